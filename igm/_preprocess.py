@@ -2,7 +2,7 @@ from __future__ import division, print_function
 
 from alabtools.utils import Genome, Index, make_diploid, make_multiploid
 from alabtools.analysis import HssFile, COORD_DTYPE
-from alabtools import Contactmatrix
+from .utils.matrix_cache import load_contact_matrix, input_matrix_cache_dir
 import os.path
 import json
 from six import string_types, raise_from
@@ -156,11 +156,12 @@ def Preprocess(cfg):
     if pbs == 'hic':
         if "Hi-C" not in cfg['restraints']:
             raise RuntimeError('Hi-C restraints specifications are missing in the cfg, but "polymer_bond_style" is set to "hic"')
-        # read the HiC matrix and get the first diagonal.
-        m = Contactmatrix(cfg['restraints']['Hi-C']['input_matrix']).matrix
+        # read the HiC matrix (from the run cache) and get the first diagonal.
+        m = load_contact_matrix(cfg['restraints']['Hi-C']['input_matrix'], input_matrix_cache_dir(cfg))
+        superdiagonal = m.superdiagonal()
         cps = np.zeros(len(index) - 1)
         for i in range(m.shape[0] - 1):
-            f = m[i][i+1]
+            f = superdiagonal[i]
             for j in index.copy_index[i]:
                 cps[j] = f
         cpfname = os.path.join(cfg['parameters']['tmp_dir'], 'consecutive_contacts.npy')
@@ -141,11 +141,7 @@ class Config(dict):
 
         opt = self['optimization']['optimizer_options']
         opt['ev_step'] = 0
-        try:
-            if opt['write'] == -1:
-                opt['write'] = opt['mdsteps']  # write only final step
-        except:
-            pass
+        # write = -1 (default): no trajectory, final coordinates are written by the kernel
 
     def preprocess_sprite_arguments(self):
         if 'sprite' not in self['restraints']:
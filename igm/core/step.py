@@ -18,6 +18,8 @@ from .job_tracking import StepDB
 from ..utils.log import print_progress, logger
 from ..utils.log import bcolors as BC
 from ..utils.files import make_absolute_path
+from ..utils.population_cache import release_population_cache, release_struct_major_copy
+from ..utils.repack import repack_hss
 from hashlib import md5
 
 class Step(object):
@@ -55,6 +57,7 @@ class Step(object):
         - before_map()
         - parallel map of static function task(struct_id, cfg, tmp_dir)
         - before_reduce()
+        - gather(arg, result) for each argument, if `stream_reduce` is set
         - reduce()
         - cleanup()
 
@@ -108,6 +111,16 @@ class Step(object):
             In a restart run, it is skipped if reduce() has already been
             completed.
 
+        gather(arg, result):
+            If the `stream_reduce` member variable is True, this function is
+            called on the master node for each argument in `argument_list`
+            as soon as its task completes, while the other tasks are still
+            running. It is intended to incrementally collect the outputs of
+            the tasks, so that the reduce() call only needs to finalize them.
+            On restart runs, or with controllers which cannot report single
+            completions, the arguments which were not gathered during the
+            mapping are gathered just before reduce() (with result=None).
+
         reduce():
             This is executed only on the master node after mapping, and
             it is intended for either serial steps which do not require
@@ -140,6 +153,8 @@ class Step(object):
             call if `keep temporary files` is True
         keep_temporary_files: bool
             if True, it deletes temporary files during cleanup
+        stream_reduce : bool
+            if True, task outputs are collected by gather() while mapping
         uid : str
             a unique string identifying the current step
 
@@ -165,6 +180,8 @@ class Step(object):
         self.tmp_dir = self.cfg["parameters"].get("tmp_dir", "tmp/")
         self.tmp_dir = make_absolute_path(self.tmp_dir, cfg["parameters"]["workdir"])
         self.keep_temporary_files = True
+        self.stream_reduce = False
+        self._gathered = set()
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
 
@@ -205,6 +222,16 @@ class Step(object):
     def before_reduce(self):
         return
 
+    def gather(self, arg, result):
+        """
+        Collect the output of a single task (only if stream_reduce is set)
+        """
+        pass
+
+    def _gather(self, k, result):
+        self.gather(self.argument_list[k], result)
+        self._gathered.add(k)
+
     def reduce(self):
         """
         Do something after parallel jobs
@@ -223,6 +250,18 @@ class Step(object):
                     os.remove(self.tmp_dir + '/' + f)
         #=
 
+        # release the node-local copies of the population on every worker, if any
+        if self.cfg.get('optimization/population_cache', False):
+            self.controller.broadcast(
+                release_population_cache,
+                self.cfg.get('optimization/structure_output'),
+                self.cfg.get('optimization/population_cache_dir', '/dev/shm')
+            )
+
+        # the struct-major copy refers to the population before this step
+        if self.cfg.get('optimization/struct_major_copy', False):
+            release_struct_major_copy(self.cfg.get('optimization/structure_output'))
+
     def run(self):
         """
         Responsible for running/restarting the step, and keeping track
@@ -271,7 +310,11 @@ class Step(object):
                 dbdata['status'] = 'map'
                 self._db.record(**dbdata)
 
-                self.controller.map(serial_function, self.argument_list)
+                if self.stream_reduce:
+                    for k, result in self.controller.imap(serial_function, self.argument_list):
+                        self._gather(k, result)
+                else:
+                    self.controller.map(serial_function, self.argument_list)
 
                 dbdata['status'] = 'mapped'
                 self._db.record(**dbdata)
@@ -283,6 +326,12 @@ class Step(object):
 
                 self.before_reduce()
 
+                # collect the outputs which were not gathered while mapping
+                if self.stream_reduce:
+                    for k in range(len(self.argument_list)):
+                        if k not in self._gathered:
+                            self._gather(k, None)
+
                 logger.info('%s - reducing' % self.name())
                 self.reduce()
                 dbdata['status'] = 'reduced'
@@ -352,8 +401,6 @@ class StructGenStep(Step):
         
 	# bonimba: using changes as Nan
         with HssFile(hssfilename, 'r+') as hss:
-            n_struct = hss.nstruct
-            n_beads = hss.nbead
             #iterate all structure files and
             total_restraints = 0.0
             total_violations = 0.0
@@ -382,16 +429,11 @@ class StructGenStep(Step):
 
         hss.close()
 
-        # repack 
-        PACK_SIZE = 1e6
-        pack_beads = max(1, int( PACK_SIZE / n_struct / 3 ) )
-        pack_beads = min(pack_beads, n_beads)
-
+        # repack
         logger.info('repacking...')
-        cmd = 'h5repack -l coordinates:CHUNK={:d}x{:d}x3 {:s} {:s}'.format(
-            pack_beads, n_struct, hssfilename, hssfilename + '.swap'
-        )
-        os.system(cmd)
+        if not repack_hss(hssfilename, hssfilename + '.swap'):
+            # already in the output layout; the working file is kept for the next step
+            copyfile(hssfilename, hssfilename + '.swap')
         logger.info('done.')
         os.rename(hssfilename + '.swap', self.cfg.get("optimization/structure_output"))
 
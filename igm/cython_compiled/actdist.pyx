@@ -0,0 +1,73 @@
+# distutils: language = c++
+
+import cython
+
+# import both numpy and the Cython declarations for numpy
+import numpy as np
+cimport numpy as np
+
+
+# declare the interface to the C code
+cdef extern from "cpp_actdist.h":
+    void get_actdist_cpp(
+        float* crds,
+        int n_struct,
+        int n_pairs,
+        long* comb_ptr,
+        long* comb_k,
+        long* comb_m,
+        double* rcutsq,
+        double* pwish,
+        double* plast,
+        double* dist,
+        double* prob,
+        double* pnow
+    )
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def get_actdist_batch(np.ndarray[float, ndim=3, mode="c"] crds not None,
+                      np.ndarray[long, ndim=1, mode="c"] comb_ptr not None,
+                      np.ndarray[long, ndim=1, mode="c"] comb_k not None,
+                      np.ndarray[long, ndim=1, mode="c"] comb_m not None,
+                      np.ndarray[double, ndim=1, mode="c"] rcutsq not None,
+                      np.ndarray[double, ndim=1, mode="c"] pwish not None,
+                      np.ndarray[double, ndim=1, mode="c"] plast not None):
+    """
+    Compute activation distances and corrected probabilities for a batch
+    of pairs, without any per-pair python overhead.
+
+    Parameters
+    ----------
+    crds (np.ndarray) : contiguous float32 coordinates of the beads involved
+        in the batch, with shape (B x N x 3), where N is the number of
+        structures (see igm.utils.files.read_bead_block)
+    comb_ptr (np.ndarray) : (P + 1) pointers, the copy combinations of the
+        q-th pair are comb_k[comb_ptr[q]:comb_ptr[q+1]], comb_m[...]
+    comb_k, comb_m (np.ndarray) : rows of crds for the first and second
+        bead of each copy combination
+    rcutsq (np.ndarray) : squared contact distance of each pair
+    pwish (np.ndarray) : target probability of each pair
+    plast (np.ndarray) : last corrected probability of each pair
+
+    Returns
+    -------
+    dist (np.ndarray) : activation distance of each pair (0 if prob is 0)
+    prob (np.ndarray) : corrected probability of each pair
+    pnow (np.ndarray) : population contact frequency of each pair
+    """
+    cdef int n_struct = crds.shape[1]
+    cdef int n_pairs = rcutsq.shape[0]
+
+    cdef np.ndarray[double, ndim=1] dist = np.zeros(n_pairs, dtype=np.float64)
+    cdef np.ndarray[double, ndim=1] prob = np.zeros(n_pairs, dtype=np.float64)
+    cdef np.ndarray[double, ndim=1] pnow = np.zeros(n_pairs, dtype=np.float64)
+
+    if n_pairs == 0 or crds.shape[0] == 0:
+        return dist, prob, pnow
+
+    get_actdist_cpp(&crds[0,0,0], n_struct, n_pairs, &comb_ptr[0], &comb_k[0], &comb_m[0],
+                    &rcutsq[0], &pwish[0], &plast[0], &dist[0], &prob[0], &pnow[0])
+
+    return dist, prob, pnow
@@ -0,0 +1,81 @@
+'''
+Benchmark of the activation distance kernels on an existing population.
+
+Random candidate pairs are assigned with:
+ - the serial `get_actdist` (one call per pair, reading from the hss file)
+ - `get_actdist_tile` with the numpy implementation
+ - `get_actdist_tile` with the compiled kernel (actdist.pyx), if built
+
+and the results are checked to be the same.
+
+Usage:
+    python benchmark_actdist.py population.hss [-n 2000] [--tile-size 64]
+'''
+from __future__ import division, print_function
+
+import sys
+import time
+import argparse
+import numpy as np
+
+from alabtools.analysis import HssFile
+
+from igm.steps.ActivationDistanceStep import get_actdist_batch
+actdist_module = sys.modules['igm.steps.ActivationDistanceStep']
+
+
+def run_tiles(ii, jj, pwish, plast, crd, radii, copy_index, chrom, contact_range, tile_size, use_compiled):
+    res = []
+    for k in range(0, len(ii), tile_size):
+        s = slice(k, k + tile_size)
+        res.append(actdist_module.get_actdist_tile(ii[s], jj[s], pwish[s], plast[s], crd, radii, copy_index,
+                                                   chrom, contact_range, use_compiled=use_compiled))
+    return np.concatenate(res)
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.time()
+    res = f(*args, **kwargs)
+    return res, time.time() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the activation distance kernels')
+    parser.add_argument('hss', help='population file')
+    parser.add_argument('-n', '--n-pairs', type=int, default=2000, help='number of random pairs')
+    parser.add_argument('--tile-size', type=int, default=64)
+    parser.add_argument('--contact-range', type=float, default=2.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    with HssFile(args.hss, 'r') as hss:
+        index = hss.index
+        n = len(index.copy_index)
+        ii = rng.randint(0, n, args.n_pairs)
+        jj = rng.randint(0, n, args.n_pairs)
+        pwish = rng.uniform(0.01, 1, args.n_pairs)
+        plast = rng.uniform(0, 0.5, args.n_pairs)
+        radii = hss.radii
+        copy_index = index.copy_index
+        chrom = index.chrom
+
+        ref, t_serial = timed(
+            lambda: [r for i, j, pw, pl in zip(ii, jj, pwish, plast)
+                     for r in actdist_module.get_actdist(i, j, pw, pl, hss, args.contact_range)]
+        )
+        print('get_actdist:              {:8.3f} s'.format(t_serial))
+
+        crd = hss['coordinates'][:]
+        out, t_numpy = timed(run_tiles, ii, jj, pwish, plast, crd, radii, copy_index, chrom,
+                             args.contact_range, args.tile_size, False)
+        print('get_actdist_tile (numpy): {:8.3f} s  ({:.1f}x)'.format(t_numpy, t_serial / t_numpy))
+        assert len(out) == len(ref) and np.allclose(out['dist'], [r[2] for r in ref])
+
+        if get_actdist_batch is None:
+            print('compiled kernel not available, build it with `python setup.py build_ext --inplace`')
+        else:
+            out, t_compiled = timed(run_tiles, ii, jj, pwish, plast, crd, radii, copy_index, chrom,
+                                    args.contact_range, args.tile_size, True)
+            print('get_actdist_tile (cpp):   {:8.3f} s  ({:.1f}x)'.format(t_compiled, t_serial / t_compiled))
+            assert len(out) == len(ref) and np.allclose(out['dist'], [r[2] for r in ref])
@@ -0,0 +1,90 @@
+#include <vector>
+#include <cmath>
+#include <algorithm>
+
+#include "cpp_actdist.h"
+
+using namespace std;
+
+// see cleanProbability in igm/steps/ActivationDistanceStep.py
+static double clean_probability(double pij, double pexist){
+  double pclean = pij;
+  if (pexist < 1)
+    pclean = (pij - pexist) / (1.0 - pexist);
+  return pclean > 0 ? pclean : 0;
+}
+
+/*
+  Activation distances for a batch of pairs.
+
+  crds contains the coordinates of the beads involved in the batch, as a
+  contiguous (n_bead, n_struct, 3) block. The copy combinations used for the
+  distances of the q-th pair are (comb_k[c], comb_m[c]) for
+  c = comb_ptr[q] ... comb_ptr[q+1] - 1, as rows of the block.
+
+  For each pair, the squared distances of all the combinations in all the
+  structures are computed in single precision (as in the numpy version),
+  the contact frequency is counted, the probability is corrected and the
+  activation distance is selected with nth_element.
+*/
+void get_actdist_cpp(float* crds,
+                     int n_struct,
+                     int n_pairs,
+                     long* comb_ptr,
+                     long* comb_k,
+                     long* comb_m,
+                     double* rcutsq,
+                     double* pwish,
+                     double* plast,
+                     double* dist,
+                     double* prob,
+                     double* pnow){
+
+  vector<double> d_sq;
+
+  for (int q = 0; q < n_pairs; ++q){
+
+    long n_comb = comb_ptr[q + 1] - comb_ptr[q];
+    long n_tot = n_comb * n_struct;
+    dist[q] = 0;
+    prob[q] = 0;
+    pnow[q] = 0;
+    if (n_tot == 0)
+      continue;
+
+    d_sq.resize(n_tot);
+    long count = 0;
+    long it = 0;
+    for (long c = comb_ptr[q]; c < comb_ptr[q + 1]; ++c){
+      float* x = crds + comb_k[c] * n_struct * 3;
+      float* y = crds + comb_m[c] * n_struct * 3;
+      for (int s = 0; s < n_struct; ++s){
+        float dx = x[3*s] - y[3*s];
+        float dy = x[3*s + 1] - y[3*s + 1];
+        float dz = x[3*s + 2] - y[3*s + 2];
+        float dx2 = dx * dx;
+        float dy2 = dy * dy;
+        float dz2 = dz * dz;
+        float v = dx2 + dy2;
+        v += dz2;
+        d_sq[it] = v;
+        if (d_sq[it] <= rcutsq[q])
+          ++count;
+        ++it;
+      }
+    }
+
+    pnow[q] = double(count) / n_tot;
+    double t = clean_probability(pnow[q], plast[q]);
+    double p = clean_probability(pwish[q], t);
+    prob[q] = p;
+
+    if (p > 0){
+      long o = (long) nearbyint(n_tot * p);
+      if (o > n_tot - 1)
+        o = n_tot - 1;
+      nth_element(d_sq.begin(), d_sq.begin() + o, d_sq.end());
+      dist[q] = sqrt(d_sq[o]);
+    }
+  }
+}
@@ -0,0 +1,12 @@
+void get_actdist_cpp(float* crds,
+                     int n_struct,
+                     int n_pairs,
+                     long* comb_ptr,
+                     long* comb_k,
+                     long* comb_m,
+                     double* rcutsq,
+                     double* pwish,
+                     double* plast,
+                     double* dist,
+                     double* prob,
+                     double* pnow);
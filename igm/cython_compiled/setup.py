@@ -1,4 +1,4 @@
-from distutils.core import setup
+from distutils.core import setup, Extension
 from Cython.Build import cythonize
 import numpy
 
@@ -6,6 +6,8 @@ setup(
       name = 'sprite',
       ext_modules = cythonize(
           ['sprite.pyx', 'cpp_sprite_assignment.cpp']
+      ) + cythonize(
+          [Extension('actdist', ['actdist.pyx', 'cpp_actdist.cpp'])]
       ),
       include_dirs=[numpy.get_include()],
 )
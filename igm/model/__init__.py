@@ -1,5 +1,5 @@
 from __future__ import division, print_function
 
-from .model import Model
+from .model import Model, optimize_models
 from .particle import Particle
 
@@ -4,6 +4,21 @@ import numpy as np
 # Define "Force" class, and then all the force instances
 
 
+def particle_arrays(particles, ids):
+    """
+    Coordinates (N*3) and radii (N) of particles ids. `particles` is either
+    the particle view of a Model, read directly from the model arrays, or
+    any sequence of Particle objects
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    model = getattr(particles, '_model', None)
+    if model is not None:
+        return model.positions[ids], model.radii[ids]
+    crd = np.array([particles[i].pos for i in ids], dtype=np.float64).reshape((-1, 3))
+    rad = np.array([particles[i].r for i in ids], dtype=np.float64)
+    return crd, rad
+
+
 class Force(object):
     """
     Define Basic Force type
@@ -74,19 +89,36 @@ class ExcludedVolume(Force):
         # scipy.spatial.distance takes an array X (m, n); m = observations, n = space dimensionality
         from scipy.spatial import distance
 
-        crd = np.array([particles[i].pos for i in self.particles])
-        rad = np.array([[particles[i].r for i in self.particles]]).T
+        crd, rad = particle_arrays(particles, self.particles)
 
         dist = distance.pdist(crd)
 
-        # distance is computed by plain sum
-        cap = distance.pdist(rad, lambda u, v: u + v)
+        # sum of radii, in the same (condensed) order as pdist
+        i, j = np.triu_indices(len(rad), 1)
+        cap = rad[i] + rad[j]
 
         # if (r_i + r_j) - d_ij < 0, then no penalty, so clip value to 0, otherwise, keep number
         s = (cap - dist).clip(min=0)
 
         return s.ravel()
 
+    def getOverlapCount(self, particles, tol=0.0):
+        '''
+        Number of pairs overlapping by more than `tol` times the sum of
+        their radii. Pairs are found with a cell list, so it can be used on
+        full genomes.
+        '''
+        from .kernel.numpy_kernel import cell_list_pairs
+
+        crd, rad = particle_arrays(particles, self.particles)
+        if len(rad) < 2:
+            return 0
+
+        i, j = cell_list_pairs(crd, 2 * rad.max())
+        cap = rad[i] + rad[j]
+        dist = np.sqrt(np.sum(np.square(crd[i] - crd[j]), axis=1))
+        return int(np.count_nonzero(cap - dist > tol * cap))
+
 #-
 
 class HarmonicUpperBound(Force):
@@ -135,6 +167,11 @@ class HarmonicUpperBound(Force):
 
         return 0 if self.d == 0 else self.getScore(particles) / (self.k * self.d)
 
+    @staticmethod
+    def getBondScores(dist, d, k):
+        """ Scores of a set of upper bounds, from the arrays of distances and parameters """
+        return k * np.maximum(dist - d, 0)
+
 #-
 
 class HarmonicLowerBound(Force):
@@ -182,6 +219,11 @@ class HarmonicLowerBound(Force):
     def getViolationRatio(self, particles):
 
         return 0 if self.d == 0 else self.getScore(particles) / (self.k * self.d)
+
+    @staticmethod
+    def getBondScores(dist, d, k):
+        """ Scores of a set of lower bounds, from the arrays of distances and parameters """
+        return k * np.maximum(d - dist, 0)
 #-
 
 class EllipticEnvelope(Force):
@@ -203,43 +245,37 @@ class EllipticEnvelope(Force):
         self.note = note
         self.rnum = len(particle_ids)
 
-    def getScore(self, particles):
+    def _k2(self, particles):
 
-        E = 0
-        for i in self.particle_ids:
-            p = particles[i]
-            s2 = np.square(self.semiaxes - p.r)
-            x = p.pos
-            x2 = x**2
-            k2 = np.sum(x2 / s2)
-            if k2 > 1:
-                t = ( 1.0 - 1.0/np.sqrt(k2) )*np.linalg.norm(x)
-                E += 0.5 * (t**2) * self.k
-        return E
+        """ Sum of squared coordinates over squared effective semiaxes, and the coordinates """
 
-    def getScores(self, particles):
+        crd, rad = particle_arrays(particles, self.particle_ids)
+        crd = crd.astype(np.float64)
+        s2 = np.square(self.semiaxes[None] - rad[:, None])
+        return np.sum(np.square(crd) / s2, axis=1), crd
 
-        scores = np.zeros(len(self.particle_ids))
-        for k, i in enumerate(self.particle_ids):
-            p = particles[i]
-            s2 = np.square(self.semiaxes - p.r)
-            x = p.pos
-            x2 = x**2
-            k2 = np.sqrt(np.sum(x2 / s2))
+    def getScore(self, particles):
 
-            # note that those scores are somewhat approximate
-            if k2 > 1 and self.k > 0:
-                t = ( 1.0 - 1.0/np.sqrt(k2) )*np.linalg.norm(x)/self.scale
+        k2, crd = self._k2(particles)
+        out = k2 > 1
+        t = ( 1.0 - 1.0/np.sqrt(k2[out]) )*np.linalg.norm(crd[out], axis=1)
+        return np.sum(0.5 * (t**2) * self.k)
 
-            elif k2 < 1 and self.k < 0:
-                t = ( 1.0 - np.sqrt(k2))
+    def getScores(self, particles):
 
-            else:
-                t = 0
+        k2, crd = self._k2(particles)
+        k2 = np.sqrt(k2)
 
-            scores[k] = max(0, t * self.k)
+        # note that those scores are somewhat approximate
+        t = np.zeros(len(k2))
+        if self.k > 0:
+            out = k2 > 1
+            t[out] = ( 1.0 - 1.0/np.sqrt(k2[out]) )*np.linalg.norm(crd[out], axis=1)/self.scale
+        elif self.k < 0:
+            inside = k2 < 1
+            t[inside] = ( 1.0 - np.sqrt(k2[inside]))
 
-        return scores
+        return np.maximum(0, t * self.k)
 
     def getViolationRatio(self, particles):
         ave_t = np.sqrt(2 * self.getScore(particles) / self.k)
@@ -287,113 +323,35 @@ class ExpEnvelope(Force):
 
     def getScores(self, particles):
 
-        scores = np.zeros(len(self.particle_ids))
+        from .kernel.numpy_kernel import load_volume_map
 
-        # load file with volumetric information and parameters
-        f = open(self.volume_file)
+        # volumetric information and parameters
+        body_idx, nvoxel, center, origin, grid, matrice = load_volume_map(self.volume_file)
 
-        # read in nucleus/nuclear body switch
-        body_idx = [int(x) for x in next(f).split()][0]
+        crd, _ = particle_arrays(particles, self.particle_ids)
+        crd = crd.astype(np.float64)
+        scores = np.zeros(len(crd))
 
-    	# compute number of voxels per size
-        nvoxel = np.array([int(x) for x in next(f).split()])
-
-        # "geometric center of the grid"
-        center = np.array([float(x) for x in next(f).split()])
- 
-        # float information about grid features (origin and grid)
-        origin = np.array([float(x) for x in next(f).split()])
-        grid   = np.array([float(x) for x in next(f).split()])  
-    
-        matrice = np.zeros((nvoxel[0], nvoxel[1], nvoxel[2]))
-    
-        for i in range(nvoxel[0] * nvoxel[1] * nvoxel[2]):
-
-            # read quadruplet, (i,j,k) and the binary value entry
-            a, b, c, q = [int(x) for x in next(f).split()]
-        
-            # cast that into matrix
-            matrice[a,b,c] = q
-       
-        # at the end of loop , check if number of remaining lines is consistent with number of map voxels
-        if (i != (nvoxel[0] * nvoxel[1] * nvoxel[2] - 1)):
-                print(nvoxel[0] * nvoxel[1] * nvoxel[2])
-                print("ACHTUNG!")
-                stop	
+        # find indexes, are they inside of the three d volume spanned by the map box?
+        idx = (crd - origin)/grid
+        inside = np.all((idx >= 0) & (idx < nvoxel), axis=1)
+        occupied = np.zeros(len(crd), dtype=bool)
+        id_int = idx[inside].astype(int)
+        occupied[inside] = matrice[id_int[:, 0], id_int[:, 1], id_int[:, 2]] == 1
+        dist = np.linalg.norm(crd - center, axis=1)
 
         # discriminate between nucleolus and nucleus
         if body_idx == False:
 
-          # compute effective map radius as geometric mean of the axes
-          R_eff = np.abs((origin[0] * origin[1] * origin[2])) ** (1./3)
-
-          for k, i in enumerate(self.particle_ids):
-
-              idx = np.zeros(3)
-              id_int = np.zeros(3).astype('int')
-
-              p = particles[i]
+            # compute effective map radius as geometric mean of the axes
+            R_eff = np.abs((origin[0] * origin[1] * origin[2])) ** (1./3)
 
-              # find indexes
-              idx = (p.pos - origin)/grid
-	    
-              # are indexes outside of the three d volume spanned by the map box? If yes, set index to -1
-              if (idx[0] < 0) or (idx[0] >= nvoxel[0]):
-               	id_int[0] = -1.0
-                #print("I mean 0")
-              else:
-                id_int[0] = int(idx[0])
-
-              if (idx[1] < 0) or (idx[1] >= nvoxel[1]):
-                id_int[1] = -1.0
-                #print("I mean 1")
-              else:
-                id_int[1] = int(idx[1])
-
-              if (idx[2] < 0) or (idx[2] >= nvoxel[2]):
-                id_int[2] = -1.0
-                #print("I mean 2")
-              else:
-                id_int[2] = int(idx[2])
-
-              if ((id_int[0] < 0) or (id_int[1] < 0) or (id_int[2] < 0) or (matrice[id_int[0], id_int[1], id_int[2]] == 1)):
-                
-                scores[k] = np.abs((np.linalg.norm(p.pos - center))/R_eff - 1.0)   # the closest to the envelope
+            out = ~inside | occupied
+            scores[out] = np.abs(dist[out]/R_eff - 1.0)   # the closest to the envelope
 
         if body_idx == True:
 
-          for k, i in enumerate(self.particle_ids):
-
-              idx = np.zeros(3)
-              id_int = np.zeros(3).astype('int')
-
-              p = particles[i]
-
-              # find indexes
-              idx = (p.pos - origin)/grid
-
-              # are indexes outside of the three d volume spanned by the map box? If yes, set index to -1
-              if (idx[0] < 0) or (idx[0] >= nvoxel[0]):
-                id_int[0] = -1.0
-                #print("I mean 0")
-              else:
-                id_int[0] = int(idx[0])
-
-              if (idx[1] < 0) or (idx[1] >= nvoxel[1]):
-                id_int[1] = -1.0
-                #print("I mean 1")
-              else:
-                id_int[1] = int(idx[1])
-
-              if (idx[2] < 0) or (idx[2] >= nvoxel[2]):
-                id_int[2] = -1.0
-                #print("I mean 2")
-              else:
-                id_int[2] = int(idx[2])
-
-              if ((id_int[0] >= 0) and (id_int[1] >= 0) and (id_int[2] >= 0) and (matrice[id_int[0], id_int[1], id_int[2]] == 1)):
-
-                scores[k] = np.linalg.norm(p.pos - center)  # the closest to the envelope
+            scores[occupied] = dist[occupied]  # the closest to the envelope
 
         return scores
 
@@ -432,10 +390,10 @@ class NuclExcludedVolume(Force):
         # scipy.spatial.distance takes an array X (m, n); m = observations, n = space dimensionality
         from scipy.spatial import distance
 
-        crd = np.array([particles[i].pos for i in self.particles])
+        crd, rad = particle_arrays(particles, self.particles)
         dist = distance.cdist(crd, self.body_pos)   # distance between all particle centers and nucleulus center
                                                # it is a (n,1) array, n = number of particles
-        rad = np.array([[particles[i].r for i in self.particles]]).T
+        rad = rad[:, None]
         cap = rad + self.body_r     # sum of radii
 
         # if (r_i + r_j) - d_ij < 0, then no penalty, so clip value to 0, otherwise, keep number
@@ -0,0 +1,214 @@
+'''
+Benchmark of the LAMMPS data file generation.
+
+A synthetic model (diploid genome, polymer, Hi-C-like bonds, radial bonds to
+the nuclear center, envelope and excluded volume) is converted and written
+with:
+ - the previous object based conversion and per-line writer, reproduced
+   below as reference
+ - the array based `LammpsModel` and `create_lammps_data`
+
+and the numeric content of the two data files is checked to be the same.
+
+Usage:
+    python benchmark_lammps_data.py [--n-beads 15000] [--n-bonds 50000]
+'''
+from __future__ import division, print_function
+
+import os
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+from igm.model import Model, Particle
+from igm.model.forces import HarmonicUpperBound, HarmonicLowerBound, ExcludedVolume, EllipticEnvelope
+from igm.model.kernel import lammps_model as lm
+from igm.model.kernel.lammps import create_lammps_data
+
+
+def make_model(n_beads, n_bonds, n_radial, seed=0):
+    rng = np.random.RandomState(seed)
+    model = Model(uid=1)
+    radius = 5000.
+    crd = rng.uniform(-radius / 2, radius / 2, (2 * n_beads, 3))
+    radii = np.where(rng.uniform(size=n_beads) < 0.5, 100., 120.)
+    for c in range(2):
+        for i in range(n_beads):
+            model.addParticle(crd[c * n_beads + i], radii[i], Particle.NORMAL, chainID=c)
+    n = 2 * n_beads
+    model.addForce(ExcludedVolume(range(n), 1.0))
+    model.addForce(EllipticEnvelope(range(n), (0, 0, 0), (radius, radius, radius), 1.0))
+    for i in range(n - 1):
+        model.addForce(HarmonicUpperBound((i, i + 1), 440., 1.0))
+    ii = rng.randint(0, n, n_bonds)
+    jj = rng.randint(0, n, n_bonds)
+    for i, j in zip(ii, jj):
+        model.addForce(HarmonicUpperBound((i, j), 440., 1.0))
+    center = model.addParticle([0., 0., 0.], 0., Particle.DUMMY_STATIC)
+    for i, d in zip(rng.randint(0, n, n_radial), rng.uniform(1000, 4000, n_radial)):
+        model.addForce(HarmonicUpperBound((i, center), d, 1.0))
+        model.addForce(HarmonicLowerBound((i, center), d * 0.9, 1.0))
+    return model
+
+
+class ObjectLammpsModel(object):
+
+    """ The previous object based conversion, for reference """
+
+    def __init__(self, model):
+        self.atoms = []
+        self.atom_types = {}
+        self.bonds = []
+        self.bond_types = {}
+        self.nmol = 1
+        self.imap = []
+        for p in model.particles:
+            if p.ptype == Particle.NORMAL:
+                atom = self.add_atom(lm.DNABead(p.r), p.pos, mol_id=p.chainID + 1)
+            elif p.ptype == Particle.DUMMY_STATIC:
+                atom = self.get_next_dummy(p.pos)
+            else:
+                atom = self.add_atom(lm.ClusterCentroid(), p.pos)
+            self.imap.append(atom.id)
+        for f in model.forces:
+            if f.ftype == f.EXCLUDED_VOLUME:
+                self.evfactor = f.k
+            elif f.ftype in (f.HARMONIC_UPPER_BOUND, f.HARMONIC_LOWER_BOUND):
+                pi, pj = self.atoms[self.imap[f.i]], self.atoms[self.imap[f.j]]
+                if pi.atom_type == lm.Atom.FIXED_DUMMY:
+                    pi = self.get_next_dummy()
+                if pj.atom_type == lm.Atom.FIXED_DUMMY:
+                    pj = self.get_next_dummy()
+                if f.ftype == f.HARMONIC_UPPER_BOUND:
+                    self.add_bond(pi, pj, lm.HarmonicUpperBound(r0=f.d, k=f.k))
+                else:
+                    self.add_bond(pi, pj, lm.HarmonicLowerBound(r0=f.d, k=f.k))
+
+    def get_next_dummy(self, pos=np.array([0., 0., 0.])):
+        if (self.atoms[-1].atom_type == lm.Atom.FIXED_DUMMY and
+                self.atoms[-1].nbonds < lm.FrozenPhantomBead.MAX_BONDS and
+                np.all(self.atoms[-1].xyz == pos)):
+            return self.atoms[-1]
+        return self.add_atom(lm.FrozenPhantomBead(), xyz=pos)
+
+    def add_bond(self, i, j, bond_type):
+        btype = self.bond_types.get(bond_type, None)
+        if btype is None:
+            bond_type.id = len(self.bond_types)
+            btype = self.bond_types[bond_type] = bond_type
+        self.bonds.append(lm.Bond(len(self.bonds), btype, i, j))
+        i.nbonds += 1
+        j.nbonds += 1
+
+    def add_atom(self, atom_type, xyz=np.array([0., 0., 0.]), mol_id=0):
+        atype = self.atom_types.get(atom_type, None)
+        if atype is None:
+            atom_type.id = len(self.atom_types)
+            atype = self.atom_types[atom_type] = atom_type
+        atom = lm.Atom(len(self.atoms), atype, mol_id, xyz)
+        self.atoms.append(atom)
+        self.nmol = max(mol_id, self.nmol)
+        return atom
+
+
+def create_object_lammps_data(model, fname):
+
+    """ The previous per-line writer, for reference """
+
+    boxdim = 0
+    for atom in model.atoms:
+        boxdim = max(boxdim, np.max(np.abs(atom.xyz)))
+    boxdim *= 1.05
+    with open(fname, 'w') as f:
+        print('LAMMPS input\n', file=f)
+        print(len(model.atoms), 'atoms\n', file=f)
+        print(len(model.atom_types), 'atom types\n', file=f)
+        print(len(model.bond_types), 'bond types\n', file=f)
+        print(len(model.bonds), 'bonds\n', file=f)
+        print('-{} {} xlo xhi\n'.format(boxdim, boxdim),
+              '-{} {} ylo yhi\n'.format(boxdim, boxdim),
+              '-{} {} zlo zhi'.format(boxdim, boxdim), file=f)
+        print('\nAtoms\n', file=f)
+        for atom in model.atoms:
+            print(atom, file=f)
+        print('\nBond Coeffs\n', file=f)
+        for bt in model.bond_types:
+            print(bt, file=f)
+        print('\nBonds\n', file=f)
+        for bond in model.bonds:
+            print(bond, file=f)
+        atom_types = list(model.atom_types.values())
+        print('\nPairIJ Coeffs\n', file=f)
+        for i in range(len(atom_types)):
+            a1 = atom_types[i]
+            for j in range(i, len(atom_types)):
+                a2 = atom_types[j]
+                if a1.atom_category == lm.AtomType.BEAD and a2.atom_category == lm.AtomType.BEAD:
+                    dc = a1.radius + a2.radius
+                    print(a1.id + 1, a2.id + 1, (dc / math.pi)**2 * model.evfactor, dc, file=f)
+                else:
+                    print(a1.id + 1, a2.id + 1, 0.0, 0.0, file=f)
+        print('\nUser\n', file=f)
+        for i, atom in enumerate(model.atoms):
+            print(i + 1, atom.mol_id, getattr(atom.atom_type, 'radius', 0), file=f)
+
+
+def read_sections(fname):
+
+    """ Numeric values in each section of a data file, bond styles are dropped """
+
+    sections = {}
+    current = None
+    with open(fname) as f:
+        for line in f:
+            v = line.split()
+            if not v:
+                continue
+            if v[0][0].isalpha():
+                current = line.strip()
+                sections[current] = []
+            elif current is not None:
+                sections[current].extend(float(x) for x in v if not x[0].isalpha())
+    return {k: np.array(v) for k, v in sections.items()}
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.time()
+    res = f(*args, **kwargs)
+    return res, time.time() - t0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the LAMMPS data file generation')
+    parser.add_argument('--n-beads', type=int, default=15000, help='beads per haploid genome')
+    parser.add_argument('--n-bonds', type=int, default=50000, help='number of random bonds')
+    parser.add_argument('--n-radial', type=int, default=2000, help='number of radial bond pairs')
+    args = parser.parse_args()
+
+    model = make_model(args.n_beads, args.n_bonds, args.n_radial)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        old_fname = os.path.join(tmpdir, 'object.data')
+        new_fname = os.path.join(tmpdir, 'array.data')
+
+        old, t_old_conv = timed(ObjectLammpsModel, model)
+        _, t_old_write = timed(create_object_lammps_data, old, old_fname)
+        new, t_new_conv = timed(lm.LammpsModel, model)
+        _, t_new_write = timed(create_lammps_data, new, {'data': new_fname})
+
+        print('                 convert     write')
+        print('objects:        {:7.3f} s {:7.3f} s'.format(t_old_conv, t_old_write))
+        print('arrays:         {:7.3f} s {:7.3f} s'.format(t_new_conv, t_new_write))
+        print('speedup:        {:7.1f} x {:7.1f} x'.format(t_old_conv / t_new_conv, t_old_write / t_new_write))
+
+        a, b = read_sections(old_fname), read_sections(new_fname)
+        assert sorted(a.keys()) == sorted(b.keys())
+        for k in a:
+            assert a[k].shape == b[k].shape and np.allclose(a[k], b[k], rtol=1e-6), k
+        assert np.all(np.asarray(old.imap) == new.imap)
+        print('data files match')
+    finally:
+        shutil.rmtree(tmpdir)
@@ -35,10 +35,13 @@ import os
 import os.path
 import errno
 import math
+import shutil
+import tempfile
 from itertools import groupby
 from copy import deepcopy
 
 from subprocess import Popen, PIPE
+from io import StringIO
 
 from .lammps_io import get_info_from_log, get_last_frame
 from .lammps_model import *
@@ -59,20 +62,39 @@ INFO_KEYS = ['final-energy', 'pair-energy',
              'bond-energy', 'md-time', 'n_restr', 'n_hic_restr']
 EPS_TEMP = 0.001
 
+# printed to the log before each model in batch runs
+BATCH_MARKER = 'IGM_MODEL_ID '
+
+
+# rows formatted with a single string operation when writing data files
+DATA_CHUNK_ROWS = 65536
+
+
+def write_rows(f, row_format, columns, chunk_rows=DATA_CHUNK_ROWS):
+    '''
+    Write a table of numeric columns to f, one row per line. Rows are
+    formatted in chunks with a single %-format operation, instead of one
+    print per row. Integer columns can use %d, values are exact up to 2**53.
+    '''
+    table = np.column_stack([np.asarray(c, dtype=np.float64) for c in columns])
+    row_format += '\n'
+    for start in range(0, len(table), chunk_rows):
+        block = table[start:start + chunk_rows]
+        f.write((row_format * len(block)) % tuple(block.ravel().tolist()))
+
 
 def create_lammps_data(model, user_args):
 
     """ model = lammps model already """
 
     n_atom_types = len(model.atom_types)
-    n_bonds      = len(model.bonds)
-    n_bondtypes  = len(model.bond_types)
-    n_atoms      = len(model.atoms)
+    n_bonds      = model.n_bonds
+    n_bondtypes  = model.n_bond_types
+    n_atoms      = model.n_atoms
+    atom_ids     = np.arange(1, n_atoms + 1)
 
     # define simulation box size
-    boxdim = 0
-    for atom in model.atoms:
-        boxdim = max(boxdim, np.max(np.abs(atom.xyz)))
+    boxdim = float(np.max(np.abs(model.atom_xyz))) if n_atoms else 0.
     boxdim *= 1.05
 
     with open(user_args['data'], 'w') as f:
@@ -92,8 +114,9 @@ def create_lammps_data(model, user_args):
         # --- atom coordinates -----
         print('\nAtoms\n', file=f)
         # index, molecule, atom type, x y z.
-        for atom in model.atoms:
-            print(atom, file=f)
+        write_rows(f, '%d %d %d %.9g %.9g %.9g',
+                   [atom_ids, model.atom_mol + 1, model.atom_type + 1,
+                    model.atom_xyz[:, 0], model.atom_xyz[:, 1], model.atom_xyz[:, 2]])
 
         # --- information about the bonds ----
         # Harmonic Upper Bond Coefficients are one for each bond type
@@ -104,46 +127,33 @@ def create_lammps_data(model, user_args):
 
         if n_bonds > 0:
             print('\nBond Coeffs\n', file=f)
-            for bt in model.bond_types:
-                print(bt, file=f)
+            for t in range(n_bondtypes):
+                print(t + 1, LammpsModel.BOND_STYLES[model.bond_style[t]].style_str,
+                      repr(float(model.bond_k[t])), repr(float(model.bond_r0[t])), file=f)
 
             print('\nBonds\n', file=f)
-            for bond in model.bonds:
-                print(bond, file=f)
+            write_rows(f, '%d %d %d %d',
+                       [np.arange(1, n_bonds + 1), model.bond_type + 1,
+                        model.bond_i + 1, model.bond_j + 1])
 
         # Excluded volume coefficients: one set of coefficients for EACH pair-flavors (i.e., pair of particle types)
+        # if either one particle is not a BEAD type, no excluded volume is applied
         atom_types = list(model.atom_types.values())
+        is_bead = np.array([at.atom_category == AtomType.BEAD for at in atom_types])
+        radii = np.array([at.radius if at.atom_category == AtomType.BEAD else 0. for at in atom_types],
+                         dtype=np.float64)
+        ti, tj = np.triu_indices(len(atom_types))
+        both = is_bead[ti] & is_bead[tj]
+        dc = np.where(both, radii[ti] + radii[tj], 0.)
+        A = (dc / math.pi)**2
+        evfactor = model.evfactor if np.any(both) else 0.
 
         print('\nPairIJ Coeffs\n', file=f)
-        for i in range(len(atom_types)):
-            a1 = atom_types[i]
-            for j in range(i, len(atom_types)):
-                a2 = atom_types[j]
-                id1 = min(a1.id + 1, a2.id + 1)
-                id2 = max(a1.id + 1, a2.id + 1)
-
-                # if either one particle is not a BEAD type, no excluded volume is applied
-                if (a1.atom_category == AtomType.BEAD and
-                        a2.atom_category == AtomType.BEAD):
-                    ri = a1.radius
-                    rj = a2.radius
-                    dc = (ri + rj)
-                    A = (dc / math.pi)**2
-                    # sigma = dc / 1.1224 #(2**(1.0/6.0))
-                    #print(i+1, user_args['evfactor'], sigma, dc, file=f)
-
-                    print(id1, id2, A * model.evfactor, dc, file=f)
-                else:
-                    print(id1, id2, 0.0, 0.0, file=f)
+        write_rows(f, '%d %d %.17g %.9g', [ti + 1, tj + 1, A * evfactor, dc])
 
         # User data, add bead radius
         print('\nUser\n', file=f)
-        for i, atom in enumerate(model.atoms):
-            if hasattr(atom.atom_type, 'radius'):
-                r = atom.atom_type.radius
-            else:
-                r = 0
-            print(i + 1, atom.mol_id, r, file=f)
+        write_rows(f, '%d %d %.9g', [atom_ids, model.atom_mol, model.atom_radius])
 
 
 def create_lammps_script(model, user_args):
@@ -249,11 +259,13 @@ def create_lammps_script(model, user_args):
 
         # print('pair_modify shift yes mix arithmetic', file=f)
 
-        # regulate output:
-        print('dump   crd_dump all custom',
-              user_args['write'],
-              user_args['out'],
-              'id type x y z fx fy fz', file=f)
+        # regulate output: the trajectory is only written if requested, the
+        # final coordinates are written at the end with write_dump
+        if user_args['write'] > 0:
+            print('dump   crd_dump all custom',
+                  user_args['write'],
+                  user_args['out'],
+                  'id type x y z fx fy fz', file=f)
 
         # Write the steps of simulated annealing
 
@@ -355,6 +367,8 @@ def create_lammps_script(model, user_args):
         print('minimize', user_args['etol'], user_args['ftol'],
               user_args['max_cg_iter'], user_args['max_cg_eval'], file=f)
 
+        print('write_dump all custom', user_args['final'], 'id x y z modify sort id', file=f)
+
         print('info time', file=f)
 
 
@@ -371,11 +385,15 @@ def optimize(model, cfg):
     The files created are
     - input file: `tmp_files_dir`/`run_name`.lam
     - data file: `tmp_files_dir`/`run_name`.input
-    - trajectory file: `tmp_files_dir`/`run_name`.lammpstrj
-
-    The function tries to remove the temporary files after the run, both in
-    case of failure and success (unless `keep_temporary_files` is set to
-    `False`). If the interpreter is killed without being able to catch
+    - trajectory file: `tmp_files_dir`/`run_name`.lammpstrj (only if
+      `optimizer_options/write` > 0)
+    - final frame: `tmp_files_dir`/`run_name`.final.lammpstrj
+
+    The files are written in a node-local scratch directory if available, and
+    copied to `tmp_files_dir` only on failure or if `keep_temporary_files` is
+    set (see `StagingDir`). The function tries to remove the temporary files
+    after the run, both in case of failure and success (unless
+    `keep_temporary_files` is set to `False`). If the interpreter is killed without being able to catch
     exceptions (for example because of a walltime limit) some files could be
     left behind.
 
@@ -404,35 +422,17 @@ def optimize(model, cfg):
         a RuntimeError with the contents of the standard error.
     '''
 
-    tmp_files_dir = cfg['optimization']['tmp_dir']
-    if not os.path.isabs(cfg['optimization']['tmp_dir']):
-        tmp_files_dir = os.path.join(
-            cfg['parameters']['tmp_dir'], tmp_files_dir)
-    try:
-        os.makedirs(tmp_files_dir)
-    except OSError as e:
-        if e.errno == errno.EEXIST:
-            pass
-
     run_name             = cfg['runtime']['run_name']
-    keep_temporary_files = cfg['optimization']['keep_temporary_files']
     lammps_executable    = cfg['optimization'][
         'kernel_opts']['lammps']['lammps_executable']
-    run_opts             = deepcopy(cfg['optimization']['optimizer_options'])
 
-    data_fname           = os.path.join(tmp_files_dir, run_name + '.data')
-    script_fname         = os.path.join(tmp_files_dir, run_name + '.lam')
-    traj_fname           = os.path.join(tmp_files_dir, run_name + '.lammpstrj')
-    log_fname            = os.path.join(tmp_files_dir, run_name + '.log')
+    with StagingDir(cfg, run_name) as staging:
 
-    try:
+        io_opts = get_io_opts(staging, run_name)
+        script_fname, log_fname = io_opts['lmp'], io_opts['log']
 
         # prepare input
-        io_opts = {'out': traj_fname, 'data': data_fname, 'lmp': script_fname}
-        run_opts.update(io_opts)
-        run_opts.update(cfg['optimization']['kernel_opts']['lammps'])
-        # this is to set the random seed
-        run_opts.update({'step_no': cfg.get('runtime/step_no', 1) + 2})
+        run_opts = get_run_opts(cfg, io_opts)
         m = LammpsModel(model)
  
         # write input .lam and .data files to be used in the minimization
@@ -440,50 +440,223 @@ def optimize(model, cfg):
         create_lammps_script(m, run_opts)
 
         # run the lammps minimization
-        with open(script_fname, 'r') as lamfile:
-            proc = Popen([lammps_executable, '-log', log_fname],
-                         stdin=lamfile,
-                         stdout=PIPE,
-                         stderr=PIPE)
-            output, error = proc.communicate()
-
-        if proc.returncode != 0:
-            raise RuntimeError('LAMMPS exited with non-zero exit code: %d (modelid: %d)\nOutput:\n%s\n' % (
-                               proc.returncode,
-                               model.id,
-                               output))
+        run_lammps(lammps_executable, script_fname, log_fname, [model.id])
 
         # get results
         with open(log_fname, 'r') as lf:
             info = get_info_from_log(lf)   # this is returned as result of lammps minimization file
 
-        with open(traj_fname, 'r') as fd:
+        with open(io_opts['final'], 'r') as fd:
             new_crd = get_last_frame(fd)
 
         # updates the input model coordinates
-        for i, p in enumerate(model.particles):
-            p.pos = new_crd[m.imap[i]]
-
-        if not keep_temporary_files:
-            if os.path.isfile(data_fname):
-                os.remove(data_fname)
-            if os.path.isfile(script_fname):
-                os.remove(script_fname)
-            if os.path.isfile(traj_fname):
-                os.remove(traj_fname)
-            if os.path.isfile(log_fname):
-                os.remove(log_fname)
-
-    except:
-        if not keep_temporary_files:
-            if os.path.isfile(data_fname):
-                os.remove(data_fname)
-            if os.path.isfile(script_fname):
-                os.remove(script_fname)
-            if os.path.isfile(traj_fname):
-                os.remove(traj_fname)
-            if os.path.isfile(log_fname):
-                os.remove(log_fname)
-        raise
+        model.positions[:] = new_crd[m.imap]
 
     return info
+
+
+def optimize_batch(models, cfg):
+    '''
+    Optimize several models with a single LAMMPS process.
+
+    The input files of each model are generated as in `optimize`, using
+    `<run_name>_<model.id>` as run name. A master script runs them in
+    sequence, with a `clear` before each one, so LAMMPS startup is paid only
+    once per batch. Each model prints a marker to the log, which is used to
+    split the log and get the info of each run.
+
+    Parameters
+    ----------
+    models : list of `igm.Model`
+    cfg : dict
+
+    Returns
+    -------
+    infos : list of dict
+        info of each run, as returned by `get_info_from_log`
+
+    Raises
+    ------
+    RuntimeError
+        If the lammps executable return code is different from 0. In this
+        case no model is updated.
+    '''
+
+    run_name             = cfg['runtime']['run_name']
+    lammps_executable    = cfg['optimization'][
+        'kernel_opts']['lammps']['lammps_executable']
+
+    batch_name = '{}_batch{:d}'.format(run_name, models[0].id)
+
+    with StagingDir(cfg, batch_name) as staging:
+
+        script_fname = staging.path(batch_name + '.lam')
+        log_fname = staging.path(batch_name + '.log')
+        all_io_opts = [get_io_opts(staging, '{}_{:d}'.format(run_name, model.id)) for model in models]
+
+        lammps_models = []
+        with open(script_fname, 'w') as f:
+            for model, io_opts in zip(models, all_io_opts):
+                run_opts = get_run_opts(cfg, io_opts)
+                m = LammpsModel(model)
+                create_lammps_data(m, run_opts)
+                create_lammps_script(m, run_opts)
+                lammps_models.append(m)
+
+                print('clear', file=f)
+                print('print "{}{:d}"'.format(BATCH_MARKER, model.id), file=f)
+                print('include', io_opts['lmp'], file=f)
+
+        run_lammps(lammps_executable, script_fname, log_fname, [model.id for model in models])
+
+        # split the log by model
+        logs = {}
+        with open(log_fname, 'r') as lf:
+            for line in lf:
+                if line.startswith(BATCH_MARKER):
+                    current = logs[int(line[len(BATCH_MARKER):])] = []
+                elif logs:
+                    current.append(line)
+
+        infos = []
+        for model, m, io_opts in zip(models, lammps_models, all_io_opts):
+            infos.append(get_info_from_log(StringIO(''.join(logs[model.id]))))
+
+            with open(io_opts['final'], 'r') as fd:
+                new_crd = get_last_frame(fd)
+
+            model.positions[:] = new_crd[m.imap]
+
+    return infos
+
+
+def get_tmp_files_dir(cfg):
+
+    """ Directory for the lammps input and output files (created if needed) """
+
+    tmp_files_dir = cfg['optimization']['tmp_dir']
+    if not os.path.isabs(cfg['optimization']['tmp_dir']):
+        tmp_files_dir = os.path.join(
+            cfg['parameters']['tmp_dir'], tmp_files_dir)
+    try:
+        os.makedirs(tmp_files_dir)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            pass
+    return tmp_files_dir
+
+
+def get_scratch_dir(cfg):
+    '''
+    Node-local directory for the files of the runs (see
+    `optimization/scratch_dir`), or None if the temporary directory should
+    be used.
+    '''
+    scratch_dir = cfg.get('optimization/scratch_dir', 'auto')
+    if not scratch_dir or scratch_dir == 'none':
+        return None
+    if scratch_dir == 'auto':
+        candidates = ['/dev/shm', os.environ.get('TMPDIR')]
+    else:
+        candidates = [os.path.expandvars(scratch_dir)]
+    for d in candidates:
+        if d and os.path.isdir(d) and os.access(d, os.W_OK | os.X_OK):
+            return d
+    return None
+
+
+class StagingDir(object):
+    '''
+    Context manager for the directory where the files of a run are written.
+    File names are obtained with `path`.
+
+    If a scratch directory is available (see `get_scratch_dir`), the files
+    are written in a new subdirectory of it, which is removed at the end.
+    The files are copied back to the temporary directory if the run fails,
+    or if `optimization/keep_temporary_files` is set. Otherwise, the files
+    are written directly in the temporary directory, and removed at the end
+    unless `keep_temporary_files` is set.
+    '''
+
+    def __init__(self, cfg, name):
+        self.tmp_files_dir = get_tmp_files_dir(cfg)
+        self.keep_temporary_files = cfg['optimization']['keep_temporary_files']
+        self.scratch_dir = get_scratch_dir(cfg)
+        self.name = name
+        self.files = []
+        self.dir = None
+
+    def __enter__(self):
+        self.dir = self.tmp_files_dir
+        if self.scratch_dir is not None:
+            try:
+                self.dir = tempfile.mkdtemp(prefix=self.name + '.', dir=self.scratch_dir)
+            except OSError:
+                self.scratch_dir = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.scratch_dir is None:
+            if not self.keep_temporary_files:
+                remove_files(self.files)
+        else:
+            if self.keep_temporary_files or exc_type is not None:
+                for fname in self.files:
+                    if os.path.isfile(fname):
+                        shutil.copy(fname, self.tmp_files_dir)
+            shutil.rmtree(self.dir, ignore_errors=True)
+        return False
+
+    def path(self, fname):
+        fname = os.path.join(self.dir, fname)
+        self.files.append(fname)
+        return fname
+
+
+def get_io_opts(staging, run_name):
+
+    """ File names for a run, in a StagingDir """
+
+    return {
+        'data': staging.path(run_name + '.data'),
+        'lmp': staging.path(run_name + '.lam'),
+        'out': staging.path(run_name + '.lammpstrj'),
+        'log': staging.path(run_name + '.log'),
+        'final': staging.path(run_name + '.final.lammpstrj'),
+    }
+
+
+def get_run_opts(cfg, io_opts):
+
+    """ Options for create_lammps_data and create_lammps_script """
+
+    run_opts = deepcopy(cfg['optimization']['optimizer_options'])
+    run_opts.update(io_opts)
+    run_opts.update(cfg['optimization']['kernel_opts']['lammps'])
+    # this is to set the random seed
+    run_opts.update({'step_no': cfg.get('runtime/step_no', 1) + 2})
+    return run_opts
+
+
+def run_lammps(lammps_executable, script_fname, log_fname, model_ids):
+
+    """ Run lammps on a script, raises a RuntimeError on failure """
+
+    with open(script_fname, 'r') as lamfile:
+        proc = Popen([lammps_executable, '-log', log_fname],
+                     stdin=lamfile,
+                     stdout=PIPE,
+                     stderr=PIPE)
+        output, error = proc.communicate()
+
+    if proc.returncode != 0:
+        raise RuntimeError('LAMMPS exited with non-zero exit code: %d (modelid: %s)\nOutput:\n%s\n' % (
+                           proc.returncode,
+                           ', '.join(str(i) for i in model_ids),
+                           output))
+
+
+def remove_files(fnames):
+    for fname in fnames:
+        if os.path.isfile(fname):
+            os.remove(fname)
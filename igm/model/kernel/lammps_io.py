@@ -1,4 +1,5 @@
 from __future__ import division, absolute_import, print_function
+import os
 import numpy as np
 
 from .util import reverse_readline
@@ -36,29 +37,35 @@ def get_info_from_log(output):
     # | tail -1 | awk '{print $3}'`
     return info
 
-def get_last_frame(fh):
+def get_last_frame(fh, buf_size=1 << 20):
 
-    """ Quite self-explanatory: extract coordinates from last frame produced by simulation """
-    atomlines = []
-    for l in reverse_readline(fh):
-        if 'ITEM: ATOMS' in l:
-            v = l.split()
-            ii = v.index('id') - 2
-            ix = v.index('x') - 2
-            iy = v.index('y') - 2
-            iz = v.index('z') - 2
+    """ Extract coordinates from the last frame of a (custom style) dump file.
+    The file is read backwards until the last ATOMS section is found, then the
+    frame is parsed in a single call. Atoms can be in any order. """
+
+    fh.seek(0, os.SEEK_END)
+    file_size = fh.tell()
+    offset = 0
+    while True:
+        offset = min(file_size, offset + buf_size)
+        fh.seek(file_size - offset)
+        text = fh.read()
+        start = text.rfind('ITEM: ATOMS')
+        if start != -1 or offset == file_size:
             break
-        atomlines.append(l)
+        buf_size *= 2
+
+    if start == -1:
+        raise ValueError('No ATOMS section in the dump file')
 
-    crds = np.empty((len(atomlines), 3))
-    for l in atomlines:
-        v = l.split()
-        i = int(v[ii]) - 1  # ids are in range 1-N
-        x = float(v[ix])
-        y = float(v[iy])
-        z = float(v[iz])
-        crds[i][0] = x
-        crds[i][1] = y
-        crds[i][2] = z
+    header, _, body = text[start:].partition('\n')
+    columns = header.split()[2:]
+    values = np.fromstring(body, sep=' ')
+    if values.size % len(columns) != 0:
+        raise ValueError('Incomplete frame in the dump file')
+    values = values.reshape((-1, len(columns)))
 
+    ids = values[:, columns.index('id')].astype(np.int64) - 1  # ids are in range 1-N
+    crds = np.empty((len(values), 3))
+    crds[ids] = values[:, [columns.index('x'), columns.index('y'), columns.index('z')]]
     return crds
@@ -1,5 +1,6 @@
 import numpy as np
 from ..particle import Particle
+from ..forces import Force
 
 class BondType(object):
     '''
@@ -232,114 +233,170 @@ class LammpsModel(object):
     '''
     An intermediate (possibly non-necessary)  class to organize data to generate lammps input files.
 
+    Atoms, bonds and bond types are stored as numpy arrays, so that large
+    systems can be converted and written without creating one python object
+    per atom or bond. Type ids are 0-based.
+
+    atom_xyz, atom_type, atom_mol, atom_radius : np.ndarray
+        coordinates, type id, molecule id and radius (0 for non-bead types)
+        of each atom
+    bond_i, bond_j, bond_type : np.ndarray
+        atom ids and bond type id of each bond
+    bond_style, bond_k, bond_r0 : np.ndarray
+        style id (see BondType), spring constant and distance of each bond
+        type
+    atom_types : dict
+        AtomType objects, sorted by id
+    imap : np.ndarray
+        atom id of each particle of the original model
+
     Parameters
     ----------
     model : igm.model.Model, optional
         tranfer data from a igm.Model to a LammpsModel, which is then used to generate the input files for a production run
     '''
 
+    BOND_STYLES = [HarmonicUpperBound, HarmonicLowerBound]
+
     def __init__(self, model=None, uid=0):
-        self.atoms = []
         self.atom_types = {}
-        self.bonds = []
-        self.bond_types = {}
+        self.atom_xyz = np.zeros((0, 3), dtype=np.float32)
+        self.atom_type = np.zeros(0, dtype=np.int64)
+        self.atom_mol = np.zeros(0, dtype=np.int64)
+        self.atom_radius = np.zeros(0, dtype=np.float32)
+        self.bond_i = np.zeros(0, dtype=np.int64)
+        self.bond_j = np.zeros(0, dtype=np.int64)
+        self.bond_type = np.zeros(0, dtype=np.int64)
+        self.bond_style = np.zeros(0, dtype=np.int64)
+        self.bond_k = np.zeros(0)
+        self.bond_r0 = np.zeros(0)
         self.nmol = 1
         self.id = uid
         self.envelopes = []
         if model is not None:
-            self.imap = []
             self.from_model(model)
 
+    @property
+    def n_atoms(self):
+        return len(self.atom_xyz)
+
+    @property
+    def n_bonds(self):
+        return len(self.bond_i)
+
+    @property
+    def n_bond_types(self):
+        return len(self.bond_style)
+
+    def atom_categories(self):
+
+        """ AtomType category of each atom """
+
+        categories = np.array([at.atom_category for at in self.atom_types], dtype=np.int64)
+        return categories[self.atom_type]
+
     def from_model(self, model):
         self.id = model.id
+        n = model.n_particles
+
+        ptype = model.ptypes.astype(np.int64)
+        pos = model.positions.astype(np.float32)
+        radius = model.radii.astype(np.float32)
+        mol = model.chain_ids + 1
+
+        category = np.full(n, -1, dtype=np.int64)
+        category[ptype == Particle.NORMAL] = AtomType.BEAD
+        category[ptype == Particle.DUMMY_STATIC] = AtomType.FIXED_DUMMY
+        category[ptype == Particle.DUMMY_DYNAMIC] = AtomType.CLUSTER_CENTROID
+        if np.any(category == -1):
+            raise ValueError('Unknown particle type')
+        is_bead = category == AtomType.BEAD
+        radius[~is_bead] = 0
+        mol[~is_bead] = 0
+
+        # consecutive static dummies in the same position share the same atom
+        merge = np.zeros(n, dtype=bool)
+        merge[1:] = (
+            (category[1:] == AtomType.FIXED_DUMMY) &
+            (category[:-1] == AtomType.FIXED_DUMMY) &
+            np.all(pos[1:] == pos[:-1], axis=1)
+        )
+        self.imap = np.cumsum(~merge) - 1
+        keep = ~merge
+
+        # atom types are numbered by first appearance, beads are identified
+        # by their radius
+        keys = np.column_stack([category[keep], radius[keep]])
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
 
-        # loop over particles, add appropriate beads for NORMAL, DUMMY_STATIC, DUMMY_DYNAMIC
-        centroid_type = ClusterCentroid()
-        for p in model.particles:
-  
-            # if NORMAL, add a regular DNA bead
-            if p.ptype == Particle.NORMAL:
-                att = DNABead(p.r)
-                if hasattr(p, 'chainID'):
-                    mol_id = p.chainID + 1
-                else:
-                    mol_id = 0
-                atom = self.add_atom(att, p.pos, mol_id=mol_id)
-
-            # if DUMMY particles, define properties and add them
-            elif p.ptype == Particle.DUMMY_STATIC:
-                atom = self.get_next_dummy(p.pos)
-            elif p.ptype == Particle.DUMMY_DYNAMIC:
-                atom = self.add_atom(centroid_type, p.pos)
+        self.atom_types = {}
+        for type_id, k in enumerate(order):
+            cat, r = keys[first[k]]
+            if cat == AtomType.BEAD:
+                at = DNABead(radius[keep][first[k]], type_id)
+            elif cat == AtomType.FIXED_DUMMY:
+                at = FrozenPhantomBead(type_id)
             else:
-                raise ValueError('Unknown particle type')
-            self.imap.append(atom.id)
+                at = ClusterCentroid(type_id)
+            self.atom_types[at] = at
+
+        self.atom_xyz = pos[keep]
+        self.atom_type = rank[inverse.ravel()]
+        self.atom_mol = mol[keep]
+        self.atom_radius = radius[keep]
+        self.nmol = max(1, int(self.atom_mol.max())) if n else 1
 
         # loop over the different physical forces involved in the model
-        for f in model.forces:
+        for f in model.getCollectiveForces():
             if (f.ftype == f.ENVELOPE) or (f.ftype == f.GENERAL_ENVELOPE):
                 self.envelopes.append(f)     # see Guido's email: la classe del model viene aggiunta alle envelopes del Lammpsmodel
             elif f.ftype == f.EXCLUDED_VOLUME:
                 self.evfactor = f.k
 
-            else:
-                pi, pj = self.atoms[self.imap[f.i]], self.atoms[self.imap[f.j]]
-
-                # dummies creation depend on the number of bonds, so we may need to
-                # create new atoms if we add bonds
-                if pi.atom_type == Atom.FIXED_DUMMY:
-                    pi = self.get_next_dummy()
-                if pj.atom_type == Atom.FIXED_DUMMY:
-                    pj = self.get_next_dummy()
-
-
-                if f.ftype == f.HARMONIC_UPPER_BOUND:
-                    bond_type = HarmonicUpperBound(r0=f.d, k=f.k)
-                    self.add_bond(pi.id, pj.id, bond_type)
-                elif f.ftype == f.HARMONIC_LOWER_BOUND:
-                    bond_type = HarmonicLowerBound(r0=f.d, k=f.k)
-                    self.add_bond(pi.id, pj.id, bond_type)
-
-    def get_next_dummy(self, pos=np.array([0., 0., 0.])):
-        if (self.atoms[-1].atom_type == Atom.FIXED_DUMMY and
-            self.atoms[-1].nbonds < FrozenPhantomBead.MAX_BONDS and
-            np.all(self.atoms[-1].xyz == pos)):
-                dummy = self.atoms[-1]
-        else:
-            atype = FrozenPhantomBead()
-            dummy = self.add_atom(atype, xyz=pos)
-
-        return dummy
-
-    def add_bond(self, i, j, bond_type, restraint_type=Bond.OTHER):
-        if not isinstance(i, Atom):
-            i = self.atoms[i]
-        if not isinstance(j, Atom):
-            j = self.atoms[j]
-        btype = self.bond_types.get(bond_type, None)
-        if btype is None:
-            bond_type.id = len(self.bond_types)
-            btype = self.bond_types[bond_type] = bond_type
-
-        bond_id = len(self.bonds)
-        bond = Bond(bond_id, btype, i, j, restraint_type)
-        self.bonds.append(bond)
-        i.nbonds += 1
-        j.nbonds += 1
-        return bond
-
-    def add_atom(self, atom_type,
-                 xyz=np.array([0., 0., 0.]),
-                 mol_id=0 # molecules are not used anyway
-                 ):
-
-        atom_id = len(self.atoms)
-        atype = self.atom_types.get(atom_type, None)
-        if atype is None:
-            atom_type.id = len(self.atom_types)
-            atype = self.atom_types[atom_type] = atom_type
-        atom = Atom(atom_id, atype, mol_id, xyz)
-        self.atoms.append(atom)
-        self.nmol = max(mol_id, self.nmol)
-        return atom
-
+        ftype, ii, jj, dd, kk = model.getBonds()
+        if len(ftype) == 0:
+            return
+        styles = np.where(ftype == Force.HARMONIC_UPPER_BOUND,
+                          BondType.HARMONIC_UPPER_BOUND, BondType.HARMONIC_LOWER_BOUND)
+
+        ends = self.imap[np.column_stack([ii, jj]).ravel()]
+        self._assign_dummies(ends)
+        self.bond_i, self.bond_j = ends[0::2], ends[1::2]
+
+        keys = np.column_stack([styles, kk, dd]).astype(np.float64)
+        _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        self.bond_type = rank[inverse.ravel()]
+        self.bond_style = keys[first[order], 0].astype(np.int64)
+        self.bond_k = keys[first[order], 1]
+        self.bond_r0 = keys[first[order], 2]
+
+    def _assign_dummies(self, ends):
+        '''
+        Bonds to frozen dummies are spread over dummy atoms in the origin, with
+        at most FrozenPhantomBead.MAX_BONDS bonds each. The last atom is
+        reused if it is such a dummy, then new ones are created as needed.
+        Modifies `ends` in place.
+        '''
+        slots = np.flatnonzero(self.atom_categories()[ends] == AtomType.FIXED_DUMMY)
+        if len(slots) == 0:
+            return
+        n_atoms = self.n_atoms
+        reuse = (self.atom_categories()[-1] == AtomType.FIXED_DUMMY and
+                 np.all(self.atom_xyz[-1] == 0))
+        first_id = n_atoms - 1 if reuse else n_atoms
+        dummy_ids = first_id + np.arange(len(slots)) // FrozenPhantomBead.MAX_BONDS
+        ends[slots] = dummy_ids
+
+        n_new = dummy_ids[-1] + 1 - n_atoms
+        if n_new > 0:
+            dummy_type = [at.id for at in self.atom_types if at.atom_category == AtomType.FIXED_DUMMY][0]
+            self.atom_xyz = np.concatenate([self.atom_xyz, np.zeros((n_new, 3), dtype=self.atom_xyz.dtype)])
+            self.atom_type = np.concatenate([self.atom_type, np.full(n_new, dummy_type, dtype=np.int64)])
+            self.atom_mol = np.concatenate([self.atom_mol, np.zeros(n_new, dtype=np.int64)])
+            self.atom_radius = np.concatenate([self.atom_radius, np.zeros(n_new, dtype=self.atom_radius.dtype)])
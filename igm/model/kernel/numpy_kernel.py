@@ -0,0 +1,534 @@
+"""
+The **numpy_kernel** module provides an in-process alternative to the
+LAMMPS kernel, selected with `optimization/kernel = numpy`.
+
+The force set of a `igm.Model` is converted to arrays, and evaluated
+vectorized:
+
+- HarmonicUpperBound/HarmonicLowerBound bonds, E = k (r - r0)^2 when violated
+- excluded volume, as the LAMMPS `soft` pair style,
+  E = A (1 + cos(pi r / rc)) with rc = ri + rj, A = evfactor (rc / pi)^2,
+  using a Verlet neighbor list built with a cell list
+- EllipticEnvelope, E = k/2 t^2 with t the radial distance from the
+  ellipsoid (semiaxes reduced by the particle radius), outside for k > 0
+  and inside for k < 0
+- ExpEnvelope, harmonic on the radial distance from the effective radius of
+  the volumetric map, for the particles in the excluded voxels
+- NuclExcludedVolume, E = k t^2 with t = ri + R - d the overlap of the
+  particle with the spherical nuclear body (center c, radius R, d = |x - c|)
+
+The protocol is the same as in the LAMMPS script: simulated annealing
+(velocity Verlet with velocity limit and temperature rescaling, optionally
+following `custom_annealing_protocol`), followed by a minimization with
+L-BFGS (default) or FIRE. No file is written, and the returned `info`
+dictionary has the same keys as `lammps_io.get_info_from_log`.
+
+Small and medium systems only: all the neighbor pairs are kept in memory.
+"""
+
+from __future__ import division, print_function
+
+import time
+import numpy as np
+
+from ..particle import Particle
+from ..forces import Force
+from ...utils import input_cache
+
+# cell list offsets: the cell itself and half of the 26 neighbors
+HALF_OFFSETS = [
+    (dx, dy, dz)
+    for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+    if (dx, dy, dz) > (0, 0, 0)
+]
+
+FIRE_PARAMS = {
+    'n_min': 5,
+    'f_inc': 1.1,
+    'f_dec': 0.5,
+    'alpha_start': 0.1,
+    'f_alpha': 0.99,
+    'dt_max_factor': 10.0,
+}
+
+
+def cell_list_pairs(crd, cutoff):
+    '''
+    All the pairs (i < j) of points closer than `cutoff`, using a cell list
+    of cutoff-sized cells.
+
+    Parameters
+    ----------
+    crd : np.ndarray
+        (N, 3) coordinates
+    cutoff : float
+
+    Returns
+    -------
+    i, j : np.ndarray
+        indexes of the points in each pair
+    '''
+    n = len(crd)
+    if n < 2 or cutoff <= 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+    cells = np.floor((crd - crd.min(axis=0)) / cutoff).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    cid = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+    order = np.argsort(cid, kind='stable')
+    cells = cells[order]
+    ucells, start, count = np.unique(cid[order], return_index=True, return_counts=True)
+    pos = np.arange(n)
+    block = np.searchsorted(ucells, cid[order])
+
+    pi, pj = [], []
+
+    # pairs in the same cell
+    n_after = start[block] + count[block] - 1 - pos
+    pi.append(np.repeat(pos, n_after))
+    pj.append(pi[-1] + _ranges(n_after) + 1)
+
+    # pairs in neighboring cells
+    for off in HALF_OFFSETS:
+        nc = cells + off
+        valid = np.all((nc >= 0) & (nc < dims), axis=1)
+        ncid = (nc[:, 0] * dims[1] + nc[:, 1]) * dims[2] + nc[:, 2]
+        b = np.minimum(np.searchsorted(ucells, ncid), len(ucells) - 1)
+        valid &= ucells[b] == ncid
+        cnt = np.where(valid, count[b], 0)
+        pi.append(np.repeat(pos, cnt))
+        pj.append(np.repeat(start[b], cnt) + _ranges(cnt))
+
+    pi = order[np.concatenate(pi)]
+    pj = order[np.concatenate(pj)]
+    keep = np.sum(np.square(crd[pi] - crd[pj]), axis=1) < cutoff * cutoff
+    pi, pj = pi[keep], pj[keep]
+    swap = pi > pj
+    pi[swap], pj[swap] = pj[swap], pi[swap]
+    return pi, pj
+
+
+def _ranges(counts):
+
+    """ concatenation of arange(c) for c in counts """
+
+    total = counts.sum()
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def read_volume_map(volume_file):
+    '''
+    Reads a volumetric map file, as used by ExpEnvelope (and by the LAMMPS
+    volumetricrestraint fix).
+
+    Returns
+    -------
+    body_idx : int
+        0 for a nuclear map, 1 for a nuclear body
+    nvoxel, center, origin, grid : np.ndarray
+        map geometry
+    occupancy : np.ndarray
+        (nx, ny, nz) voxel values
+    '''
+    with open(volume_file) as f:
+        body_idx = int(next(f).split()[0])
+        nvoxel = np.array([int(x) for x in next(f).split()])
+        center = np.array([float(x) for x in next(f).split()])
+        origin = np.array([float(x) for x in next(f).split()])
+        grid = np.array([float(x) for x in next(f).split()])
+        voxels = np.loadtxt(f, dtype=np.int64, ndmin=2)
+
+    if len(voxels) != np.prod(nvoxel):
+        raise ValueError('Inconsistent number of voxels in %s' % volume_file)
+
+    occupancy = np.zeros(nvoxel, dtype=np.int8)
+    occupancy[voxels[:, 0], voxels[:, 1], voxels[:, 2]] = voxels[:, 3]
+    return body_idx, nvoxel, center, origin, grid, occupancy
+
+
+def load_volume_map(volume_file):
+    '''
+    `read_volume_map`, cached in the worker process (the returned arrays
+    are shared and must not be modified)
+    '''
+    return input_cache.cached(volume_file, read_volume_map, 'volume_map')
+
+
+class ArrayModel(object):
+    '''
+    Array representation of a `igm.Model` for the numpy kernel.
+
+    Parameters
+    ----------
+    model : igm.model.Model
+    '''
+
+    def __init__(self, model):
+        self.crd = model.positions.astype(np.float64)
+        self.radii = model.radii.astype(np.float64)
+        ptype = model.ptypes
+
+        # static dummies are frozen, dummies do not have excluded volume
+        self.mobile = ptype != Particle.DUMMY_STATIC
+        self.beads = np.flatnonzero(ptype == Particle.NORMAL)
+        self.maxrad = self.radii[self.beads].max() if len(self.beads) else 0.0
+        self.evfactor = 0.0
+
+        ftype, bi, bj, br0, bk = model.getBonds()
+        self.bond_i = bi.copy()
+        self.bond_j = bj.copy()
+        self.bond_k = bk.astype(np.float64)
+        self.bond_r0 = br0.astype(np.float64)
+        self.bond_upper = ftype == Force.HARMONIC_UPPER_BOUND
+
+        self.ellipsoids = []
+        self.volume_maps = []
+        self.bodies = []
+        for f in model.getCollectiveForces():
+            if f.ftype == f.EXCLUDED_VOLUME:
+                self.evfactor = f.k
+            elif f.ftype == f.ENVELOPE:
+                if len(f.particle_ids):
+                    self.ellipsoids.append((np.array(f.particle_ids, dtype=np.int64),
+                                            np.array(f.semiaxes, dtype=np.float64), float(f.k)))
+            elif f.ftype == f.GENERAL_ENVELOPE:
+                if len(f.particle_ids):
+                    self.volume_maps.append(
+                        (np.array(f.particle_ids, dtype=np.int64), load_volume_map(f.volume_file), float(f.k))
+                    )
+            elif f.ftype == f.NUCL_EXCLUDED_VOLUME:
+                if len(f.particles):
+                    self.bodies.append((np.array(f.particles, dtype=np.int64),
+                                        np.asarray(f.body_pos, dtype=np.float64).reshape(3),
+                                        float(f.body_r), float(f.k)))
+            else:
+                raise NotImplementedError('Force %s is not supported by the numpy kernel' % f)
+
+        self.pairs = None
+        self.pairs_crd = None
+
+    # ---- neighbor list
+
+    def update_neighbors(self, crd, skin):
+        '''
+        Rebuild the excluded volume pairs list when any bead moved by more
+        than half the skin since the last build
+        '''
+        x = crd[self.beads]
+        if self.pairs is not None:
+            dmax = np.max(np.sum(np.square(x - self.pairs_crd), axis=1)) if len(x) else 0
+            if dmax <= (0.5 * skin) ** 2:
+                return
+        pi, pj = cell_list_pairs(x, 2.0 * self.maxrad + skin)
+        self.pairs = (self.beads[pi], self.beads[pj])
+        self.pairs_crd = x.copy()
+
+    # ---- energy terms, each returns the energy and adds the gradient to grad
+
+    def pair_energy(self, crd, grad, evscale=1.0):
+        if self.evfactor == 0 or self.pairs is None or len(self.pairs[0]) == 0:
+            return 0.0
+        pi, pj = self.pairs
+        dx = crd[pi] - crd[pj]
+        r = np.sqrt(np.sum(dx * dx, axis=1))
+        rc = self.radii[pi] + self.radii[pj]
+        on = (r < rc) & (rc > 0)
+        if not np.any(on):
+            return 0.0
+        pi, pj, dx, r, rc = pi[on], pj[on], dx[on], r[on], rc[on]
+        A = self.evfactor * evscale * np.square(rc / np.pi)
+        e = A * (1.0 + np.cos(np.pi * r / rc))
+        dedr = -A * np.pi / rc * np.sin(np.pi * r / rc)
+        g = (dedr / np.maximum(r, 1e-12))[:, None] * dx
+        np.add.at(grad, pi, g)
+        np.add.at(grad, pj, -g)
+        return e.sum()
+
+    def bond_energy(self, crd, grad):
+        if len(self.bond_i) == 0:
+            return 0.0
+        dx = crd[self.bond_i] - crd[self.bond_j]
+        r = np.sqrt(np.sum(dx * dx, axis=1))
+        dr = r - self.bond_r0
+        on = np.where(self.bond_upper, dr > 0, dr < 0)
+        dr = np.where(on, dr, 0.0)
+        e = self.bond_k * dr * dr
+        g = (2.0 * self.bond_k * dr / np.maximum(r, 1e-12))[:, None] * dx
+        np.add.at(grad, self.bond_i, g)
+        np.add.at(grad, self.bond_j, -g)
+        return e.sum()
+
+    def ellipsoid_energy(self, idx, semiaxes, k, crd, grad, scale=1.0):
+        x = crd[idx]
+        s2 = np.square(semiaxes * scale - self.radii[idx][:, None])
+        s = np.sqrt(np.sum(x * x / s2, axis=1))
+        n = np.sqrt(np.sum(x * x, axis=1))
+        on = (s > 1) if k > 0 else (s < 1)
+        on &= (s > 0) & (n > 0)
+        if not np.any(on):
+            return 0.0
+        x, s2, s, n, ii = x[on], s2[on], s[on], n[on], idx[on]
+        t = (1.0 - 1.0 / s) * n
+        # dt/dx = (1 - 1/s) x/n + n/s^2 ds/dx, ds/dx = x / (s2 s)
+        dt = ((1.0 - 1.0 / s) / n)[:, None] * x + (n / s**3)[:, None] * x / s2
+        np.add.at(grad, ii, (abs(k) * t)[:, None] * dt)
+        return 0.5 * abs(k) * np.sum(t * t)
+
+    def volume_map_energy(self, idx, vmap, k, crd, grad):
+        body_idx, nvoxel, center, origin, grid, occupancy = vmap
+        x = crd[idx]
+        v = np.floor((x - origin) / grid).astype(np.int64)
+        inside_box = np.all((v >= 0) & (v < nvoxel), axis=1)
+        occupied = np.zeros(len(x), dtype=bool)
+        vi = v[inside_box]
+        occupied[inside_box] = occupancy[vi[:, 0], vi[:, 1], vi[:, 2]] == 1
+        dx = x - center
+        d = np.sqrt(np.sum(dx * dx, axis=1))
+        if body_idx == 0:
+            # nucleus: particles in excluded voxels or outside of the map are pulled to the effective radius
+            R = np.abs(np.prod(origin)) ** (1. / 3)
+            on = ~inside_box | occupied
+        else:
+            # nuclear body: particles in the body are pushed out of its effective radius
+            vox = np.argwhere(occupancy == 1)
+            R = np.max(np.linalg.norm((vox + 0.5) * grid + origin - center, axis=1)) if len(vox) else 0.0
+            on = inside_box & occupied
+        on &= d > 0
+        if not np.any(on):
+            return 0.0
+        t = d[on] - R
+        np.add.at(grad, idx[on], (k * t / d[on])[:, None] * dx[on])
+        return 0.5 * k * np.sum(t * t)
+
+    def body_energy(self, idx, center, body_r, k, crd, grad):
+        dx = crd[idx] - center
+        d = np.sqrt(np.sum(dx * dx, axis=1))
+        t = self.radii[idx] + body_r - d
+        on = (t > 0) & (d > 0)
+        if not np.any(on):
+            return 0.0
+        t, d = t[on], d[on]
+        np.add.at(grad, idx[on], (-2.0 * k * t / d)[:, None] * dx[on])
+        return k * np.sum(t * t)
+
+    def energy(self, crd, evscale=1.0, envscale=1.0, terms=None):
+        '''
+        Total energy and gradient. If `terms` is a dict, it is filled with the
+        pair, bond and envelope energies.
+        '''
+        grad = np.zeros_like(crd)
+        ep = self.pair_energy(crd, grad, evscale)
+        eb = self.bond_energy(crd, grad)
+        eenv = [self.ellipsoid_energy(idx, ax, k, crd, grad, envscale) for idx, ax, k in self.ellipsoids]
+        eenv += [self.volume_map_energy(idx, vm, k, crd, grad) for idx, vm, k in self.volume_maps]
+        eenv += [self.body_energy(idx, c, r, k, crd, grad) for idx, c, r, k in self.bodies]
+        grad[~self.mobile] = 0
+        if terms is not None:
+            terms['E_pair'] = ep
+            terms['E_bond'] = eb
+            for j, e in enumerate(eenv):
+                terms['f_envelope%d' % j] = e
+        return ep + eb + sum(eenv), grad
+
+
+def temperature(v, mobile):
+    n = np.count_nonzero(mobile)
+    dof = max(3 * n - 3, 1)
+    return np.sum(np.square(v[mobile])) / dof
+
+
+def create_velocities(n, mobile, t, rng):
+
+    """ random velocities with zero momentum at temperature t (unit masses) """
+
+    v = np.zeros((n, 3))
+    v[mobile] = rng.uniform(-0.5, 0.5, (np.count_nonzero(mobile), 3))
+    if np.any(mobile):
+        v[mobile] -= v[mobile].mean(axis=0)
+    t_now = temperature(v, mobile)
+    if t_now > 0:
+        v *= np.sqrt(t / t_now)
+    return v
+
+
+def run_md(m, crd, v, nsteps, dt, t0, t1, max_displacement, skin, evscale=1.0, envscale=1.0):
+    '''
+    Velocity Verlet with limited displacement per step (as the LAMMPS
+    nve/limit fix) and temperature rescaling from t0 to t1 (as temp/rescale
+    with a 0.1 window, applied every step). Updates crd and v in place.
+    '''
+    vmax = max_displacement / dt
+    m.update_neighbors(crd, skin)
+    _, grad = m.energy(crd, evscale, envscale)
+    for step in range(nsteps):
+        v -= 0.5 * dt * grad
+        _limit(v, vmax)
+        crd[m.mobile] += dt * v[m.mobile]
+        m.update_neighbors(crd, skin)
+        _, grad = m.energy(crd, evscale, envscale)
+        v -= 0.5 * dt * grad
+        _limit(v, vmax)
+        v[~m.mobile] = 0
+
+        target = t0 + (t1 - t0) * (step + 1) / nsteps
+        t_now = temperature(v, m.mobile)
+        if t_now > 0 and abs(t_now - target) > 0.1:
+            v *= np.sqrt(target / t_now)
+
+
+def _limit(v, vmax):
+    speed = np.sqrt(np.sum(v * v, axis=1))
+    fast = speed > vmax
+    if np.any(fast):
+        v[fast] *= (vmax / speed[fast])[:, None]
+
+
+def minimize_lbfgs(m, crd, etol, ftol, maxiter, maxeval, skin, evscale=1.0, envscale=1.0):
+    from scipy.optimize import minimize
+
+    mobile = m.mobile
+    x0 = crd[mobile].ravel()
+
+    def fun(x):
+        crd[mobile] = x.reshape(-1, 3)
+        m.update_neighbors(crd, skin)
+        e, grad = m.energy(crd, evscale, envscale)
+        return e, grad[mobile].ravel()
+
+    res = minimize(fun, x0, jac=True, method='L-BFGS-B',
+                   options={'maxiter': maxiter, 'maxfun': maxeval, 'ftol': etol, 'gtol': ftol})
+    crd[mobile] = res.x.reshape(-1, 3)
+
+
+def minimize_fire(m, crd, etol, ftol, maxiter, dt, skin, evscale=1.0, envscale=1.0):
+    p = FIRE_PARAMS
+    v = np.zeros_like(crd)
+    alpha = p['alpha_start']
+    dt_max = p['dt_max_factor'] * dt
+    n_pos = 0
+    m.update_neighbors(crd, skin)
+    e_old, grad = m.energy(crd, evscale, envscale)
+    for it in range(maxiter):
+        f = -grad
+        if np.sqrt(np.sum(f * f)) < ftol:
+            break
+        power = np.sum(f * v)
+        if power > 0:
+            fnorm = np.sqrt(np.sum(f * f))
+            vnorm = np.sqrt(np.sum(v * v))
+            v = (1 - alpha) * v + alpha * vnorm * f / fnorm
+            n_pos += 1
+            if n_pos > p['n_min']:
+                dt = min(dt * p['f_inc'], dt_max)
+                alpha *= p['f_alpha']
+        else:
+            v[:] = 0
+            dt *= p['f_dec']
+            alpha = p['alpha_start']
+            n_pos = 0
+        v += dt * f
+        v[~m.mobile] = 0
+        crd += dt * v
+        m.update_neighbors(crd, skin)
+        e, grad = m.energy(crd, evscale, envscale)
+        if power > 0 and abs(e - e_old) < etol * 0.5 * (abs(e) + abs(e_old) + 1e-8):
+            break
+        e_old = e
+
+
+def optimize(model, cfg):
+    '''
+    In-process minimization of a `igm.Model`, following the same protocol
+    as the LAMMPS kernel.
+
+    Parameters
+    ----------
+    model : `igm.Model`
+        Abstracted model object for simulation optimization. Particle
+        coordinates are updated in place.
+    cfg : dict
+        A dict of configurations.
+
+    Returns
+    -------
+    info : dict
+        Dictionary with summarized info for the run, with the same keys
+        returned by `lammps_io.get_info_from_log`.
+    '''
+    run_opts = cfg['optimization']['optimizer_options']
+    kernel_opts = cfg['optimization'].get('kernel_opts', {}).get('numpy', {})
+
+    # same seed as the lammps kernel
+    seed = kernel_opts.get('seed', None)
+    if not isinstance(seed, int):
+        seed = np.random.randint(1, 9007991)
+    step_no = cfg.get('runtime/step_no', 1) + 2
+    seed = ((seed * model.id * step_no) % 9190037) + 1
+
+    m = ArrayModel(model)
+    crd = m.crd
+    skin = m.maxrad
+    dt = run_opts['timestep']
+
+    protocol = run_opts.get('custom_annealing_protocol', None)
+    if protocol is None:
+        protocol = {
+            'num_steps': 1,
+            'mdsteps': [run_opts['mdsteps']],
+            'tstarts': [run_opts['tstart']],
+            'tstops': [run_opts['tstop']],
+            'evfactors': [1],
+            'envelope_factors': [1]
+        }
+
+    nsteps     = protocol.get('num_steps')
+    mdsteps    = protocol.get('mdsteps', [run_opts['mdsteps']] * nsteps)
+    tstarts    = protocol.get('tstarts', [run_opts['tstart']] * nsteps)
+    tstops     = protocol.get('tstops', tstarts)
+    evfs       = protocol.get('evfactors', [1] * nsteps)
+    envelopesf = protocol.get('envelope_factors', [1] * nsteps)
+    relax      = protocol.get('relax', None)
+
+    assert(len(mdsteps) == len(tstarts) == len(tstops)
+           == len(evfs) == len(envelopesf) == nsteps)
+
+    md_start = time.time()
+    v = np.zeros_like(crd)
+    for step, (md, t0, t1, evf, envf) in enumerate(zip(mdsteps, tstarts, tstops, evfs, envelopesf)):
+        rng = np.random.RandomState(seed + step)
+        if relax is not None:
+            v = create_velocities(len(crd), m.mobile, relax['temperature'], rng)
+            run_md(m, crd, v, relax['mdsteps'], dt, relax['temperature'], relax['temperature'],
+                   relax['max_velocity'], skin, evf, envf)
+        v = create_velocities(len(crd), m.mobile, t0, rng)
+        run_md(m, crd, v, md, dt, t0, t1, run_opts['max_velocity'], skin, evf, envf)
+    md_time = time.time() - md_start
+
+    # as in lammps, the excluded volume scaling is reset after the annealing,
+    # while the last envelope scaling is kept
+    if kernel_opts.get('minimizer', 'lbfgs') == 'fire':
+        minimize_fire(m, crd, run_opts['etol'], run_opts['ftol'], run_opts['max_cg_iter'], dt, skin,
+                      1.0, envelopesf[-1])
+    else:
+        minimize_lbfgs(m, crd, run_opts['etol'], run_opts['ftol'], run_opts['max_cg_iter'],
+                       run_opts['max_cg_eval'], skin, 1.0, envelopesf[-1])
+
+    terms = {}
+    m.update_neighbors(crd, skin)
+    final_energy, _ = m.energy(crd, 1.0, envelopesf[-1], terms)
+
+    # updates the input model coordinates
+    model.positions[:] = crd
+
+    thermo = {'Temp': temperature(v, m.mobile)}
+    thermo.update(terms)
+    return {
+        'final-energy': final_energy,
+        'pair-energy': terms['E_pair'],
+        'bond-energy': terms['E_bond'],
+        'md-time': md_time,
+        'thermo': thermo,
+    }
@@ -1,11 +1,80 @@
 from __future__ import division, absolute_import, print_function
 import numpy as np
-from .particle import Particle
+from .particle import Particle, ParticleView, POSDTYPE
+from .forces import Force, HarmonicUpperBound, HarmonicLowerBound
 try:
     from itertools import izip as zip
 except ImportError: 
     pass
 
+# forces stored in the model bond table
+BOND_FTYPES = (Force.HARMONIC_UPPER_BOUND, Force.HARMONIC_LOWER_BOUND)
+
+
+def _reserve(arr, n):
+
+    """ Returns arr, or a larger copy of it, with room for at least n rows """
+
+    if len(arr) >= n:
+        return arr
+    new = np.zeros((max(n, 2 * len(arr), 16),) + arr.shape[1:], dtype=arr.dtype)
+    new[:len(arr)] = arr
+    return new
+
+
+class ParticleList(object):
+    """
+    Sequence view of the particles of a Model. Items are `ParticleView`
+    objects, reading and writing the model arrays.
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def __len__(self):
+        return self._model.n_particles
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('particle index out of range')
+        return ParticleView(self._model, i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ParticleView(self._model, i)
+
+
+class ForceList(object):
+    """
+    Sequence view of the forces of a Model (see `Model.getForce`)
+    """
+
+    def __init__(self, model):
+        self._model = model
+
+    def __len__(self):
+        return self._model.n_forces
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('force index out of range')
+        return self._model.getForce(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._model.getForce(i)
+
+
 class Model(object):
     """
     
@@ -15,12 +84,39 @@ class Model(object):
     
     The Model holds all information about the target system by particles and
     harmonic forces.
+
+    Particles are stored in contiguous arrays (`positions`, `radii`,
+    `ptypes`, `chain_ids`). Harmonic bounds, which are most of the forces,
+    are stored in a bond table (see `getBonds`), other forces as objects.
+    `particles` and `forces` are views providing the object interface.
     
     """
     def __init__(self, uid=0):
-        self.particles = []
-        self.forces = []
         self.id = uid
+
+        self.n_particles = 0
+        self._pos = np.zeros((0, 3), dtype=POSDTYPE)
+        self._radius = np.zeros(0, dtype=POSDTYPE)
+        self._ptype = np.zeros(0, dtype=np.int8)
+        self._chain = np.zeros(0, dtype=np.int64)
+        self._particle_attrs = {}
+
+        # force id -> type, and row in the bond table or index in _force_objects
+        self.n_forces = 0
+        self._force_ftype = np.zeros(0, dtype=np.int8)
+        self._force_row = np.zeros(0, dtype=np.int64)
+        self._force_objects = []
+
+        self.n_bonds = 0
+        self._bond_ftype = np.zeros(0, dtype=np.int8)
+        self._bond_i = np.zeros(0, dtype=np.int64)
+        self._bond_j = np.zeros(0, dtype=np.int64)
+        self._bond_d = np.zeros(0, dtype=np.float64)
+        self._bond_k = np.zeros(0, dtype=np.float64)
+        self._bond_note = np.zeros(0, dtype=object)
+
+        self.particles = ParticleList(self)
+        self.forces = ForceList(self)
     
     
     #====Particle methods
@@ -28,11 +124,41 @@ class Model(object):
         """
         Add particle to system
         """
-        
-        self.particles.append(Particle(pos, r, t, **kwargs))
-        
-        return len(self.particles)-1
-        
+        chain_id = kwargs.pop('chainID', None)
+        i = int(self.addParticles([pos], [r], t, None if chain_id is None else [chain_id])[0])
+        if kwargs:
+            self._particle_attrs[i] = kwargs
+        return i
+
+    def addParticles(self, crd, rad, t=Particle.NORMAL, chain_ids=None):
+        """
+        Add particles to system, returns their indexes
+
+        Parameters
+        ----------
+        crd : 2D numpy array (float), N*3
+            coordinates
+        rad : numpy array (float), N
+            radii
+        t : int or numpy array (int), N
+            particle types (see Particle.PTYPES)
+        chain_ids : numpy array (int), N, optional
+            chain ids, stored as the particles `chainID`
+        """
+        crd = np.asarray(crd, dtype=POSDTYPE).reshape((-1, 3))
+        n = len(crd)
+        start, end = self.n_particles, self.n_particles + n
+        self._pos = _reserve(self._pos, end)
+        self._radius = _reserve(self._radius, end)
+        self._ptype = _reserve(self._ptype, end)
+        self._chain = _reserve(self._chain, end)
+
+        self._pos[start:end] = crd
+        self._radius[start:end] = np.asarray(rad, dtype=POSDTYPE).ravel()
+        self._ptype[start:end] = t
+        self._chain[start:end] = -1 if chain_ids is None else chain_ids
+        self.n_particles = end
+        return np.arange(start, end)
     
     def getParticle(self,i):
         """
@@ -45,7 +171,7 @@ class Model(object):
         set particle coordinates
         """
         
-        self.particles[i].setCoordinates(pos)
+        self._pos[i] = pos
     #====
     
     
@@ -63,43 +189,133 @@ class Model(object):
         """
         assert crd.shape[0] == rad.shape[0]
         
-        for pos, r in zip(crd, rad):
-            self.addParticle(pos, r, Particle.NORMAL)
+        self.addParticles(crd, rad, Particle.NORMAL)
     #====
     
     
     #====bulk get methods
+    @property
+    def positions(self):
+        """
+        (N, 3) array of the coordinates of all particles (a view, can be modified)
+        """
+        return self._pos[:self.n_particles]
+
+    @property
+    def radii(self):
+        """
+        Radii of all particles
+        """
+        return self._radius[:self.n_particles]
+
+    @property
+    def ptypes(self):
+        """
+        Types of all particles
+        """
+        return self._ptype[:self.n_particles]
+
+    @property
+    def chain_ids(self):
+        """
+        Chain ids of all particles, -1 if not set
+        """
+        return self._chain[:self.n_particles]
+
     def getCoordinates(self):
         """
         Get all particles' Coordinates in numpy array form
         """
-        return np.array([p.pos for p in self.particles if p.ptype == Particle.NORMAL])
+        return self.positions[self.ptypes == Particle.NORMAL]
     
     
     def getRadii(self):
         """
         Get all particles' radii in numpy array vector form
         """
-        return np.array([[p.r for p in self.particles if p.ptype == Particle.NORMAL]]).T
+        return self.radii[self.ptypes == Particle.NORMAL][:, None]
     #====
     
     
     #====force methods
+    def _append_forces(self, ftype, rows):
+        n = len(rows)
+        start, end = self.n_forces, self.n_forces + n
+        self._force_ftype = _reserve(self._force_ftype, end)
+        self._force_row = _reserve(self._force_row, end)
+        self._force_ftype[start:end] = ftype
+        self._force_row[start:end] = rows
+        self.n_forces = end
+        return np.arange(start, end)
+
     def addForce(self, f):
         """
         Add a basic force
         """
         
-        self.forces.append(f)
-        
-        return len(self.forces)-1
+        if f.ftype in BOND_FTYPES:
+            return int(self.addBonds(f.ftype, [f.i], [f.j], [f.d], f.k, f.note)[0])
+
+        self._force_objects.append(f)
+        return int(self._append_forces(f.ftype, [len(self._force_objects) - 1])[0])
+
+    def addBonds(self, ftype, i, j, d, k=1.0, note=""):
+        """
+        Add harmonic bounds (Force.HARMONIC_UPPER_BOUND or
+        Force.HARMONIC_LOWER_BOUND) between particles i[q] and j[q] with
+        distance d[q]. k and note can be scalars or arrays. Returns the
+        force ids.
+        """
+        if ftype not in BOND_FTYPES:
+            raise ValueError('Not a bond force type: %s' % ftype)
+        i = np.asarray(i, dtype=np.int64).ravel()
+        n = len(i)
+        start, end = self.n_bonds, self.n_bonds + n
+        for name in ['_bond_ftype', '_bond_i', '_bond_j', '_bond_d', '_bond_k', '_bond_note']:
+            setattr(self, name, _reserve(getattr(self, name), end))
+
+        self._bond_ftype[start:end] = ftype
+        self._bond_i[start:end] = i
+        self._bond_j[start:end] = np.asarray(j, dtype=np.int64).ravel()
+        self._bond_d[start:end] = np.asarray(d, dtype=np.float64).ravel()
+        self._bond_k[start:end] = k
+        self._bond_note[start:end] = note
+        self.n_bonds = end
+        return self._append_forces(ftype, np.arange(start, end))
+
+    def getBonds(self):
+        """
+        Harmonic bounds as arrays (ftype, i, j, d, k), sorted by force id
+        """
+        n = self.n_bonds
+        return (self._bond_ftype[:n], self._bond_i[:n], self._bond_j[:n],
+                self._bond_d[:n], self._bond_k[:n])
+
+    def getBondRows(self, fids):
+        """
+        Rows in the `getBonds` arrays of bond forces fids
+        """
+        return self._force_row[np.asarray(fids, dtype=np.int64)]
+
+    def getCollectiveForces(self):
+        """
+        Forces which are not harmonic bounds (excluded volume, envelopes...)
+        """
+        return list(self._force_objects)
     
     def getForce(self, i):
         """
         get a force
         """
         
-        return self.forces[i]
+        ftype = self._force_ftype[i]
+        row = self._force_row[i]
+        if ftype in BOND_FTYPES:
+            cls = HarmonicUpperBound if ftype == Force.HARMONIC_UPPER_BOUND else HarmonicLowerBound
+            return cls((int(self._bond_i[row]), int(self._bond_j[row])),
+                       float(self._bond_d[row]), float(self._bond_k[row]),
+                       note=self._bond_note[row])
+        return self._force_objects[row]
     
     def evalForceScore(self, i):
         """
@@ -114,6 +330,72 @@ class Model(object):
         """
         
         return self.forces[i].getViolationRatio(self.particles)
+
+    def _split_forces(self, fids):
+        """
+        Split force ids in rows of the bond table and collective force objects
+        """
+        fids = np.asarray(fids, dtype=np.int64).ravel()
+        is_bond = np.isin(self._force_ftype[fids], BOND_FTYPES)
+        rows = self._force_row[fids[is_bond]]
+        others = [self._force_objects[r] for r in self._force_row[fids[~is_bond]]]
+        return is_bond, rows, others
+
+    def _bond_scores(self, rows):
+        ftype = self._bond_ftype[rows]
+        d = self._bond_d[rows]
+        k = self._bond_k[rows]
+        dx = self._pos[self._bond_i[rows]] - self._pos[self._bond_j[rows]]
+        dist = np.sqrt(np.sum(np.square(dx), axis=1))
+        upper = ftype == Force.HARMONIC_UPPER_BOUND
+        scores = np.where(upper,
+                          HarmonicUpperBound.getBondScores(dist, d, k),
+                          HarmonicLowerBound.getBondScores(dist, d, k))
+        return scores, d, k
+
+    def evalForceScores(self, fids):
+        """
+        Scores of a set of forces (one per force), harmonic bounds are
+        evaluated all at once
+        """
+        is_bond, rows, others = self._split_forces(fids)
+        scores = np.zeros(len(is_bond))
+        scores[is_bond] = self._bond_scores(rows)[0]
+        scores[~is_bond] = [f.getScore(self.particles) for f in others]
+        return scores
+
+    def evalForceViolationRatios(self, fids, expand=False):
+        """
+        Violation ratios of a set of forces, harmonic bounds are evaluated
+        all at once. With `expand`, collective forces (rnum > 1) return a
+        ratio for each restrained particle instead of one overall value;
+        harmonic bound ratios come first in that case.
+        """
+        is_bond, rows, others = self._split_forces(fids)
+        scores, d, k = self._bond_scores(rows)
+        bond_ratios = np.divide(scores, k * d, out=np.zeros(len(rows)), where=(d != 0))
+
+        if expand:
+            ratios = [bond_ratios]
+            for f in others:
+                if getattr(f, 'rnum', 1) > 1:
+                    ratios.append(np.asarray(f.getViolationRatios(self.particles), dtype=np.float64))
+                else:
+                    ratios.append([f.getViolationRatio(self.particles)])
+            return np.concatenate(ratios)
+
+        ratios = np.zeros(len(is_bond))
+        ratios[is_bond] = bond_ratios
+        ratios[~is_bond] = [f.getViolationRatio(self.particles) for f in others]
+        return ratios
+
+    def getImposedCount(self, fids):
+        """
+        Number of restraints imposed by a set of forces (collective forces
+        count one per restrained particle)
+        """
+        is_bond, rows, others = self._split_forces(fids)
+        return int(len(rows) + sum(getattr(f, 'rnum', 1) for f in others))
     #====
         
         
@@ -135,6 +417,9 @@ class Model(object):
         if cfg['optimization']["kernel"] == "lammps":
             from .kernel import lammps
             return lammps.optimize(self, cfg)
+        elif cfg['optimization']["kernel"] == "numpy":
+            from .kernel import numpy_kernel
+            return numpy_kernel.optimize(self, cfg)
         #-
     #-
     
@@ -157,3 +442,24 @@ class Model(object):
 #=
 
 
+
+
+def optimize_models(models, cfg):
+    """
+    optimize a list of models by selected kernel, returns the list of
+    optimization infos. With the lammps kernel, all the models are run
+    by a single LAMMPS process. Each model uses `<run_name>_<model.id>`
+    as run name.
+    """
+
+    if cfg['optimization']["kernel"] == "lammps" and len(models) > 1:
+        from .kernel import lammps
+        return lammps.optimize_batch(models, cfg)
+
+    run_name = cfg['runtime']['run_name']
+    infos = []
+    for m in models:
+        cfg['runtime']['run_name'] = '{}_{}'.format(run_name, m.id)
+        infos.append(m.optimize(cfg))
+    cfg['runtime']['run_name'] = run_name
+    return infos
@@ -34,5 +34,53 @@ class Particle(object):
     
     def __sub__(self, other):
         return np.linalg.norm(self.pos - other.pos)
-    
-    
+
+
+class ParticleView(Particle):
+    """
+    A particle of a `igm.Model`, reading and writing the model arrays.
+    Additional attributes passed to `Model.addParticle` are stored in the
+    model too.
+    """
+
+    def __init__(self, model, i):
+        self._model = model
+        self._i = i
+
+    @property
+    def pos(self):
+        return self._model._pos[self._i]
+
+    @pos.setter
+    def pos(self, value):
+        self._model._pos[self._i] = value
+
+    @property
+    def r(self):
+        return self._model._radius[self._i]
+
+    @r.setter
+    def r(self, value):
+        self._model._radius[self._i] = value
+
+    @property
+    def ptype(self):
+        return int(self._model._ptype[self._i])
+
+    @ptype.setter
+    def ptype(self, value):
+        self._model._ptype[self._i] = value
+
+    @property
+    def chainID(self):
+        chain_id = self._model._chain[self._i]
+        if chain_id < 0:
+            raise AttributeError('chainID')
+        return chain_id
+
+    def __getattr__(self, name):
+        attrs = self._model._particle_attrs.get(self._i, {})
+        if name in attrs:
+            return attrs[name]
+        raise AttributeError(name)
+
@@ -1,10 +1,22 @@
 import os
 import os.path
 import time
+import errno
+import struct
+import ctypes
+import ctypes.util
 import traceback
 import multiprocessing
+from multiprocessing.connection import wait as wait_connections
 
-POLL_INTERVAL = 30  # check 30 seconds
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+POLL_INTERVAL = 30  # maximum interval between two scans of the files
+MIN_POLL_INTERVAL = 0.1  # first interval, it grows while no file is found
+POLL_INTERVAL_GROWTH = 1.5
 
 
 class GeneratorLen(object):
@@ -19,14 +31,113 @@ class GeneratorLen(object):
         return self.gen
 
 
+class Inotify(object):
+
+    '''
+    Minimal inotify wrapper (Linux only), reporting the files created or
+    closed after writing in a set of directories. Files written by other
+    nodes on network file systems are not reported, so it is only used to
+    notice local completions early, together with the scans.
+    '''
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = 0o2000000
+
+    EVENT_HEADER = struct.Struct('iIII')
+
+    _libc = None
+
+    @classmethod
+    def available(cls):
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                cls._libc = libc
+            except (OSError, AttributeError):
+                cls._libc = False
+        return bool(cls._libc)
+
+    def __init__(self, directories):
+        if not self.available():
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.directories = {}
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        for d in directories:
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(d), mask)
+            if wd < 0:
+                self.close()
+                raise OSError(ctypes.get_errno(), 'inotify_add_watch failed on %s' % d)
+            self.directories[wd] = d
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+
+        """ Paths of the files reported since the last call (does not block) """
+
+        paths = []
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not buf:
+                break
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buf, pos)
+                pos += self.EVENT_HEADER.size
+                name = buf[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if wd in self.directories and name:
+                    paths.append(os.path.join(self.directories[wd], os.fsdecode(name)))
+        return paths
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class _Reporter(object):
+
+    """ list-like append, sending the values to the parent process """
+
+    def __init__(self, queue, kind):
+        self.queue = queue
+        self.kind = kind
+
+    def append(self, value):
+        self.queue.put((self.kind, value))
+
+
 class FilePoller(object):
 
-    """ Define polling function """
+    '''
+    Calls `callback(*args[i], **kwargs[i])` when the i-th file appears,
+    in a separate process (see watch_async), after calling `setup`. When
+    all the files have been processed, `teardown` is called.
+
+    Files are noticed through inotify events where available, through
+    `notify` calls (e.g. from the completion iterator of the controller),
+    and through scans of the remaining files, at intervals which grow from
+    MIN_POLL_INTERVAL to `interval` while nothing is found.
+    '''
 
     def __init__(self, files, callback, args=None, kwargs=None, remove_after_callback=False,
                  setup=None, setup_args=tuple(), setup_kwargs=dict(),
                  teardown=None, teardown_args=tuple(), teardown_kwargs=dict()):
-        self._manager = multiprocessing.Manager()
 
         self.files = files
         self.args = args
@@ -42,31 +153,61 @@ class FilePoller(object):
         self.th = None
 
         self.remove_flag = remove_after_callback
-        self.completed = self._manager.list()
+        self.completed = []
         self.setup = setup
         self.setup_args = setup_args
         self.setup_kwargs = setup_kwargs
         self.teardown = teardown
         self.teardown_args = teardown_args
         self.teardown_kwargs = teardown_kwargs
-        self._traceback = self._manager.list()
+        self._traceback = []
+        self._queue = None
+        self._notify_recv, self._notify_send = None, None
+
+    def _watch_inotify(self):
+        if not Inotify.available():
+            return None
+        try:
+            return Inotify(set(os.path.dirname(os.path.abspath(f)) for f in self.files))
+        except OSError:
+            return None
 
-    # watch function, which scans over the 'to_poll' list
+    # watch function, which waits for the files in the 'to_poll' set
     def watch(self, completed, tb, timeout=None, interval=POLL_INTERVAL):
+        inotify = None
         try:
             if self.setup:
                 self.setup(*self.setup_args, **self.setup_kwargs)
             to_poll = set(range(len(self.files)))
-            start = time.time()
-            while True:
-                last_poll = time.time()
-                for i in list(to_poll):
-                    if os.path.isfile(self.files[i]):
+            index = {os.path.abspath(f): i for i, f in enumerate(self.files)}
+
+            def check(candidates):
+                found = 0
+                for i in candidates:
+                    if i in to_poll and os.path.isfile(self.files[i]):
                         self.callback(*self.args[i], **self.kwargs[i])
                         if self.remove_flag:
                             os.remove(self.files[i])
                         to_poll.remove(i)
                         completed.append(i)
+                        found += 1
+                return found
+
+            inotify = self._watch_inotify()
+            sources = [c for c in (inotify, self._notify_recv) if c is not None]
+
+            start = time.time()
+            wait_time = min(MIN_POLL_INTERVAL, interval)
+            next_scan = start
+            while True:
+                now = time.time()
+                if now >= next_scan:
+                    # scan all the remaining files
+                    if check(list(to_poll)):
+                        wait_time = min(MIN_POLL_INTERVAL, interval)
+                    else:
+                        wait_time = min(wait_time * POLL_INTERVAL_GROWTH, interval)
+                    next_scan = time.time() + wait_time
 
                 if len(to_poll) == 0:
                     break
@@ -76,9 +217,24 @@ class FilePoller(object):
                     if now - start > timeout:
                         raise RuntimeError('Timeout expired (%f seconds)' % (timeout,))
 
-                delta = now - last_poll
-                if delta < interval:
-                    time.sleep(interval - delta)
+                # wait for events until the next scan
+                delay = max(0, next_scan - now)
+                if len(sources):
+                    ready = wait_connections(sources, delay)
+                else:
+                    ready = []
+                    time.sleep(delay)
+
+                for source in ready:
+                    if source is inotify:
+                        check([index[p] for p in inotify.read() if p in index])
+                    else:
+                        try:
+                            ids = source.recv()
+                        except EOFError:
+                            sources.remove(source)
+                            continue
+                        check(ids)
 
         except KeyboardInterrupt:
             pass
@@ -87,45 +243,109 @@ class FilePoller(object):
             tb.append(traceback.format_exc())
 
         finally:
+            if inotify is not None:
+                inotify.close()
             if self.teardown:
                 try:
                     self.teardown(*self.teardown_args, **self.teardown_kwargs)
                 except:
                     stb = traceback.format_exc()
                     try:
-                        # the tb manager could already be down
+                        # the parent process could already be gone
                         tb.append(stb)
                     except:
-                        print(stb)    
-                    
+                        print(stb)
+
     def watch_async(self, timeout=None, interval=POLL_INTERVAL):
-        self.th = multiprocessing.Process(target=self.watch, args=(self.completed, self._traceback, timeout, interval))
+        self._queue = multiprocessing.Queue()
+        self._notify_recv, self._notify_send = multiprocessing.Pipe(duplex=False)
+        self.th = multiprocessing.Process(target=self.watch, args=(
+            _Reporter(self._queue, 'completed'), _Reporter(self._queue, 'error'), timeout, interval))
         self.th.start()
+        self._notify_recv.close()
+
+    def notify(self, ids):
+        '''
+        Signal that the files `ids` (indexes in `files`) may be ready, e.g.
+        because their tasks have been reported as completed by the controller.
+        The files are checked right away by the watching process.
+        '''
+        if self._notify_send is not None and self.th is not None and self.th.is_alive():
+            try:
+                self._notify_send.send(list(ids))
+            except (OSError, IOError, ValueError):
+                pass
+
+    def _receive(self, block=True, timeout=None):
+
+        """ Collect the messages of the watching process, returns False if there was none """
+
+        try:
+            kind, value = self._queue.get(block, timeout)
+        except Empty:
+            return False
+        if kind == 'completed':
+            self.completed.append(value)
+        else:
+            self._traceback.append(value)
+        return True
+
+    def _drain(self, timeout=None):
+        '''
+        Collect the messages of the watching process until it exits (or
+        `timeout` expires), then join it. The process does not exit while
+        its messages are buffered in the queue, so the queue must be emptied
+        before joining.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while self.th is not None and self.th.is_alive():
+            wait_time = MIN_POLL_INTERVAL
+            if deadline is not None:
+                wait_time = min(wait_time, deadline - time.time())
+                if wait_time <= 0:
+                    break
+            if self._queue is not None:
+                self._receive(timeout=wait_time)
+            else:
+                self.th.join(wait_time)
+        if self.th is not None and not self.th.is_alive():
+            self.th.join()
+        while self._queue is not None and self._receive(block=False):
+            pass
+
+    def _finish(self):
+        self._drain()
+        if self._notify_send is not None:
+            self._notify_send.close()
+            self._notify_send = None
 
     def wait(self, timeout=None):
-        self.th.join(timeout)
+        self._drain(timeout)
         if len(self._traceback):
             raise RuntimeError('\n'.join(self._traceback))
 
     def _enumerate(self):
         lastc = 0
         while True:
-            #print('lastdc = ' + str(lastc))     # LB
             if len(self._traceback):
-                    self.th.join()
-                    raise RuntimeError('\n'.join(self._traceback))
+                self._finish()
+                raise RuntimeError('\n'.join(self._traceback))
 
             if lastc == len(self.files):
-                if self.th:
-                    self.th.join()
+                self._finish()
+                if len(self._traceback):
+                    raise RuntimeError('\n'.join(self._traceback))
                 break
 
             if len(self.completed) > lastc:
                 lastc += 1
                 yield self.completed[lastc - 1]
 
-            else:
-                time.sleep(POLL_INTERVAL)
+            elif not self._receive(timeout=1.0) and not self.th.is_alive():
+                # the process may have sent its last messages before exiting
+                self._finish()
+                if len(self.completed) == lastc and not len(self._traceback):
+                    raise RuntimeError('the file poller terminated before all the files were processed')
 
     def enumerate(self):
         return GeneratorLen(self._enumerate(), len(self.files))
@@ -65,5 +65,8 @@ class DaskController(ParallelController):
             results.append(f.result())
         return results
 
+    def broadcast(self, task, *args):
+        self.client.run(task, *args)
+
     def reduce(self, reduce_task, outs):
         return reduce_task(outs)
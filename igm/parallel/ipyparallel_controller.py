@@ -22,18 +22,26 @@ class IppFunctionWrapper(object):
         self.inner = inner
         self.timeout = timeout
 
-    def run(self, *args, **kwargs):
+    def execute(self, *args, **kwargs):
         try:
             from time import time
             tstart = time()
             res = self.inner(*args, **kwargs)
-            self._q.put( (0, res, time()-tstart) )
+            return (0, res, time()-tstart)
         except:
             exc_type, exc_value, exc_traceback = sys.exc_info()
             tb_str = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
-            self._q.put( (-1, tb_str, None) )
+            return (-1, tb_str, None)
+
+    def run(self, *args, **kwargs):
+        self._q.put(self.execute(*args, **kwargs))
 
     def __call__(self, *args, **kwargs):
+        # without a timeout, run in the engine process, so that the process-local
+        # caches (e.g. utils.input_cache) are kept from one task to the next
+        if self.timeout is None:
+            return self.execute(*args, **kwargs)
+
         # runs on a child process to terminate execution if timeout exceedes
         try:
             import multiprocessing
@@ -58,12 +66,33 @@ class IppFunctionWrapper(object):
 
 
 
+class IndexedTask(object):
+    '''
+    Wraps a task so that it returns the index of its argument together with
+    the result. Used to match results (and failures, when wrapping an
+    IppFunctionWrapper) to arguments when they are collected out of order.
+    '''
+    def __init__(self, inner):
+        self.inner = inner
+
+    def __call__(self, indexed_arg):
+        k, arg = indexed_arg
+        return k, self.inner(arg)
+
+
+
 class BasicIppController(ParallelController):
     def __init__(self, timeout=None, max_tasks=-1):
         self.max_tasks = max_tasks
         self.timeout=timeout
 
     def map(self, parallel_task, args):
+        r = [None] * len(args)
+        for k, res in self.imap(parallel_task, args):
+            r[k] = res
+        return r
+
+    def imap(self, parallel_task, args):
         from ipyparallel import Client, TimeoutError
 
         chunksize = 1
@@ -81,22 +110,24 @@ class BasicIppController(ParallelController):
         try:
             client[:].use_cloudpickle()
             lbv = client.load_balanced_view()
+            # results are yielded as soon as they are available
             ar = lbv.map_async(
-                IppFunctionWrapper(parallel_task, self.timeout),
-                args,
-                chunksize=chunksize
+                IndexedTask(IppFunctionWrapper(parallel_task, self.timeout)),
+                list(enumerate(args)),
+                chunksize=chunksize,
+                ordered=False
             )
             try:
-                r = []
-                for k, z in enumerate(tqdm(ar, desc="(IPYPARALLEL)", total=len(args))):
+                for k, z in tqdm(ar, desc="(IPYPARALLEL)", total=len(args)):
                     if z[0] == -1:
                         logger.error(z[1])
-                        engine = ar.engine_id[k]
+                        # arguments are sent in consecutive chunks, one message per chunk
+                        engine = ar.engine_id[k // chunksize]
                         client.abort(ar)
                         client.close()
-                        raise RuntimeError('remote failure (task %d of %d on engine %d)' % (k+1, len(ar), engine))
+                        raise RuntimeError('remote failure (task %d of %d on engine %s)' % (k+1, len(args), engine))
                     elif z[0] == 0:
-                        r.append(z[1])
+                        yield k, z[1]
             except KeyboardInterrupt:
                 client.abort(ar)
                 raise
@@ -106,7 +137,20 @@ class BasicIppController(ParallelController):
                 client.abort(ar)
             if client:
                 client.close()
-        return r
+
+    def broadcast(self, task, *args):
+        from ipyparallel import Client, TimeoutError
+
+        try:
+            client = Client()
+        except TimeoutError:
+            raise RuntimeError('Cannot connect to the ipyparallel client. Is it running?')
+        try:
+            dview = client[:]
+            dview.use_cloudpickle()
+            dview.apply_sync(task, *args)
+        finally:
+            client.close()
 
 class BasicAsyncIppController(BasicIppController):
     def map(self, parallel_task, args):
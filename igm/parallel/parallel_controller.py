@@ -17,6 +17,24 @@ class ParallelController(object):
     def map(self, parallel_task, args):
         raise NotImplementedError()
 
+    def imap(self, parallel_task, args):
+        '''
+        Iterates over (index, result) pairs, where index is the position of
+        the argument in `args`. Controllers able to report single
+        completions yield them as soon as each task is done, in completion
+        order. By default, results are yielded after the whole map.
+        '''
+        for k, r in enumerate(self.map(parallel_task, args)):
+            yield k, r
+
+    def broadcast(self, task, *args):
+        '''
+        Runs `task(*args)` once on every worker, e.g. to release node-local
+        resources at the end of a step. By default, workers run on the
+        local node, and the task is run here.
+        '''
+        task(*args)
+
     def reduce(self, reduce_task, outs):
         return reduce_task(outs)
 
@@ -30,6 +48,10 @@ class SerialController(ParallelController):
     def map(self, parallel_task, args):
         return [parallel_task(a) for a in tqdm(args, desc="(SERIAL)")]
 
+    def imap(self, parallel_task, args):
+        for k, a in enumerate(tqdm(args, desc="(SERIAL)")):
+            yield k, parallel_task(a)
+
 
 
 def map_reduce(parallel_task, reduce_function, args, controller):
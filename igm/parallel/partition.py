@@ -0,0 +1,154 @@
+from __future__ import division, print_function
+
+import os
+import os.path
+import json
+import glob
+import time
+import numpy as np
+
+from ..utils.log import logger
+
+# weight of the last measurements when updating the timings history
+HISTORY_WEIGHT = 0.5
+
+
+def partition_by_cost(costs, target_cost):
+    '''
+    Split a sequence of items into contiguous batches of roughly `target_cost`
+    total cost. Each item goes to the batch containing the midpoint of its
+    cost interval, so an item more expensive than `target_cost` gets a batch
+    of its own.
+
+    Returns
+    -------
+    bounds : np.ndarray
+        (n_batches + 1) array, batch b contains the items in
+        bounds[b]:bounds[b+1]
+    '''
+    costs = np.asarray(costs, dtype=np.float64)
+    if len(costs) == 0:
+        return np.zeros(1, dtype=np.int64)
+    target_cost = max(float(target_cost), np.finfo(np.float64).tiny)
+    mid = np.cumsum(costs) - 0.5 * costs
+    batch = np.floor(mid / target_cost).astype(np.int64)
+    cuts = np.flatnonzero(np.diff(batch)) + 1
+    return np.concatenate([[0], cuts, [len(costs)]]).astype(np.int64)
+
+
+def batch_costs(costs, bounds):
+
+    """ Total cost of each batch """
+
+    cum = np.concatenate([[0.], np.cumsum(costs, dtype=np.float64)])
+    return cum[bounds[1:]] - cum[bounds[:-1]]
+
+
+class BatchCostModel(object):
+    '''
+    Estimates the duration of assignment tasks from the cost of their items,
+    and partitions the items into batches of similar duration.
+
+    Item costs are computed by each step, in arbitrary units (e.g. the number
+    of distances computed by the task). Task timings measured in previous runs
+    of steps with the same `name` are fit with a linear model
+
+        duration = overhead + seconds_per_unit * cost
+
+    and stored in `<parameters/tmp_dir>/batch_costs.json`. If a target task
+    duration is set (`parallel/target_task_duration`) and a fit is
+    available, batches are cut to match it. Otherwise, the target cost is the
+    average cost of `batch_size` items, so the number of batches is the same
+    as with fixed size batches, but each has a similar cost.
+    '''
+
+    def __init__(self, cfg, name):
+        self.name = name
+        self.history_file = os.path.join(cfg.get('parameters/tmp_dir'), 'batch_costs.json')
+        self.target_duration = cfg.get('parallel/target_task_duration', None)
+
+    def read_history(self):
+        if os.path.isfile(self.history_file):
+            with open(self.history_file) as f:
+                return json.load(f)
+        return {}
+
+    def target_cost(self, costs, batch_size):
+        costs = np.asarray(costs, dtype=np.float64)
+        fit = self.read_history().get(self.name)
+        if self.target_duration and fit is not None and fit['seconds_per_unit'] > 0:
+            target = (self.target_duration - fit['overhead']) / fit['seconds_per_unit']
+            if target > 0:
+                return target
+        if len(costs) == 0:
+            return 1.0
+        return costs.mean() * batch_size
+
+    def partition(self, costs, batch_size):
+        '''
+        Returns the bounds of the batches (see `partition_by_cost`)
+        '''
+        bounds = partition_by_cost(costs, self.target_cost(costs, batch_size))
+        logger.info('%s: %d items in %d batches', self.name, len(costs), len(bounds) - 1)
+        return bounds
+
+    def update(self, batch_costs, tmp_dir):
+        '''
+        Fit the timings recorded by the tasks (see `record_task_time`) in
+        `tmp_dir` and merge the result into the history file. Timing records
+        are removed.
+        '''
+        costs, durations = [], []
+        for fname in glob.glob(os.path.join(tmp_dir, '*.timing')):
+            batch_id = int(os.path.basename(fname).split('.')[0])
+            with open(fname) as f:
+                elapsed = float(f.read())
+            os.remove(fname)
+            if batch_id < len(batch_costs):
+                costs.append(batch_costs[batch_id])
+                durations.append(elapsed)
+
+        if len(costs) < 2:
+            return
+        costs = np.array(costs)
+        durations = np.array(durations)
+
+        if np.ptp(costs) > 0:
+            seconds_per_unit, overhead = np.polyfit(costs, durations, 1)
+        else:
+            seconds_per_unit, overhead = 0., 0.
+        if seconds_per_unit <= 0:
+            seconds_per_unit, overhead = durations.sum() / max(costs.sum(), 1e-12), 0.
+        overhead = max(0., overhead)
+
+        history = self.read_history()
+        old = history.get(self.name)
+        if old is not None:
+            seconds_per_unit = HISTORY_WEIGHT * seconds_per_unit + (1 - HISTORY_WEIGHT) * old['seconds_per_unit']
+            overhead = HISTORY_WEIGHT * overhead + (1 - HISTORY_WEIGHT) * old['overhead']
+        history[self.name] = {
+            'seconds_per_unit': float(seconds_per_unit),
+            'overhead': float(overhead),
+            'max_duration': float(durations.max()),
+            'mean_duration': float(durations.mean()),
+        }
+        tmpname = self.history_file + '.%d.tmp' % os.getpid()
+        with open(tmpname, 'w') as f:
+            json.dump(history, f, indent=4)
+        os.rename(tmpname, self.history_file)
+
+
+def record_task_time(tmp_dir, batch_id, start):
+    '''
+    Called at the end of a task, records the time elapsed since `start`
+    (a time.time() value) to `<tmp_dir>/<batch_id>.timing`
+    '''
+    with open(os.path.join(tmp_dir, '%d.timing' % batch_id), 'w') as f:
+        f.write('%f' % (time.time() - start))
+
+
+def copy_numbers(copy_index):
+
+    """ Number of copies of each locus, from an alabtools copy_index """
+
+    return np.array([len(copy_index[i]) for i in range(len(copy_index))], dtype=np.int64)
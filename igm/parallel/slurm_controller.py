@@ -119,15 +119,19 @@ class SlurmController(ParallelController):
 
             time.sleep(timeout)
 
-        raise StopIteration
-
 
     def map(self, parallel_task, args):
+        for _ in self.imap(parallel_task, args):
+            pass
+
+    def imap(self, parallel_task, args):
         uid = 'slurmc.' + str(uuid4())
         outd = os.path.join(self.tmp_dir, uid)
         os.makedirs(outd)
 
-        batches = list(split_evenly(args, self.max_tasks))
+        # each job runs a batch of arguments, yield their indexes when the job completes
+        index_batches = list(split_evenly(list(range(len(args))), self.max_tasks))
+        batches = [[args[k] for k in b] for b in index_batches]
 
         sfile = os.path.join(outd, 'exdata.cloudpickle')
         with open(sfile, 'wb') as f:
@@ -139,12 +143,22 @@ class SlurmController(ParallelController):
 
         ar = self.poll_loop(n_tasks, outd)
         for i in tqdm(ar, desc="(SLURM)", total=n_tasks):
-            pass
+            for k in index_batches[i]:
+                yield k, None
         shutil.rmtree(outd)
 
+    def broadcast(self, task, *args):
+        # jobs do not outlive their tasks, and cannot be reached once the map is over:
+        # node-local resources are released by each job when it ends (see execute)
+        task(*args)
+
     @staticmethod
     def execute(sfile, i):
+        from ..utils.population_cache import release_idle_population_caches
+
         v = cloudpickle.load(open(sfile, 'rb'))
         for x in v['args'][i]:
             v['f'](x)
+        # node-local population caches not in use by other jobs
+        release_idle_population_caches()
         open(os.path.join(v['outd'], '%d.complete' % i), 'w').close()
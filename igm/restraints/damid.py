@@ -7,11 +7,11 @@
 from __future__ import division, print_function
 
 import numpy as np
-import h5py
 
 from .restraint import Restraint
 from ..model.forces import HarmonicLowerBound, EllipticEnvelope    # restraint forces associated with damid
 from ..model import Particle
+from ..utils import input_cache
 
 try:
     UNICODE_EXISTS = bool(type(unicode))
@@ -120,14 +120,14 @@ class Damid(Restraint):
         center = model.addParticle([0., 0., 0.], 0., Particle.DUMMY_STATIC)
         cutoff = 1 - self.contact_range
 
-        affected_particles = [
-            i for i, d in self.damid_actdist
-            if snormsq_ellipsoid(
-                model.particles[i].pos,
-                np.array([self.a, self.b, self.c]) * cutoff,
-                model.particles[i].r
-            ) >= d**2
-        ]
+        loc, dist = self.damid_actdist.get_arrays()
+        semiaxes = np.array([self.a, self.b, self.c]) * cutoff
+        r = model.radii[loc].astype(np.float64)
+        snormsq = np.sum(
+            np.square(model.positions[loc]) / np.square(semiaxes[None] - r[:, None]),
+            axis=1
+        )
+        affected_particles = loc[snormsq >= np.square(dist)].tolist()
 
         f = model.addForce(
             EllipticEnvelope(
@@ -153,8 +153,9 @@ class DamidActivationDistanceDB(object):
     """
 
     def __init__(self, damid_file, chunk_size = 10000):
-        self.h5f = h5py.File(damid_file,'r')
-        self._n = len(self.h5f['loc'])
+        # read-only, so the arrays are shared by all the tasks of a worker process
+        self._data = input_cache.h5_arrays(damid_file, ('loc', 'dist'))
+        self._n = len(self._data['loc'])
 
         self.chunk_size = min(chunk_size, self._n)
 
@@ -165,6 +166,10 @@ class DamidActivationDistanceDB(object):
     def __len__(self):
         return self._n
 
+    def get_arrays(self):
+        """ Returns the (loc, dist) arrays """
+        return np.asarray(self._data['loc'], dtype=np.int64), np.asarray(self._data['dist'])
+
     def __iter__(self):
         return self
 
@@ -188,14 +193,7 @@ class DamidActivationDistanceDB(object):
         return self.__next__()
 
     def _load_next_chunk(self):
-        self._chk_row = self.h5f['loc'][self._chk_end : self._chk_end + self.chunk_size]
-        self._chk_data = self.h5f['dist'][self._chk_end : self._chk_end + self.chunk_size]
+        self._chk_row = self._data['loc'][self._chk_end : self._chk_end + self.chunk_size]
+        self._chk_data = self._data['dist'][self._chk_end : self._chk_end + self.chunk_size]
         self._chk_end += self.chunk_size
         self._chk_i = 0
-
-    def __del__(self):
-        try:
-            self.h5f.close()
-        except:
-            pass
-
@@ -38,10 +38,7 @@ class Envelope(Restraint):
         """ add a dummy dimensionless particle in the geometric center, to be used in force modeling """
         center = model.addParticle([0., 0., 0.], 0., Particle.DUMMY_STATIC)
 
-        normal_particles = [
-            i for i, p in enumerate(model.particles)
-            if p.ptype == Particle.NORMAL
-        ]
+        normal_particles = np.flatnonzero(model.ptypes == Particle.NORMAL).tolist()
         f = model.addForce(
             EllipticEnvelope(
                 normal_particles,
@@ -14,8 +14,10 @@ from .restraint import Restraint
 from ..model.forces import HarmonicUpperBound, HarmonicLowerBound
 from ..model.particle import Particle
 
-import h5py
 from ..utils.log import logger
+from ..utils import input_cache
+
+FISH_FIELDS = ('probes', 'radial_min', 'radial_max', 'pairs', 'pair_min', 'pair_max')
 
 # helper functions
 
@@ -77,7 +79,8 @@ class Fish(Restraint):
         
         self.fish_assignment_file = fish_assignment_file
 
-        self.hff                  = h5py.File(self.fish_assignment_file, 'r')
+        # read-only, so the arrays are shared by all the tasks of a worker process
+        self.hff                  = input_cache.h5_arrays(self.fish_assignment_file, FISH_FIELDS)
 
         self.rtype                = rtype
         self.index                = index
@@ -121,7 +124,7 @@ class Fish(Restraint):
             if minradial:
 
                probes  = hff['probes'][()]
-               targets = hff['radial_min'][:, struct_id][()]   # select only those "target_distance"s pertaining such a structure
+               targets = hff['radial_min'][:, struct_id]   # select only those "target_distance"s pertaining such a structure
    
                for q, i in enumerate(probes):
                 
@@ -162,7 +165,7 @@ class Fish(Restraint):
             if maxradial:
 
                probes  = hff['probes'][()]
-               targets = hff['radial_max'][:, struct_id][()]
+               targets = hff['radial_max'][:, struct_id]
 
                for q, i in enumerate(probes):
                     # get all multiploid copies of locus i
@@ -199,7 +202,7 @@ class Fish(Restraint):
             if minpair:
 
                 pairs   = hff['pairs'][()]
-                targets = hff['pair_min'][:, struct_id][()]
+                targets = hff['pair_min'][:, struct_id]
 
                 for q, (i, j) in enumerate(pairs):
                    assert (i != j)
@@ -237,7 +240,7 @@ class Fish(Restraint):
             if maxpair:
 
                pairs   = hff['pairs'][()]
-               targets = hff['pair_max'][:, struct_id][()]
+               targets = hff['pair_max'][:, struct_id]
 
                for q, (i, j) in enumerate(pairs):
                 
@@ -270,7 +273,5 @@ class Fish(Restraint):
                                        note=Restraint.FISH_PAIR)
                    f = model.addForce(f)
                    self.forceID.append(f)
-
-            hff.close()
     
 #==
@@ -34,10 +34,7 @@ class GenEnvelope(Restraint):
 
     def _apply_sphere_envelop(self, model):
 
-        normal_particles = [
-            i for i, p in enumerate(model.particles)
-            if p.ptype == Particle.NORMAL
-        ]
+        normal_particles = np.flatnonzero(model.ptypes == Particle.NORMAL).tolist()
 
         f = model.addForce(
             ExpEnvelope(
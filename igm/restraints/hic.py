@@ -7,9 +7,8 @@ from __future__ import division, print_function
 import numpy as np
 
 from .restraint import Restraint
-from ..model.forces import HarmonicUpperBound
-
-import h5py
+from ..model.forces import Force
+from ..utils import input_cache
 
 class HiC(Restraint):
 
@@ -19,45 +18,64 @@ class HiC(Restraint):
     Parameters
     ----------
     actdist_file : activation distance file (generated from ActivationDistanceStep.py)
+        or an ActivationDistanceDB, which can be shared by several restraints
+        so that the file is read only once
         
     contactRange : int
         defining contact range between 2 particles as contactRange*(r1+r2)
 
     k: float
 	elastic constant for harmonic restraint
+
+    struct_id: int, optional
+        if specified and the actdist file contains the per-structure layout,
+        only the restraints pre-assigned to this structure are read and
+        tested (see ActivationDistanceStep.get_struct_assignments)
     """
+
+    NOTE = Restraint.HIC
     
-    def __init__(self, actdist_file, contactRange=2, k=1.0):
+    def __init__(self, actdist_file, contactRange=2, k=1.0, struct_id=None):
         
         self.contactRange = contactRange
         self.k = k
+        self.struct_id = struct_id
         self.forceID = []
         self._load_actdist(actdist_file)
     #-
     
     def _load_actdist(self,actdist):
-        self.actdist = ActivationDistanceDB(actdist)
+        if isinstance(actdist, ActivationDistanceDB):
+            self.actdist = actdist
+        else:
+            self.actdist = ActivationDistanceDB(actdist)
+
+    def _select(self, row, col):
+
+        """ Mask of the candidate pairs handled by this restraint """
+
+        return np.ones(len(row), dtype=bool)
     
     def _apply(self, model):
 
         """ Apply harmonic restraint to those distances smaller than d_{act}""" 
-       
-        for (i, j, d) in self.actdist:
-            
-            # calculate particle distances for i, j
-            # if ||i-j|| <= d then assign a bond for i, j
-            if model.particles[i] - model.particles[j] <= d : 
-                
-                # harmonic mean distance
-                dij = self.contactRange*(model.particles[i].r + 
-                                         model.particles[j].r)
-                
-                # add harmonic bond between i-th and j-th beads
-                f = model.addForce(HarmonicUpperBound((i, j), dij, self.k, 
-                                                      note=Restraint.HIC))
-                self.forceID.append(f)
-            #-
-        #-
+
+        row, col, dist = self.actdist.get_arrays(self.struct_id)
+        sel = np.flatnonzero(self._select(row, col))
+        i, j = row[sel], col[sel]
+
+        # calculate particle distances for all the (i, j) candidates
+        # if ||i-j|| <= d then assign a bond for i, j
+        crd = model.positions
+        active = np.linalg.norm(crd[i] - crd[j], axis=1) <= dist[sel]
+        i, j = i[active], j[active]
+
+        # harmonic mean distance
+        dij = self.contactRange*(model.radii[i].astype(np.float64) + model.radii[j])
+
+        # add harmonic bonds between i-th and j-th beads
+        fids = model.addBonds(Force.HARMONIC_UPPER_BOUND, i, j, dij, self.k, note=self.NOTE)
+        self.forceID.extend(fids.tolist())
     #=
     
     
@@ -66,25 +84,61 @@ class HiC(Restraint):
 class ActivationDistanceDB(object):
 
     """ HDF5 activation distance iterator: read in file of activation distances, in chunks """
+
+    FIELDS = ('row', 'col', 'dist', 'by_struct/indptr', 'by_struct/row', 'by_struct/col', 'by_struct/dist')
+    STRUCT_FIELDS = ('by_struct/indptr', 'by_struct/row', 'by_struct/col', 'by_struct/dist')
         
     def __init__(self, actdist_file, chunk_size = 10000):
-        self.h5f = h5py.File(actdist_file,'r')
-        self._n = len(self.h5f['row'])
+        # read-only, so the arrays are shared by all the tasks of a worker process.
+        # The per-structure layout is stored contiguously and mapped from the file, the
+        # full row/col/dist columns are chunked (read whole), and are read only if needed
+        self._file = actdist_file
+        self._struct = input_cache.h5_arrays(actdist_file, self.STRUCT_FIELDS)
+        self._data = None
         
-        self.chunk_size = min(chunk_size, self._n)
+        self.chunk_size = chunk_size
         
         self._i = 0
         self._chk_i = chunk_size
         self._chk_end = 0
+
+    def _columns(self):
+        if self._data is None:
+            self._data = input_cache.h5_arrays(self._file, ('row', 'col', 'dist'))
+        return self._data
         
     def __len__(self):
-        return self._n
+        return len(self._columns()['row'])
+
+    def has_struct_layout(self):
+        return 'by_struct/indptr' in self._struct
+
+    def get_arrays(self, struct_id=None):
+        """
+        Returns the (row, col, dist) arrays of the restraints. If struct_id
+        is specified and the file contains the per-structure layout, only
+        the restraints pre-assigned to that structure.
+        """
+        if struct_id is not None and self.has_struct_layout():
+            start, end = self._struct['by_struct/indptr'][struct_id:struct_id + 2]
+            data = {k: self._struct['by_struct/' + k] for k in ('row', 'col', 'dist')}
+        else:
+            data = self._columns()
+            start, end = 0, len(data['row'])
+
+        return (np.asarray(data['row'][start:end], dtype=np.int64),
+                np.asarray(data['col'][start:end], dtype=np.int64),
+                np.asarray(data['dist'][start:end]))
+
+    def get_struct_restraints(self, struct_id):
+        """ Returns the (i, j, d) restraints pre-assigned to a structure, read in a single slice """
+        return zip(*self.get_arrays(struct_id))
     
     def __iter__(self):
         return self
     
     def __next__(self):
-        if self._i < self._n:
+        if self._i < len(self):
             self._i += 1
             self._chk_i += 1
             
@@ -104,12 +158,9 @@ class ActivationDistanceDB(object):
     
     # probabilities are not needed now, since they are already encoded in the list of activation distances
     def _load_next_chunk(self):
-        self._chk_row = self.h5f['row'][self._chk_end : self._chk_end + self.chunk_size]
-        self._chk_col = self.h5f['col'][self._chk_end : self._chk_end + self.chunk_size]
-        self._chk_data = self.h5f['dist'][self._chk_end : self._chk_end + self.chunk_size]
+        data = self._columns()
+        self._chk_row = data['row'][self._chk_end : self._chk_end + self.chunk_size]
+        self._chk_col = data['col'][self._chk_end : self._chk_end + self.chunk_size]
+        self._chk_data = data['dist'][self._chk_end : self._chk_end + self.chunk_size]
         self._chk_end += self.chunk_size
         self._chk_i = 0
-    
-    def __del__(self):
-        self.h5f.close()
-        
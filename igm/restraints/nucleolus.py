@@ -1,5 +1,6 @@
 from __future__ import division, print_function
 
+import numpy as np
 from .restraint import Restraint
 from ..model.particle import Particle
 from ..model.forces import NuclExcludedVolume
@@ -28,7 +29,7 @@ class Nucleolus(Restraint):
       
         """ Apply force """
       
-        plist = [i for i, p in enumerate(model.particles) if p.ptype == Particle.NORMAL]
+        plist = np.flatnonzero(model.ptypes == Particle.NORMAL).tolist()
         
         f = model.addForce(NuclExcludedVolume(plist, self.body_pos, self.body_r, self.k))
         self.forceID.append(f)
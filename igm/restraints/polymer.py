@@ -2,7 +2,8 @@ from __future__ import division, print_function
 
 import numpy as np
 from .restraint import Restraint
-from ..model.forces import HarmonicUpperBound
+from ..model.forces import Force
+from ..utils import input_cache
 
 MIN_CONSECUTIVE = 0.5
 
@@ -26,35 +27,31 @@ class Polymer(Restraint):
         self.contactRange = contactRange
         self.k = k
         self.forceID = []
-        self.cp = np.load(contact_probabilities) if (contact_probabilities is not None) else None
+        self.cp = input_cache.npy(contact_probabilities) if (contact_probabilities is not None) else None
 
     def _apply(self, model):
 
-        for i in range(len(self.index) - 1):
-            
-            # if i and i+1 belong to the same chromosome (and copy)
-            if (self.index.chrom[i] == self.index.chrom[i+1] and
-                self.index.copy[i] == self.index.copy[i+1]):
-
-                # do we have contact probabiities?
-                if self.cp is None:
-                    dij = self.contactRange*(model.particles[i].r +
-                                             model.particles[i+1].r)
-                else:
-                    d0 = (model.particles[i].r + model.particles[i+1].r)
-                    d1 = self.contactRange * d0
-                    f = self.cp[i]
-                    # if we have inconsistent or no data, just assume MIN_CONSECUTIVE contact
-                    if f < MIN_CONSECUTIVE or f > 1:
-                        f = MIN_CONSECUTIVE
-                    x3 = ( d1**3 + ( f - 1 )*d0**3 ) / f
-                    dij = x3**(1./3)
-
-                f = model.addForce(HarmonicUpperBound((i, i+1), dij, self.k,
-                                                      note=Restraint.CONSECUTIVE))
-                self.forceID.append(f)
-            #-
-        #--
+        chrom = np.asarray(self.index.chrom)
+        copy = np.asarray(self.index.copy)
+
+        # i and i+1 belong to the same chromosome (and copy)
+        i = np.flatnonzero((chrom[:-1] == chrom[1:]) & (copy[:-1] == copy[1:]))
+        d0 = model.radii[i].astype(np.float64) + model.radii[i+1]
+
+        # do we have contact probabiities?
+        if self.cp is None:
+            dij = self.contactRange * d0
+        else:
+            d1 = self.contactRange * d0
+            f = np.asarray(self.cp, dtype=np.float64)[i]
+            # if we have inconsistent or no data, just assume MIN_CONSECUTIVE contact
+            f[(f < MIN_CONSECUTIVE) | (f > 1) | np.isnan(f)] = MIN_CONSECUTIVE
+            x3 = ( d1**3 + ( f - 1 )*d0**3 ) / f
+            dij = x3**(1./3)
+
+        fids = model.addBonds(Force.HARMONIC_UPPER_BOUND, i, i+1, dij, self.k,
+                              note=Restraint.CONSECUTIVE)
+        self.forceID.extend(fids.tolist())
     #=
 
 
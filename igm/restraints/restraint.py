@@ -53,37 +53,26 @@ class Restraint(object):
         """
         evaluate the restraint violations
         """
-        score = 0
-        violations = 0
+        scores = self.model.evalForceScores(self.forceID)
 
-        for fid in self.forceID:
-            s = self.model.evalForceScore(fid)
-            if s > 0:
-                violations += 1
-            #-
-            score += s
-
-        return (violations, score)
+        return (np.count_nonzero(scores > 0), scores.sum())
 
     def get_violations(self, tolerance):
-        violations = []
-        ratios = []
+        ratios = self.model.evalForceViolationRatios(self.forceID)
+        violated = np.flatnonzero(ratios > tolerance)
 
-        for fid in self.forceID:
-            s = self.model.evalForceViolationRatio(fid)
-            if s > tolerance:
-                violations.append(repr(self.model.forces[fid]))
-                ratios.append(s)
+        violations = [repr(self.model.forces[self.forceID[i]]) for i in violated]
 
-        return (violations, ratios)
+        return (violations, ratios[violated].tolist())
 
     def get_violation_histogram(self, nbins=100, vmax=1, epsilon=1e-4):
-        v = self.get_violations(tolerance=epsilon)
-        over = len(v>vmax)
-        inner = v[v<=vmax]
-        H, edges = np.histogram(inner, bins=nbins)
+        v = self.model.evalForceViolationRatios(self.forceID)
+        v = v[v > epsilon]
+        over = np.count_nonzero(v > vmax)
+        inner = v[v <= vmax]
+        H, edges = np.histogram(inner, bins=nbins, range=(0, vmax))
         H = np.concatenate([H, [over]])
-        edges.append(np.array([vmax, float('inf')]))
+        edges = np.concatenate([edges, [np.inf]])
         return H, edges
 
     def __repr__(self):
@@ -10,7 +10,27 @@ import h5py
 
 from ..model.particle import Particle
 from .restraint import Restraint
-from ..model.forces import HarmonicUpperBound
+from ..model.forces import Force
+from ..utils import input_cache
+
+
+def load_sprite_assignment(assignment_file):
+
+    """
+    Reads the SPRITE assignment file, and sorts the clusters by the
+    structure they are assigned to
+    """
+
+    with h5py.File(assignment_file, 'r') as h5f:
+        assignment = h5f['assignment'][()]
+        clusters = np.argsort(assignment, kind='stable')
+        return {
+            'indptr': h5f['indptr'][()],
+            'selected': h5f['selected'][()],
+            'clusters': clusters,
+            'sorted_assignment': assignment[clusters],
+        }
+
 
 class Sprite(Restraint):
     """
@@ -35,17 +55,18 @@ class Sprite(Restraint):
         self.struct_id        = struct_id
         self.k                = k
         self.forceID          = []
-        self.assignment_file  = h5py.File(assignment_file, 'r')
+        # read-only, so the arrays are shared by all the tasks of a worker process
+        self.assignment       = input_cache.cached(assignment_file, load_sprite_assignment, 'sprite_assignment')
     #-
     
     def _apply(self, model):
 
         """ Apply SPRITE restraints """ 
 
-        assignment     = self.assignment_file['assignment'][()]
-        indptr         = self.assignment_file['indptr'][()]
-        selected_beads = self.assignment_file['selected']
-        clusters_ids   = np.where(assignment == self.struct_id)[0]
+        indptr         = self.assignment['indptr']
+        selected_beads = self.assignment['selected']
+        start, end     = np.searchsorted(self.assignment['sorted_assignment'], [self.struct_id, self.struct_id + 1])
+        clusters_ids   = self.assignment['clusters'][start:end]
         radii          = model.getRadii()
         coord          = model.getCoordinates()
 
@@ -61,12 +82,10 @@ class Sprite(Restraint):
             centroid_pos = np.mean(ccrd, axis=0)
             centroid     = model.addParticle(centroid_pos, 0, Particle.DUMMY_DYNAMIC) # no excluded volume
 
-            for b in beads:
-                # apply harmonic restraint(s) to all beads making up the cluster, using the position of the centroid as "origin" (one-body terms)
-                f = model.addForce(HarmonicUpperBound(
-                    (b, centroid), float(csize-radii[b]), self.k, 
-                    note=Restraint.SPRITE))
-                self.forceID.append(f)
+            # apply harmonic restraint(s) to all beads making up the cluster, using the position of the centroid as "origin" (one-body terms)
+            fids = model.addBonds(Force.HARMONIC_UPPER_BOUND, beads, np.full(len(beads), centroid),
+                                  csize - crad.ravel(), self.k, note=Restraint.SPRITE)
+            self.forceID.extend(fids.tolist())
                 
     
 def cbrt(x):
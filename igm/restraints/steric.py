@@ -1,5 +1,6 @@
 from __future__ import division, print_function
 
+import numpy as np
 from .restraint import Restraint
 from ..model.particle import Particle
 from ..model.forces import ExcludedVolume
@@ -22,7 +23,7 @@ class Steric(Restraint):
         
     def _apply(self, model):
         
-        plist = [i for i, p in enumerate(model.particles) if p.ptype == Particle.NORMAL]
+        plist = np.flatnonzero(model.ptypes == Particle.NORMAL).tolist()
         
         f = model.addForce(ExcludedVolume(plist, self.k))
         
@@ -13,15 +13,24 @@ import scipy.sparse
 import os
 import os.path
 import shutil
+import time
 
-from alabtools import Contactmatrix
 from alabtools.analysis import HssFile
 
-from tqdm import tqdm
 
 from ..core import Step
 from ..utils.log import logger
-from ..utils.files import make_absolute_path
+from ..utils.files import make_absolute_path, save_npy_batch, h5_append_columns
+from ..utils.population_cache import get_population_coordinates
+from ..utils.actdist import population_fingerprint
+from ..utils.matrix_cache import load_contact_matrix, input_matrix_cache_dir
+from ..parallel.partition import BatchCostModel, batch_costs, record_task_time, copy_numbers
+
+try:
+    # compiled kernel, see igm/cython_compiled/actdist.pyx
+    from ..cython_compiled.actdist import get_actdist_batch
+except ImportError:
+    get_actdist_batch = None
 
 try:
     # python 2 izip
@@ -38,6 +47,34 @@ actdist_shape = [
 ]
 actdist_fmt_str = "%6d %6d %10.4f %.4f"
 
+# dictionary for the population contact frequencies of the candidate pairs
+pnow_shape = [
+    ('row', 'int32'),
+    ('col', 'int32'),
+    ('pnow', 'float32')
+]
+
+# dictionary for the restraints pre-assigned to each structure
+struct_restraint_shape = [
+    ('row', 'int32'),
+    ('col', 'int32'),
+    ('dist', 'float32')
+]
+
+# relative tolerance on the activation distance when assigning restraints to structures
+STRUCT_ASSIGNMENT_MARGIN = 1e-5
+
+# approximate number of restraints held in memory when merging the per-structure layout
+STRUCT_MERGE_SIZE = 1e7
+
+# dictionary for the candidate pairs batch files (.in.npy)
+actdist_params_shape = [
+    ('row', 'int32'),
+    ('col', 'int32'),
+    ('pwish', 'float64'),
+    ('plast', 'float64')
+]
+
 
 class ActivationDistanceStep(Step):
     def __init__(self, cfg):
@@ -116,9 +153,10 @@ class ActivationDistanceStep(Step):
         logger.info(inter_sigma)
         logger.info(intra_sigma)
 
-        contact_matrix = Contactmatrix(dictHiC["input_matrix"])
-        input_matrix   = contact_matrix.matrix
+        # the input matrix is parsed once per run, then memory-mapped from the cache
+        input_matrix   = load_contact_matrix(dictHiC["input_matrix"], input_matrix_cache_dir(self.cfg))
         n              = input_matrix.shape[0]
+        self.matrix_size = n
 
         last_actdist_file = self.cfg.get('runtime/Hi-C').get("actdist_file", None)
         batch_size        = self.cfg.get('restraints/Hi-C/batch_size', 1000)
@@ -132,58 +170,73 @@ class ActivationDistanceStep(Step):
 
         self.keep_temporary_files = dictHiC.get("keep_temporary_files", False)
 
+        # batch outputs are collected while the map is still running
+        self.stream_reduce = True
+        self._gather_file = None
+
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
 
-        # get the last iteration corrected probabilities from last_actdist_file...
-        # TODO: find a way not to read all to memory?
+        # candidate pairs: all the nonzero entries in the upper triangle of the input matrix
+        row   = input_matrix.row.astype(np.int64)
+        col   = input_matrix.col.astype(np.int64)
+        pwish = input_matrix.data.astype(np.float64)
+
+        chrom = np.asarray(input_matrix.chrom)
+        intra = chrom[row] == chrom[col]
+
+        keep_intra = np.zeros(len(row), dtype=bool)
+        keep_inter = np.zeros(len(row), dtype=bool)
+        if intra_sigma is not False:
+            keep_intra = intra & (pwish >= intra_sigma)
+        if inter_sigma is not False:
+            keep_inter = ~intra & (pwish >= inter_sigma)
+        n_keep_intra = np.count_nonzero(keep_intra)
+        n_keep_inter = np.count_nonzero(keep_inter)
+
+        keep  = keep_intra | keep_inter
+        row   = row[keep]
+        col   = col[keep]
+        pwish = pwish[keep]
+
+        # get the last iteration corrected probabilities from last_actdist_file, and
+        # join them to the candidates on the (row, col) key
         if last_actdist_file is not None:
-            with h5py.File(last_actdist_file) as h5f:   #-- NB: to get keys, one can use h5f.keys()
-                row = h5f["row"][()]
-                col = h5f["col"][()]
-                ii = np.logical_and(row < n, col < n)
-                row = row[ii]
-                col = col[ii]
-                data = h5f["prob"][ii][()]
-
-                plast = scipy.sparse.coo_matrix(
-                    (data, (row, col)),
-                    shape=input_matrix.shape
-                ).tolil()
+            with h5py.File(last_actdist_file, 'r') as h5f:   #-- NB: to get keys, one can use h5f.keys()
+                last_row = h5f["row"][()].astype(np.int64)
+                last_col = h5f["col"][()].astype(np.int64)
+                last_prob = h5f["prob"][()].astype(np.float64)
+            plast = get_last_probabilities(row, col, last_row, last_col, last_prob, n)
         else:
             # ... if there are no corrected probabilities from last iteration (aka, the current iteration is the first iteration)
-            # initialize empty sparse lil matrix
-            plast = scipy.sparse.lil_matrix(input_matrix.shape)
-
-        # initialize parameters for batch processing
-        n_args_batches = 0
-        k = 0
-        curr_batch = []
-        chrom = contact_matrix.index.chrom
-        n_keep_intra = 0
-        n_keep_inter = 0
-
-        # prepare batches by mapping the plast matrix into a number of .in.npy files
-        for i, j, pwish in input_matrix.coo_generator():
-            keep1 = (intra_sigma is not False) and (chrom[i] == chrom[j]) and (pwish >= intra_sigma)
-            keep2 = (inter_sigma is not False) and (chrom[i] != chrom[j]) and (pwish >= inter_sigma)
-            n_keep_intra += keep1
-            n_keep_inter += keep2
-            if keep1 or keep2:
-                curr_batch.append((i, j, pwish, plast[i, j]))
-                k += 1
-
-            # if one batch is completed, save to file, reset increment k to 0, augment number of batches
-            if k == batch_size:
-                fname = os.path.join(self.tmp_dir, '%d.in.npy' % n_args_batches)
-                np.save(fname, curr_batch)
-                k = 0
-                n_args_batches += 1
-                curr_batch = []
-        # save to file
-        fname = os.path.join(self.tmp_dir, '%d.in.npy' % n_args_batches)
-        np.save(fname, curr_batch)
-        n_args_batches += 1
+            plast = np.zeros(len(row))
+
+        params = np.empty(len(row), dtype=actdist_params_shape)
+        params['row'] = row
+        params['col'] = col
+        params['pwish'] = pwish
+        params['plast'] = plast
+
+        # split the candidates into batches of similar cost, and save each one of them to a .in.npy file.
+        # The cost of a pair is the number of distances to compute: intra pairs use the
+        # (i, j), (i', j') combinations only, inter pairs all of them
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            n_copies = copy_numbers(hss.index.copy_index)
+            n_struct = hss.nstruct
+        n_comb = np.where(chrom[row] == chrom[col],
+                          np.minimum(n_copies[row], n_copies[col]),
+                          n_copies[row] * n_copies[col])
+        costs = n_comb * n_struct
+        self.cost_model = BatchCostModel(self.cfg, 'Hi-C')
+        bounds = self.cost_model.partition(costs, batch_size)
+        if len(bounds) == 1:
+            bounds = np.zeros(2, dtype=np.int64)
+        self.batch_costs = batch_costs(costs, bounds)
+
+        n_args_batches = len(bounds) - 1
+        for b in range(n_args_batches):
+            fname = os.path.join(self.tmp_dir, '%d.in.npy' % b)
+            np.save(fname, params[bounds[b]:bounds[b + 1]])
 
         # this list [0, 1, ..., n_args_batches] will be passed as a parameter
         self.argument_list = range(n_args_batches)
@@ -193,61 +246,143 @@ class ActivationDistanceStep(Step):
 
         """ Compute activation distances for batch identified by parameter batch_id """
 
-        dictHiC = cfg['restraints']['Hi-C']
-        hss     = HssFile(cfg.get("optimization/structure_output"), 'r')
+        start_time = time.time()
+        dictHiC   = cfg['restraints']['Hi-C']
+        tile_size = dictHiC.get('tile_size', 64)
 
         # read params
         fname   = os.path.join(tmp_dir, '%d.in.npy' % batch_id)
         params  = np.load(fname)
 
-        # initialize result list
-        results = []
-
-        # compute activation distances for all pairs of locus indexes, append to "results" list
-        for i, j, pwish, plast in params:
-            res = get_actdist(
-                int(i), int(j), pwish, plast, hss,
-                contactRange=dictHiC.get('contact_range', 2.0)
+        # initialize result lists
+        results = [np.empty(0, dtype=actdist_shape)]
+        frequencies = [np.empty(0, dtype=pnow_shape)]
+        assigned_rows = [np.empty(0, dtype=np.int64)]
+        assigned_structs = [np.empty(0, dtype=np.int64)]
+        n_rows = 0
+
+        # compute activation distances for all pairs of locus indexes, one tile of pairs at a time
+        with HssFile(cfg.get("optimization/structure_output"), 'r') as hss:
+            index = hss.index
+            radii = hss.radii
+            crd   = get_population_coordinates(hss, cfg)
+
+            for start in range(0, len(params), tile_size):
+                tile = params[start:start + tile_size]
+                res, pnow, (r, s) = get_actdist_tile(
+                    tile['row'], tile['col'], tile['pwish'], tile['plast'],
+                    crd, radii, index.copy_index, index.chrom,
+                    contactRange=dictHiC.get('contact_range', 2.0),
+                    return_pnow=True, return_assignment=True
+                )
+                results.append(res)  # (i, j, actdist, p)
+
+                # structures each restraint is assigned to, decided on the coordinates read for the tile
+                assigned_rows.append(r + n_rows)
+                assigned_structs.append(s)
+                n_rows += len(res)
+
+                # keep the population contact frequency of each (i, j) pair
+                freq = np.empty(len(tile), dtype=pnow_shape)
+                freq['row'] = tile['row']
+                freq['col'] = tile['col']
+                freq['pnow'] = pnow
+                frequencies.append(freq[freq['row'] != freq['col']])
+
+            results = np.concatenate(results)
+            frequencies = np.concatenate(frequencies)
+            by_struct, indptr = struct_assignment_layout(
+                results, np.concatenate(assigned_rows), np.concatenate(assigned_structs), crd.shape[1]
             )
 
-            for r in res:
-                results.append(r)  # (i, j, actdist, p)
-            # -
-
-        hss.close()
-
-        # save activation distances from current batch to a batch-unique output file, using format specifier 'actdist_fmt_str'
-        fname = os.path.join(tmp_dir, '%d.out.tmp' % batch_id)
-        with open(fname, 'w') as f:
-            f.write('\n'.join([actdist_fmt_str % x for x in results]))
-
-
+        # save activation distances from current batch to a batch-unique binary output file
+        fname = os.path.join(tmp_dir, '%d.out.npy' % batch_id)
+        save_npy_batch(fname, results)
+        fname = os.path.join(tmp_dir, '%d.pnow.npy' % batch_id)
+        save_npy_batch(fname, frequencies)
+        fname = os.path.join(tmp_dir, '%d.bystruct.npy' % batch_id)
+        save_npy_batch(fname, by_struct)
+        fname = os.path.join(tmp_dir, '%d.bystruct_indptr.npy' % batch_id)
+        save_npy_batch(fname, indptr)
+
+        record_task_time(tmp_dir, batch_id, start_time)
+
+
+
+    def gather(self, batch_id, result):
+
+        """ Append the output of a completed batch to the temporary hdf5 'actdist' file """
+
+        h5f = self.get_gather_file()
+        fname = os.path.join(self.tmp_dir, '%d.out.npy' % batch_id)
+        h5_append_columns(h5f, np.load(fname))
+        fname = os.path.join(self.tmp_dir, '%d.pnow.npy' % batch_id)
+        h5_append_columns(h5f['pnow'], np.load(fname))
+
+    def get_gather_file(self):
+
+        """ Open (once) the temporary hdf5 file where batch outputs are gathered """
+
+        if self._gather_file is None:
+            tmp_actdist_file = os.path.join(self.tmp_dir, "actdist.hdf5.tmp")
+            self._gather_file = h5py.File(tmp_actdist_file, "w")
+            h5_append_columns(self._gather_file, np.empty(0, dtype=actdist_shape))
+            h5_append_columns(self._gather_file.create_group('pnow'), np.empty(0, dtype=pnow_shape))
+        return self._gather_file
+
+    def write_struct_layout(self, grp, n_struct):
+
+        """
+        Merge the per-structure restraint lists of all batches into a CSR layout:
+        the restraints of structure s are row/col/dist[indptr[s]:indptr[s+1]].
+        Structures are processed in blocks, so that only a slice of each batch
+        output is read at a time.
+        """
+
+        fnames = [os.path.join(self.tmp_dir, '%d.bystruct.npy' % i) for i in self.argument_list]
+        indptrs = np.array([
+            np.load(os.path.join(self.tmp_dir, '%d.bystruct_indptr.npy' % i))
+            for i in self.argument_list
+        ]).reshape(-1, n_struct + 1)
+
+        counts = np.sum(np.diff(indptrs, axis=1), axis=0)
+        indptr = np.zeros(n_struct + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+        n = int(indptr[-1])
+
+        grp.create_dataset('indptr', data=indptr)
+        dsets = {
+            k: grp.create_dataset(k, shape=(n,), dtype=dict(struct_restraint_shape)[k])
+            for k, _ in struct_restraint_shape
+        }
+
+        s0 = 0
+        while s0 < n_struct:
+            # take as many structures as fit in a block (at least one)
+            s1 = max(s0 + 1, int(np.searchsorted(indptr, indptr[s0] + STRUCT_MERGE_SIZE, side='right')) - 1)
+            s1 = min(s1, n_struct)
+            parts = []
+            structs = []
+            for fname, bptr in zip(fnames, indptrs):
+                if bptr[s1] == bptr[s0]:
+                    continue
+                batch = np.load(fname, mmap_mode='r')
+                parts.append(np.array(batch[bptr[s0]:bptr[s1]]))
+                structs.append(np.repeat(np.arange(s0, s1), np.diff(bptr[s0:s1 + 1])))
+            if len(parts):
+                parts = np.concatenate(parts)
+                order = np.argsort(np.concatenate(structs), kind='stable')
+                parts = parts[order]
+                for k, _ in struct_restraint_shape:
+                    dsets[k][indptr[s0]:indptr[s1]] = parts[k]
+            s0 = s1
 
     def reduce(self):
 
-        """ Concatenate data from all batches into a single hdf5 'actdist' file """
+        """ Finalize the hdf5 'actdist' file with the data gathered from all batches """
 
         actdist_file      = os.path.join(self.tmp_dir, "actdist.hdf5")
         last_actdist_file = self.cfg['runtime']['Hi-C'].get("actdist_file", None)
-        row = []
-        col = []
-        dist = []
-        prob = []
-
-        # poll all files and strap them together into a single file output
-        for i in tqdm(self.argument_list, desc='(REDUCE)'):
-
-            fname           = os.path.join(self.tmp_dir, '%d.out.tmp' % i)
-            partial_actdist = np.genfromtxt(fname, dtype=actdist_shape)
-
-            if partial_actdist.ndim == 0:
-                partial_actdist = np.array([partial_actdist], dtype=actdist_shape)
-
-            row.append(partial_actdist['row'])
-            col.append(partial_actdist['col'])
-            dist.append(partial_actdist['dist'])
-            prob.append(partial_actdist['prob'])
-        #-
 
         # build suffix to append to actdist file (code does not overwrite actdist files)
         additional_data = []
@@ -273,13 +408,20 @@ class ActivationDistanceStep(Step):
         # this is the activation distance tmp file storing the information about the currect act step
         tmp_actdist_file = actdist_file + '.tmp'
 
-        # concatenate all the information and saeve to file
-        with h5py.File(tmp_actdist_file, "w") as h5f:
-            h5f.create_dataset("row",  data=np.concatenate(row))
-            h5f.create_dataset("col",  data=np.concatenate(col))
-            h5f.create_dataset("dist", data=np.concatenate(dist))
-            h5f.create_dataset("prob", data=np.concatenate(prob))
-        # -
+        # all the batch outputs have been gathered into the temporary file, one dataset per column.
+        # Record which population and contact range the contact frequencies refer to,
+        # so that they are reused only when still valid (see utils.actdist.read_pnow_matrix)
+        h5f = self.get_gather_file()
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            h5f['pnow'].attrs['population'] = population_fingerprint(hss)
+            n_struct = hss.nstruct
+        h5f['pnow'].attrs['contact_range'] = self.cfg.get('restraints/Hi-C/contact_range', 2.0)
+        h5f['pnow'].attrs['shape'] = (self.matrix_size, self.matrix_size)
+
+        # merge the per-structure restraint lists
+        self.write_struct_layout(h5f.create_group('by_struct'), n_struct)
+        h5f.close()
+        self._gather_file = None
 
         swapfile = os.path.realpath('.'.join([actdist_file, ] + additional_data))
         if last_actdist_file is not None:
@@ -289,6 +431,9 @@ class ActivationDistanceStep(Step):
         # update runtime entry in dictionary, for next iteration/step
         self.cfg['runtime']['Hi-C']["actdist_file"] = actdist_file
 
+        # use the measured task durations for the next partitions
+        self.cost_model.update(self.batch_costs, self.tmp_dir)
+
     def skip(self):
         '''
         Fix the dictionary values when already completed
@@ -459,6 +604,341 @@ def get_actdist(i, j, pwish, plast, hss, contactRange=2, option=0):
     return res
 
 
+
+def get_last_probabilities(row, col, last_row, last_col, last_prob, n):
+
+    '''
+    Lookup of the previous iteration corrected probabilities for a set of pairs.
+
+    Entries of the last activation distances file are restricted to the first
+    n x n block and duplicate (row, col) entries are summed, as in a scipy
+    sparse matrix. The pairs are then joined on the row * n + col key with a
+    binary search.
+
+    Returns
+    -------
+        np.ndarray (float) of len(row) probabilities, 0 if the pair was not
+        present in the last file
+    '''
+
+    ii = (last_row < n) & (last_col < n)
+    last_keys = last_row[ii] * n + last_col[ii]
+    last_prob = last_prob[ii]
+
+    last_keys, inverse = np.unique(last_keys, return_inverse=True)
+    last_prob = np.bincount(inverse, weights=last_prob, minlength=len(last_keys))
+
+    plast = np.zeros(len(row))
+    if len(last_keys) == 0:
+        return plast
+
+    keys = np.asarray(row, dtype=np.int64) * n + np.asarray(col, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(last_keys, keys), len(last_keys) - 1)
+    found = last_keys[pos] == keys
+    plast[found] = last_prob[pos[found]]
+    return plast
+
+
+
+def get_actdist_tile(ii, jj, pwish, plast, crd, radii, copy_index, chrom, contactRange=2, option=0,
+                     return_pnow=False, return_assignment=False, use_compiled=True):
+
+    '''
+    Vectorized version of `get_actdist`, working on a tile of candidate pairs at once.
+
+    All the beads involved in the tile are read only once from the (bead-major) coordinates
+    into a contiguous float32 block. Pairs are then grouped by "signature" (number of copies
+    of i and j, intra/inter), and for each group all the copy-combination squared distances
+    are computed with numpy broadcasting. The activation distance is selected with a partial
+    sort (np.partition) instead of a full sort. If the compiled kernel
+    (igm.cython_compiled.actdist) is available, distances, counts and quantiles
+    are computed by it for the whole tile instead.
+
+    Parameters
+    ----------
+        ii, jj : np.ndarray (int)
+            indexes of the first, second locus for each pair in the tile
+        pwish : np.ndarray (float)
+            target contact probabilities
+        plast : np.ndarray (float)
+            the last refined probabilities (from previous iteration)
+        crd : h5py.Dataset or np.ndarray
+            bead-major coordinates (n_bead x n_struct x 3), e.g. hss['coordinates']
+        radii : np.ndarray
+            bead radii
+        copy_index, chrom :
+            as in alabtools.utils.Index
+        contactRange : int
+            contact range of sum of radius of beads
+        option : int
+            calculation option, see `get_actdist`
+        return_pnow : bool
+            if True, also return the population contact frequencies
+        return_assignment : bool
+            if True, also return the structures each row is assigned to (see
+            `assign_structures`), tested on the coordinates already read for the tile
+        use_compiled : bool
+            use the compiled kernel, if available
+
+    Returns
+    -------
+        np.ndarray with dtype `actdist_shape`, containing the same (i, j, ad, p) rows
+        (and in the same order) `get_actdist` would return for each pair in the tile.
+        If return_pnow is set, a second array contains the population contact
+        frequency of each pair in the tile (0 for i == j).
+        If return_assignment is set, a last (rows, structs) tuple contains the
+        assigned (row index, structure) entries.
+    '''
+
+    from ..utils.files import read_bead_block
+
+    ii = np.asarray(ii, dtype=np.int64)
+    jj = np.asarray(jj, dtype=np.int64)
+    pwish = np.asarray(pwish, dtype=np.float64)
+    plast = np.asarray(plast, dtype=np.float64)
+    n_pairs = len(ii)
+
+    # per pair: bead combinations used for distances, and bead combinations to emit
+    dist_combinations = [None] * n_pairs
+    emit_combinations = [None] * n_pairs
+    groups = {}
+    for q in range(n_pairs):
+        i, j = int(ii[q]), int(jj[q])
+        # there is no contact between i and i
+        if i == j:
+            continue
+        ci, cj = copy_index[i], copy_index[j]
+        intra = chrom[i] == chrom[j]
+        if intra:
+            dist_combinations[q] = list(zip(ci, cj))
+        else:
+            dist_combinations[q] = [(k, m) for k in ci for m in cj]
+        if intra and option == 0:
+            emit_combinations[q] = list(zip(ci, cj))
+        else:
+            emit_combinations[q] = [(k, m) for k in ci for m in cj]
+        groups.setdefault((len(ci), len(cj), intra), []).append(q)
+
+    def tile_result(out, pnow, assignment):
+        ret = (out,)
+        if return_pnow:
+            ret += (pnow,)
+        if return_assignment:
+            ret += (assignment,)
+        return ret if len(ret) > 1 else out
+
+    out = np.empty(0, dtype=actdist_shape)
+    pnow_all = np.zeros(n_pairs)
+    no_assignment = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    if len(groups) == 0:
+        return tile_result(out, pnow_all, no_assignment)
+
+    # read each bead row once (also the emitted ones, used to assign the restraints to structures)
+    qs = [q for g in groups.values() for q in g]
+    beads = np.concatenate([np.ravel(dist_combinations[q]) for q in qs] +
+                           ([np.ravel(emit_combinations[q]) for q in qs] if return_assignment else []))
+    beads, block = read_bead_block(crd, beads)
+    n_struct = block.shape[1]
+
+    if use_compiled and get_actdist_batch is not None:
+        activation_distance, p, pnow_all = _get_actdist_compiled(
+            dist_combinations, pwish, plast, beads, block, radii, contactRange
+        )
+        groups = {}
+    else:
+        activation_distance = np.zeros(n_pairs)
+        p = np.zeros(n_pairs)
+
+    for g in groups.values():
+        g = np.array(g)
+        combs = np.array([dist_combinations[q] for q in g])   # (G, C, 2)
+        n_possible_contacts = combs.shape[1]
+        n_tot = n_possible_contacts * n_struct
+        kk = np.searchsorted(beads, combs[:, :, 0])
+        mm = np.searchsorted(beads, combs[:, :, 1])
+
+        # all squared distances, (G, C * n_struct)
+        d_sq = np.sum(np.square(block[kk] - block[mm]), axis=-1)
+        d_sq = d_sq.reshape(len(g), n_tot).astype(np.float64)
+
+        ri = radii[combs[:, 0, 0]]
+        rj = radii[combs[:, 0, 1]]
+        rcutsq = np.square(contactRange * (ri + rj))
+
+        # population contact frequency
+        contact_count = np.count_nonzero(d_sq <= rcutsq[:, None], axis=1)
+        pnow = contact_count / n_tot
+        pnow_all[g] = pnow
+
+        # iterative correction (see cleanProbability)
+        t = cleanProbabilities(pnow, plast[g])
+        pg = cleanProbabilities(pwish[g], t)
+
+        o = np.minimum(n_tot - 1, np.rint(n_tot * pg).astype(np.int64))
+        for r in np.flatnonzero(pg > 0):
+            activation_distance[g[r]] = np.sqrt(np.partition(d_sq[r], o[r])[o[r]])
+        p[g] = pg
+
+    # emit the rows in the original order
+    keep = [q for q in range(n_pairs) if emit_combinations[q] is not None and p[q] > 0]
+    if len(keep) == 0:
+        return tile_result(out, pnow_all, no_assignment)
+    n_rows = [len(emit_combinations[q]) for q in keep]
+    out = np.empty(sum(n_rows), dtype=actdist_shape)
+    pairs = np.concatenate([emit_combinations[q] for q in keep])
+    out['row'] = pairs[:, 0]
+    out['col'] = pairs[:, 1]
+    out['dist'] = np.repeat(activation_distance[keep], n_rows)
+    out['prob'] = np.repeat(p[keep], n_rows)
+    if return_assignment:
+        return tile_result(out, pnow_all, assign_structures(out, beads, block))
+    return tile_result(out, pnow_all, no_assignment)
+
+
+
+def _get_actdist_compiled(dist_combinations, pwish, plast, beads, block, radii, contactRange):
+
+    """ Flatten the copy combinations of a tile and run the compiled kernel on it """
+
+    n_comb = [0 if c is None else len(c) for c in dist_combinations]
+    comb_ptr = np.zeros(len(n_comb) + 1, dtype=np.int64)
+    comb_ptr[1:] = np.cumsum(n_comb)
+    combs = np.concatenate([c for c in dist_combinations if c is not None])
+    comb_k = np.searchsorted(beads, combs[:, 0]).astype(np.int64)
+    comb_m = np.searchsorted(beads, combs[:, 1]).astype(np.int64)
+
+    # same rounding as in the numpy version
+    first = comb_ptr[:-1].copy()
+    valid = comb_ptr[1:] > first
+    first[~valid] = 0
+    ri = radii[combs[first, 0]]
+    rj = radii[combs[first, 1]]
+    rcutsq = np.square(contactRange * (ri + rj)).astype(np.float64)
+
+    return get_actdist_batch(block, comb_ptr, comb_k, comb_m, rcutsq,
+                             np.ascontiguousarray(pwish), np.ascontiguousarray(plast))
+
+
+
+def assign_structures(actdist, beads, block, chunk_size=256):
+
+    '''
+    Structures each activation distance restraint is applied to.
+
+    A Hi-C restraint (i, j, d) is assigned to a structure if the distance
+    between beads i and j in that structure is not larger than the activation
+    distance d. The test is the same performed by the Hi-C restraints on the
+    starting coordinates of the modeling step, done here for all the structures
+    at once. Entries within a relative STRUCT_ASSIGNMENT_MARGIN of d are kept as
+    well, so that rounding differences never drop a restraint.
+
+    Parameters
+    ----------
+        actdist : np.ndarray
+            activation distances, with dtype `actdist_shape`
+        beads, block :
+            sorted bead indexes and their (len(beads), n_struct, 3) coordinates,
+            as returned by `read_bead_block`; must contain all the beads of actdist
+        chunk_size : int
+            number of restraints processed at once
+
+    Returns
+    -------
+        rows, structs : np.ndarray
+            the assigned entries, as (index in actdist, structure) pairs
+    '''
+
+    rows = [np.empty(0, dtype=np.int64)]
+    structs = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(actdist), chunk_size):
+        chunk = actdist[start:start + chunk_size]
+        x = block[np.searchsorted(beads, chunk['row'])]
+        y = block[np.searchsorted(beads, chunk['col'])]
+        # keep a small margin for rounding: the exact test on the particle distances
+        # is repeated by the restraints, only on the assigned entries
+        d = np.linalg.norm(x - y, axis=2)   # (chunk, n_struct)
+        r, s = np.nonzero(d <= chunk['dist'][:, None] * (1 + STRUCT_ASSIGNMENT_MARGIN))
+        rows.append(r + start)
+        structs.append(s)
+    return np.concatenate(rows), np.concatenate(structs)
+
+
+
+def struct_assignment_layout(actdist, rows, structs, n_struct):
+
+    '''
+    Sort the assigned (row, structure) entries by structure.
+
+    Returns
+    -------
+        restraints : np.ndarray
+            the assigned (row, col, dist) entries, sorted by structure, with
+            dtype `struct_restraint_shape`
+        indptr : np.ndarray
+            (n_struct + 1) array, restraints of structure s are in
+            restraints[indptr[s]:indptr[s+1]]
+    '''
+
+    order = np.argsort(structs, kind='stable')
+    rows = rows[order]
+
+    restraints = np.empty(len(rows), dtype=struct_restraint_shape)
+    for k, _ in struct_restraint_shape:
+        restraints[k] = actdist[k][rows]
+
+    indptr = np.zeros(n_struct + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(structs, minlength=n_struct))
+    return restraints, indptr
+
+
+
+def get_struct_assignments(actdist, crd, chunk_size=256):
+
+    '''
+    Pre-resolve the structures each activation distance restraint is applied
+    to (see `assign_structures`), reading the coordinates of the beads of
+    each chunk of restraints. The activation distance step assigns the
+    restraints of each tile from the coordinates it already read instead.
+
+    Parameters
+    ----------
+        actdist : np.ndarray
+            activation distances, with dtype `actdist_shape`
+        crd : h5py.Dataset or np.ndarray
+            bead-major coordinates (n_bead x n_struct x 3)
+        chunk_size : int
+            number of restraints processed at once
+
+    Returns
+    -------
+        restraints, indptr :
+            see `struct_assignment_layout`
+    '''
+
+    from ..utils.files import read_bead_block
+
+    rows = [np.empty(0, dtype=np.int64)]
+    structs = [np.empty(0, dtype=np.int64)]
+    for start in range(0, len(actdist), chunk_size):
+        chunk = actdist[start:start + chunk_size]
+        beads, block = read_bead_block(crd, np.concatenate([chunk['row'], chunk['col']]))
+        r, s = assign_structures(chunk, beads, block, chunk_size)
+        rows.append(r + start)
+        structs.append(s)
+
+    return struct_assignment_layout(actdist, np.concatenate(rows), np.concatenate(structs), crd.shape[1])
+
+
+
+def cleanProbabilities(pij, pexist):
+
+    """ Vectorized version of cleanProbability """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pclean = np.where(pexist < 1, (pij - pexist) / (1.0 - pexist), pij)
+    return np.maximum(0, pclean)
+
+
 # this seems to be DEPRECATED, not used
 def newton_prob(p_wish, x_now, x_last, p_now, p_last):
     # value of the functions
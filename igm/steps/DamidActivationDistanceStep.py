@@ -10,11 +10,15 @@ import numpy as np
 import h5py
 import os
 import os.path
+import time
 
 from alabtools.analysis import HssFile
 
 from ..core import Step
 from ..utils.log import logger
+from ..utils.files import save_npy_batch, h5_append_columns
+from ..utils.population_cache import get_population_coordinates
+from ..parallel.partition import BatchCostModel, batch_costs, copy_numbers, record_task_time
 
 try:
     # python 2 izip
@@ -121,6 +125,10 @@ class DamidActivationDistanceStep(Step):
         self.set_tmp_path()
         self.keep_temporary_files = self.cfg.get("restraints/DamID/keep_temporary_files", False)
 
+        # batch outputs are collected while the map is still running
+        self.stream_reduce = True
+        self._gather_file = None
+
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
 
@@ -146,15 +154,19 @@ class DamidActivationDistanceStep(Step):
             last_prob = {}
             logger.info('Creating new damid actdist file...')
 
-        # split the full matrix into batches of size batch_size...each chunk is then saved to a temporary damid.in.npy file
+        # split the loci into batches of similar cost (the number of copies times the number of
+        # structures)...each chunk is then saved to a temporary damid.in.npy file
         batch_size = self.cfg.get('restraints/DamID/batch_size', 100)
-        n_args_batches = len(ii) // batch_size
-        if len(ii) % batch_size != 0:
-            n_args_batches += 1
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            costs = copy_numbers(hss.index.copy_index)[ii] * hss.nstruct
+        self.cost_model = BatchCostModel(self.cfg, 'DamID')
+        bounds = self.cost_model.partition(costs, batch_size)
+        self.batch_costs = batch_costs(costs, bounds)
+        n_args_batches = len(bounds) - 1
 
         for b in range(n_args_batches):
-            start = b * batch_size
-            end = min((b+1) * batch_size, len(ii))
+            start = bounds[b]
+            end = bounds[b + 1]
             params = np.array(
                 [
                     ( ii[k], pwish[k], last_prob.get(ii[k], 0.) )
@@ -173,6 +185,8 @@ class DamidActivationDistanceStep(Step):
 
         """ Read in temporary in.tmp files, generated list of Damid activation distances, produce out.tmp files """
 
+        start_time = time.time()
+
         nucleus_parameters = None
         shape = cfg.get('model/restraints/envelope/nucleus_shape')
         if shape == 'sphere':
@@ -188,6 +202,9 @@ class DamidActivationDistanceStep(Step):
             fname = os.path.join(tmp_dir, '%d.damid.in.npy' % batch_id)
             params = np.load(fname)
 
+            # bead-major coordinates, possibly mapped from the node-local population cache
+            crd = get_population_coordinates(hss, cfg)
+
             # compute the corresponding output to save to out.tmp file
             results = []
             for i, pwish, plast in params:
@@ -195,57 +212,58 @@ class DamidActivationDistanceStep(Step):
                     int(i), pwish, plast, hss,
                     contact_range=cfg.get('restraints/DamID/contact_range', 0.05),
                     shape=shape,
-                    nucleus_param=nucleus_parameters
+                    nucleus_param=nucleus_parameters,
+                    crd=crd
                 )
                 results += res #(i, damid_actdist, p)
             #-
 
-        # save output for this chunk to file, using the format specified by string 'damid_actdist_fmt_str'
-        fname = os.path.join(tmp_dir, '%d.out.tmp' % batch_id)
-        with open(fname, 'w') as f:
-            f.write('\n'.join([damid_actdist_fmt_str % x for x in results]))
+        # save output for this chunk to a binary file, with dtype 'damid_actdist_shape'
+        fname = os.path.join(tmp_dir, '%d.out.npy' % batch_id)
+        save_npy_batch(fname, np.array(results, dtype=damid_actdist_shape))
+
+        record_task_time(tmp_dir, batch_id, start_time)
+
+
+    def gather(self, batch_id, result):
+
+        """ Append the output of a completed batch to the temporary hdf5 damid_actdist file """
+
+        # (also see 'gather' step in ActivationDistanceStep.py) one dataset per column
+        fname = os.path.join(self.tmp_dir, '%d.out.npy' % batch_id)
+        h5_append_columns(self.get_gather_file(), np.load(fname))
+
+
+    def get_gather_file(self):
+
+        """ Open (once) the temporary hdf5 file where batch outputs are gathered """
+
+        if self._gather_file is None:
+            damid_actdist_file = os.path.join(self.tmp_dir, "damid_actdist.hdf5")
+            self._gather_file = h5py.File(damid_actdist_file + '.tmp', "w")
+            h5_append_columns(self._gather_file, np.empty(0, dtype=damid_actdist_shape))
+        return self._gather_file
 
 
     def reduce(self):
 
-        """ Concatenate data from all batches into a single hdf5 damid_actdist file """
+        """ Finalize the hdf5 damid_actdist file with the data gathered from all batches """
 
         # create filename
         damid_actdist_file = os.path.join(self.tmp_dir, "damid_actdist.hdf5")
 
-        # we start with one empty element to avoid errors in np.concatenate
-        # if argument_list is empty
-        loc = [[]]
-        dist = [[]]
-        prob = [[]]
-
-        # (also see 'reduce' step in ActivationDistanceStep.py) Read in all .out.tmp files and concatenate all data into a single
-        # 'damid_actdist_file' file, of type h5df (see 'create-dataset attributes)
-        
-        # concatenate...
-        for i in self.argument_list:
-            
-            fname = os.path.join(self.tmp_dir, '%d.out.tmp' % i)
-            partial_damid_actdist = np.genfromtxt( fname, dtype=damid_actdist_shape )
-            
-            if partial_damid_actdist.ndim == 0:
-                partial_damid_actdist = np.array([partial_damid_actdist], dtype=damid_actdist_shape)
-
-            loc.append( partial_damid_actdist['loc'])
-            dist.append(partial_damid_actdist['dist'])
-            prob.append(partial_damid_actdist['prob'])
-
-        #... write to tmp damid actdist file
-        with h5py.File(damid_actdist_file + '.tmp', "w") as h5f:
-            h5f.create_dataset("loc", data=np.concatenate(loc))
-            h5f.create_dataset("dist", data=np.concatenate(dist))
-            h5f.create_dataset("prob", data=np.concatenate(prob))
+        # all the batch outputs have been gathered into the temporary file
+        self.get_gather_file().close()
+        self._gather_file = None
 
         os.rename(damid_actdist_file + '.tmp', damid_actdist_file)
 
         # ... update runtime parameter for next iteration/sigma value
         self.cfg['runtime']['DamID']["damid_actdist_file"] = damid_actdist_file
 
+        # use the measured task durations for the next partitions
+        self.cost_model.update(self.batch_costs, self.tmp_dir)
+
 
 
     def skip(self):
@@ -282,7 +300,7 @@ def cleanProbability(pij, pexist):
 
 
 
-def get_damid_actdist(locid, pwish, plast, hss, contact_range=0.05, shape="sphere", nucleus_param=5000.0):
+def get_damid_actdist(locid, pwish, plast, hss, contact_range=0.05, shape="sphere", nucleus_param=5000.0, crd=None):
     """
     Serial function to compute the damid activation distance for a locus.
 
@@ -302,6 +320,9 @@ def get_damid_actdist(locid, pwish, plast, hss, contact_range=0.05, shape="spher
             shape of the envelope
         nucleus_param : variable
             parameters for the envelope (probably this will need restructuring in the future)
+        crd : np.ndarray or h5py.Dataset, optional
+            bead-major coordinates to read from instead of the hss file
+            (e.g. a memmap of the population cache)
 
     Returns
     -------
@@ -326,7 +347,7 @@ def get_damid_actdist(locid, pwish, plast, hss, contact_range=0.05, shape="spher
     d_sq = np.empty(n_copies*n_struct)
 
     for i in range(n_copies):
-        x = hss.get_bead_crd( ii[ i ] )
+        x = hss.get_bead_crd( ii[ i ] ) if crd is None else crd[ ii[ i ] ]
         R = np.array(nucleus_param)*(1 - contact_range)
         d_sq[ i*n_struct:(i+1)*n_struct ] = snormsq[shape](x, R, r)
     #=
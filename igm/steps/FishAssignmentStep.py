@@ -12,12 +12,15 @@ import h5py
 import os
 import os.path
 import shutil
+import time
 from tqdm import tqdm
 
 from alabtools.analysis import HssFile
 
 from ..core import Step
 from ..utils.log import logger
+from ..utils.population_cache import get_population_coordinates
+from ..parallel.partition import BatchCostModel, batch_costs, record_task_time
 
 try:
     # python 2 izip
@@ -131,13 +134,22 @@ class FishAssignmentStep(Step):
 
         self.keep_temporary_files = self.cfg.get("restraints/FISH/keep_temporary_files", False)
 
+        # batch outputs are collected while the map is still running
+        self.stream_reduce = True
+        self._target_dists = None
+
         # create folder
         if not os.path.exists(self.tmp_dir):
             os.makedirs(self.tmp_dir)
 
-        # batch size and initialize empty batch list
+        # batch size and initialize empty batch list. Batches are cut to a similar cost: each pair
+        # needs the 4 diploid distances, each probe the 2 radial ones, in all the structures
         batch_size = self.cfg.get('restraints/FISH/batch_size')
         batches = []
+        costs = []
+        self.cost_model = BatchCostModel(self.cfg, 'FISH')
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            n_struct = hss.nstruct
 
         fish_input_file = self.cfg.get('restraints/FISH/input_fish')
        
@@ -150,15 +162,23 @@ class FishAssignmentStep(Step):
                  logger.info('pairs are in FISH input!')
                  pairs = h5['pairs'][()]
         
-                 for i in range(0, len(pairs), batch_size):
-                      batches.append((len(batches), 'pair', pairs[i: i+batch_size]))
+                 pair_costs = np.full(len(pairs), 4.0 * n_struct)
+                 bounds = self.cost_model.partition(pair_costs, batch_size)
+                 for b in range(len(bounds) - 1):
+                      batches.append((len(batches), 'pair', pairs[bounds[b]:bounds[b + 1]]))
+                 costs.append(batch_costs(pair_costs, bounds))
 
             if 'probes' in dict_entries:
                  logger.info('probes are in FISH input')
                  probes = h5['probes'][()]
         
-                 for i in range(0, len(probes), batch_size):
-                      batches.append((len(batches), 'probe', probes[i: i+batch_size]))
+                 probe_costs = np.full(len(probes), 2.0 * n_struct)
+                 bounds = self.cost_model.partition(probe_costs, batch_size)
+                 for b in range(len(bounds) - 1):
+                      batches.append((len(batches), 'probe', probes[bounds[b]:bounds[b + 1]]))
+                 costs.append(batch_costs(probe_costs, bounds))
+
+        self.batch_costs = np.concatenate([np.empty(0)] + costs)
 
         self.argument_list = batches
 
@@ -166,6 +186,7 @@ class FishAssignmentStep(Step):
     @staticmethod
     def task(batch, cfg, tmp_dir):
 
+        start_time = time.time()
 
         # initialize empty dictionary to be populated later in loop
         fish_restr = {'pair_min': [], 'radial_min' : [] , 'pair_max': [], 'radial_max' : [] }
@@ -173,7 +194,7 @@ class FishAssignmentStep(Step):
         
         # read in population file and extract coordinates
         hss = HssFile(cfg.get("optimization/structure_output"), 'r')
-        crd = hss['coordinates']
+        crd = get_population_coordinates(hss, cfg)
     
         # number of configurations, number of domains
         n_conf = crd.shape[1]
@@ -265,10 +286,62 @@ class FishAssignmentStep(Step):
                              radial_max = np.array(fish_restr['radial_max'])      
                )
 
+        record_task_time(tmp_dir, batch_id, start_time)
+
+
+    def get_target_dists(self):
+
+        """ Initialize (once) the lists of target distances for all pairs and probes """
+
+        if self._target_dists is None:
+
+            # again, read in pairs and probes
+            n_pairs, n_probes = 0, 0
+            with h5py.File(self.cfg.get('restraints/FISH/input_fish'), 'r') as h5:
+
+                dict_entries = list(h5.keys())
+
+                if 'pairs' in dict_entries:
+                    n_pairs = len(h5['pairs'])
+
+                if 'probes' in dict_entries:
+                    n_probes = len(h5['probes'])
+
+            self._target_dists = (
+                [None] * n_pairs,     # pair_min
+                [None] * n_pairs,     # pair_max
+                [None] * n_probes,    # radial_min
+                [None] * n_probes     # radial_max
+            )
+
+        return self._target_dists
+
+
+    def gather(self, batch, result):
+
+        """ Read the auxiliary file of a completed batch, and fill in the target distances """
+
+        batch_id = batch[0]
+        minpairdists, maxpairdists, minraddists, maxraddists = self.get_target_dists()
+
+        # load auxiliary files and fill in lists
+        auxiliary_file = os.path.join(self.tmp_dir, 'tmp.%d.fish_targeting.npz' % batch_id)
+
+        t = np.load(auxiliary_file, allow_pickle=True)
+
+        for pair_index, dists in t['pair_min']:
+            minpairdists[pair_index] = dists
+        for pair_index, dists in t['pair_max']:
+            maxpairdists[pair_index] = dists
+        for probe_index, dists in t['radial_min']:
+            minraddists[probe_index] = dists
+        for probe_index, dists in t['radial_max']:
+            maxraddists[probe_index] = dists
+
 
     def reduce(self):
 
-        """ Concatenate data from all batches into a single hdf5 fish_actdist file """
+        """ Write the data gathered from all batches into a single hdf5 fish_actdist file """
 
         # build suffix to append to actdist file (code does not overwrite actdist files)
         additional_data = []
@@ -291,48 +364,10 @@ class FishAssignmentStep(Step):
         last_actdist_file = self.cfg['runtime']['FISH'].get("fish_assignment_file", None)
 
 
-        # again, read in pairs and probes
-        fish_input_file = self.cfg.get('restraints/FISH/input_fish')
-        with h5py.File(fish_input_file, 'r') as h5:
-
-            dict_entries = list(h5.keys())
-
-            if 'pairs' in dict_entries:
-
-                   pairs   = h5['pairs'][()]
-                   n_pairs = len(pairs)
-
-                   minpairdists = [None] * n_pairs
-                   maxpairdists = [None] * n_pairs
-
-            if 'probes' in dict_entries:
-
-                   probes = h5['probes'][()]
-                   n_probes = len(probes)
-
-                   minraddists = [None] * n_probes
-                   maxraddists = [None] * n_probes
-
-        # (also see 'reduce' step in ActivationDistanceStep.py) Read in all *fish.npz files and concatenate all data into a single
-        # 'fish_actdist_file' file, of type h5df (see 'create-dataset attributes)
- 
-        # concatenate: loop over chunks
-        for batch_id, _, _  in self.argument_list:
-            
-            # load auxiliary files and fill in lists
-            auxiliary_file = os.path.join(self.tmp_dir, 'tmp.%d.fish_targeting.npz' % batch_id)
- 
-            t = np.load(auxiliary_file, allow_pickle=True)
-
-            for pair_index, dists in t['pair_min']:
-                minpairdists[pair_index] = dists
-            for pair_index, dists in t['pair_max']:
-                maxpairdists[pair_index] = dists
-            for probe_index, dists in t['radial_min']:
-                minraddists[probe_index] = dists
-            for probe_index, dists in t['radial_max']:
-                maxraddists[probe_index] = dists            
+        # target distances, gathered from all batches
+        minpairdists, maxpairdists, minraddists, maxraddists = self.get_target_dists()
 
+        fish_input_file = self.cfg.get('restraints/FISH/input_fish')
 
         tmp_assignment_file = fish_assignment_file + '.tmp'
 
@@ -344,7 +379,7 @@ class FishAssignmentStep(Step):
                   dict_entries = list(h5.keys())
 
                   if 'pairs' in dict_entries:
-                       o5f.create_dataset('pairs',      data =   pairs,  dtype='i4')
+                       o5f.create_dataset('pairs',      data =   h5['pairs'][()],  dtype='i4')
 
                   if 'pair_min' in dict_entries:
                        o5f.create_dataset('pair_min',   data =  minpairdists,  dtype='f4')
@@ -353,7 +388,7 @@ class FishAssignmentStep(Step):
                        o5f.create_dataset('pair_max',   data =  maxpairdists,  dtype='f4')
 
                   if 'probes' in dict_entries:
-                       o5f.create_dataset('probes',     data =  probes,  dtype='i4')
+                       o5f.create_dataset('probes',     data =  h5['probes'][()],  dtype='i4')
 
                   if 'radial_min' in dict_entries:
                        o5f.create_dataset('radial_min', data =  minraddists,  dtype='f4')
@@ -371,6 +406,8 @@ class FishAssignmentStep(Step):
         # ... update runtime parameter for next iteration/sigma value
         self.cfg['runtime']['FISH']["fish_assignment_file"] = fish_assignment_file
 
+        # use the measured task durations for the next partitions
+        self.cost_model.update(self.batch_costs, self.tmp_dir)
 
     def skip(self):
         """
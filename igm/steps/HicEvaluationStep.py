@@ -17,6 +17,7 @@ from tqdm import tqdm
 from ..core import Step
 from ..utils.files import make_absolute_path
 from ..utils.log import logger
+from ..utils.matrix_cache import load_contact_matrix, input_matrix_cache_dir
 from ..parallel.utils import split_evenly
 # tolerance on contact probabilities
 eps = 0.05
@@ -139,20 +140,22 @@ class HicEvaluationStep(Step):
             plt.savefig( os.path.join(out_dir, 'diffmap_'+ c +'.pdf') )
             plt.close()
 
-        input_matrix = { (i, j): pwish for i, j, pwish in input_matrix.matrix.coo_generator() if pwish >= sigma and i != j}
-        diffs = []
-        reldiffs = []
-        totp = 0
-        for i, j, pout in output_matrix.matrix.coo_generator():
-            p = input_matrix.get( (i, j) )
-            if p is not None:
-                diffs.append(pout-p)
-                reldiffs.append((pout-p)/p)
-                totp += p
+        # restrained pairs (pwish >= sigma, i != j) which are in contact in the output matrix
+        cached = load_contact_matrix(self.cfg.get('restraints/Hi-C/input_matrix'), input_matrix_cache_dir(self.cfg))
+        keep = cached.data >= sigma
+        n = cached.shape[1]
+        input_keys = cached.row[keep].astype(np.int64) * n + cached.col[keep]
+        p_input = cached.data[keep]
+        out = output_matrix.matrix.csr.tocoo()
+        output_keys = out.row.astype(np.int64) * n + out.col
+        pos = np.minimum(np.searchsorted(input_keys, output_keys), max(len(input_keys) - 1, 0))
+        found = (input_keys[pos] == output_keys) if len(input_keys) else np.zeros(len(output_keys), dtype=bool)
+        pout = out.data[found]
+        p = p_input[pos[found]]
         del output_matrix
         del input_matrix
-        diffs = np.array(diffs)
-        reldiffs = np.array(reldiffs)
+        diffs = pout - p
+        reldiffs = diffs / p
 
         f, ax = plt.subplots(2, 2)
         ax[0,0].set_title('Absolute matrix differences')
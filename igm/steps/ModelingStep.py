@@ -13,15 +13,24 @@ from copy import deepcopy
 from shutil import copyfile
 import shutil
 import json
-from subprocess import Popen, PIPE
+import hashlib
+import h5py
 import traceback
+import itertools
 
 from alabtools.analysis import HssFile
 
 from ..core import StructGenStep
-from ..model import Model, Particle
+from ..model import Model, Particle, optimize_models
 from ..restraints import Polymer, Envelope, Steric, intraHiC, interHiC, Sprite, Damid, Nucleolus, GenEnvelope, Fish
+from ..restraints.hic import ActivationDistanceDB
+from ..restraints.sprite import load_sprite_assignment
+from ..restraints.fish import FISH_FIELDS
 from ..utils import HmsFile
+from ..utils import input_cache
+from ..utils.population_cache import create_struct_major_copy, get_struct_coordinates
+from ..utils.repack import repack_hss
+from ..utils import population_store
 from ..utils.files import h5_create_group_if_not_exist, h5_create_or_replace_dataset, make_absolute_path
 from ..parallel.async_file_operations import FilePoller
 from ..utils.log import logger, bcolors
@@ -32,6 +41,15 @@ from tqdm import tqdm
 DEFAULT_HIST_BINS = 100
 DEFAULT_HIST_MAX = 0.1
 
+# structures optimized by each modeling step (see ModelingStep.select_structures)
+REMODEL_POLICIES = ('all', 'changed', 'violated', 'changed_or_violated')
+
+# HSS group with the restraint fingerprints and per-structure violation statistics
+MODELING_STATS = 'modeling_stats'
+
+# how the tasks return their results (see ModelingStep.save_model and ModelingStep.save_chunk)
+RESULT_STORAGES = ('hms', 'store')
+
 
 class ModelingStep(StructGenStep):
 
@@ -94,31 +112,139 @@ class ModelingStep(StructGenStep):
 
         self.tmp_extensions = [".hms", ".data", ".lam", ".lammpstrj", ".ready"]
         self.tmp_file_prefix = "mstep"
-        self.argument_list = range(self.cfg["model"]["population_size"])
+        # only the structures selected by the remodel policy are optimized, the statistics
+        # of the others are copied from the previous modeling step (see select_structures)
+        self.struct_ids = self.select_structures()
+        # each task models a batch of structures (see ModelingStep.task)
+        n_per_task = self.cfg.get("optimization/structures_per_task", 1)
+        self.result_store = ModelingStep.store_path(self.cfg, self.tmp_dir)
+        if self.result_store is None:
+            self.argument_list = [
+                list(self.struct_ids[i:i + n_per_task])
+                for i in range(0, len(self.struct_ids), n_per_task)
+            ]
+        else:
+            # one task for each chunk of the store, so that workers never write to the same chunk
+            self.argument_list = [
+                list(ids) for _, ids in itertools.groupby(
+                    self.struct_ids, key=lambda i: population_store.chunk_index(i, n_per_task))
+            ]
         self.hssfilename = self.cfg["optimization"]["structure_output"] + '.T'
         self.file_poller = None
+        self._collecting = False
+        # completed tasks are signaled to the poller as soon as the controller reports them
+        self.stream_reduce = True
+    #-
+
+    def select_structures(self):
+
+        """
+        Select the structures to optimize, following `optimization/remodel_policy`:
+            - all: the whole population
+            - changed: structures whose restraints assigned from the data (Hi-C, DamID, SPRITE, FISH) changed
+              since the previous modeling step
+            - violated: structures whose fraction of violated restraints in the previous modeling step is larger
+              than `optimization/max_violations`
+            - changed_or_violated: both
+        The whole population is selected if the statistics of the previous modeling step are not available
+        """
+
+        n_struct = self.cfg["model"]["population_size"]
+        policy = self.cfg.get('optimization/remodel_policy', 'all')
+        self._fingerprints = None
+        self._reused_ids = []
+
+        if policy not in REMODEL_POLICIES:
+            raise ValueError('Unknown remodel policy: %s' % policy)
+        if policy == 'all' or self.cfg.get('optimization/random_shuffling', False):
+            return list(range(n_struct))
+
+        self._fingerprints = restraint_fingerprints(self.cfg, n_struct)
+
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            if MODELING_STATS not in hss or hss[MODELING_STATS]['fingerprints'].shape != (n_struct,):
+                return list(range(n_struct))
+            previous = hss[MODELING_STATS]['fingerprints'][()]
+            counts = hss[MODELING_STATS]['violation_counts'][()]
+
+        n_imposed = counts[:, :, 0].sum(axis=1)
+        n_violations = counts[:, :, 1].sum(axis=1)
+        fraction = np.divide(n_violations, n_imposed, out=np.zeros(n_struct), where=(n_imposed > 0))
+
+        changed = self._fingerprints != previous
+        violated = fraction > self.cfg.get('optimization/max_violations')
+        if policy == 'changed':
+            selected = changed
+        elif policy == 'violated':
+            selected = violated
+        else:
+            selected = changed | violated
+
+        self._reused_ids = np.flatnonzero(~selected).tolist()
+        logger.info('Remodeling %d structures out of %d (%d with changed restraints, %d violated)',
+                    np.count_nonzero(selected), n_struct, np.count_nonzero(changed), np.count_nonzero(violated))
+        return np.flatnonzero(selected).tolist()
+    #-
+
+
+    @staticmethod
+    def store_path(cfg, tmp_dir):
+
+        """ Directory store of the task results, None if the results are saved to .hms files """
+
+        storage = cfg.get('optimization/result_storage', 'hms')
+        if storage not in RESULT_STORAGES:
+            raise ValueError('Unknown result storage: %s' % storage)
+        if storage == 'hms':
+            return None
+        return os.path.join(tmp_dir, '%s.store' % cfg.get('runtime/step_hash', 'xxxx'))
     #-
 
+
     def _run_poller(self):
 
-        """ Setup, run and teardown polling function (See also RelaxInit.py script) """
+        """
+        Setup, run and teardown polling function (See also RelaxInit.py script).
+        With a result store there is nothing to poll: the summary is set up here, and the
+        results of each task are collected by gather
+        """
+
+        if self.result_store is not None:
+            self.setup_poller()
+            self._collecting = True
+            return
 
         readyfiles = [
             os.path.join(self.tmp_dir, '%s.%d.ready' % (self.uid, struct_id))
-            for struct_id in self.argument_list
+            for struct_id in self.struct_ids
         ]
 
         self.file_poller = FilePoller(
             readyfiles,
             callback=self.set_structure,
-            args=[[i] for i in self.argument_list],
+            args=[[i] for i in self.struct_ids],
             setup=self.setup_poller,
             teardown=self.teardown_poller
         )
+        self._poller_index = {struct_id: k for k, struct_id in enumerate(self.struct_ids)}
         self.file_poller.watch_async()
     #-
 
 
+    def gather(self, struct_ids, result):
+
+        """
+        A task has been completed: its ready files can be checked right away by the poller,
+        or its chunk of the result store can be collected
+        """
+
+        if self._collecting:
+            self.collect_chunk(struct_ids)
+        elif self.file_poller is not None:
+            self.file_poller.notify([self._poller_index[i] for i in struct_ids])
+    #-
+
+
     def before_map(self):
         """
         This runs only if map step is not skipped
@@ -126,12 +252,18 @@ class ModelingStep(StructGenStep):
         # clean up ready files (those that arae there and spotter by the poller) if we want a clean restart of the modeling step
         readyfiles = [
             os.path.join(self.tmp_dir, '%s.%d.ready' % (self.uid, struct_id))
-            for struct_id in self.argument_list
+            for struct_id in self.struct_ids
         ]
         if self.cfg.get('optimization/clean_restart', False):
             for f in readyfiles:
                 if os.path.isfile(f):
                     os.remove(f)
+            if self.result_store is not None:
+                population_store.remove_store(self.result_store)
+
+        # struct-major copy of the coordinates, so that each task reads its structures in a single block
+        if self.cfg.get('optimization/struct_major_copy', False) and not self.cfg.get('optimization/random_shuffling', False):
+            create_struct_major_copy(self.cfg.get("optimization/structure_output"))
 
         self._run_poller()
     #-
@@ -142,31 +274,46 @@ class ModelingStep(StructGenStep):
         This runs only if reduce step is not skipped
         """
         # if we don't have a poller, set it up
-        if self.file_poller is None:
+        if self.file_poller is None and not self._collecting:
             self._run_poller()
     #-
 
 
     @staticmethod
-    def task(struct_id, cfg, tmp_dir):
+    def task(struct_ids, cfg, tmp_dir):
 
         """
-        Do single structure modeling (i.e., run LAMMPS) with restraint assignment from A-step
+        Do modeling (i.e., run LAMMPS) of a batch of structures with restraint assignment from A-step.
+        With the lammps kernel, all the structures in the batch are optimized by a single LAMMPS process
         """
 
         # the static method modifications to the cfg should only be local,
         # use a copy of the config file
         cfg = deepcopy(cfg)
 
+        if isinstance(struct_ids, (int, np.integer)):
+            struct_ids = [struct_ids]
+
         # extract structure information
         step_id = cfg.get('runtime/step_hash', 'xxxx')
 
-        readyfile = os.path.join(tmp_dir, '%s.%d.ready' % (step_id, struct_id))
-
-        # if the ready file exists it does nothing, unless it is a clear run
-        if not cfg.get('optimization/clean_restart', False):
-            if os.path.isfile(readyfile):
+        # if the ready file (or the chunk in the result store) exists it does nothing, unless it is a clear run
+        store = ModelingStep.store_path(cfg, tmp_dir)
+        chunk = None
+        if store is not None and len(struct_ids):
+            chunk = population_store.chunk_index(struct_ids[0], cfg.get('optimization/structures_per_task', 1))
+            if not cfg.get('optimization/clean_restart', False) and population_store.has_chunk(store, chunk):
                 return
+        elif not cfg.get('optimization/clean_restart', False):
+            struct_ids = [
+                struct_id for struct_id in struct_ids
+                if not os.path.isfile(os.path.join(tmp_dir, '%s.%d.ready' % (step_id, struct_id)))
+            ]
+        if len(struct_ids) == 0:
+            return
+
+        # restraint inputs are kept in memory by the worker, for the following tasks
+        input_cache.configure(cfg)
 
         hssfilename = cfg["optimization"]["structure_output"]
 
@@ -176,9 +323,120 @@ class ModelingStep(StructGenStep):
             radii = hss.radii
             chrom = hss.get_index().chrom
             if cfg.get('optimization/random_shuffling', False):
-                crd = generate_random_in_sphere(radii, cfg.get('model/restraints/envelope/nucleus_radius'))
+                crds = [generate_random_in_sphere(radii, cfg.get('model/restraints/envelope/nucleus_radius'))
+                        for struct_id in struct_ids]
             else:
-                crd = hss.get_struct_crd(struct_id)
+                # read from the struct-major copy of the population, if available
+                crds = get_struct_coordinates(hss, struct_ids, cfg)
+
+        models, monitored = [], []
+        for struct_id, crd in zip(struct_ids, crds):
+            model, monitored_restraints = ModelingStep.build_model(struct_id, crd, index, radii, chrom, cfg)
+            models.append(model)
+            monitored.append(monitored_restraints)
+
+        # ====== actual optimization: restraints have been assigned, now relax structures
+        cfg['runtime']['run_name'] = cfg.get('runtime/step_hash')
+
+        # with the adaptive protocol, structures which already satisfy (almost) all
+        # their restraints are only minimized, or not optimized at all
+        protocols, fractions = [], []
+        for model, monitored_restraints in zip(models, monitored):
+            protocol, fraction = ModelingStep.select_protocol(model, monitored_restraints, cfg)
+            protocols.append(protocol)
+            fractions.append(fraction)
+
+        optinfos = [None] * len(models)
+        for protocol in ['full', 'minimize']:
+            idx = [i for i, p in enumerate(protocols) if p == protocol]
+            if len(idx) == 0:
+                continue
+            run_cfg = cfg if protocol == 'full' else ModelingStep.minimization_cfg(cfg)
+            for i, info in zip(idx, optimize_models([models[i] for i in idx], run_cfg)):
+                optinfos[i] = info
+
+        for i, protocol in enumerate(protocols):
+            if optinfos[i] is None:
+                optinfos[i] = {'thermo': {}}
+            if isinstance(optinfos[i], dict):
+                optinfos[i]['protocol'] = protocol
+                if fractions[i] is not None:
+                    optinfos[i]['initial-violations'] = fractions[i]
+
+        if store is not None:
+            ModelingStep.save_chunk(store, chunk, struct_ids, models, monitored, optinfos, cfg)
+            return
+
+        for struct_id, model, monitored_restraints, optinfo in zip(struct_ids, models, monitored, optinfos):
+            ModelingStep.save_model(struct_id, model, monitored_restraints, optinfo, cfg, tmp_dir)
+    #-
+
+
+    @staticmethod
+    def select_protocol(model, monitored_restraints, cfg):
+
+        """
+        Choose the optimization protocol of a structure (adaptive protocol), scoring its starting coordinates
+        against the assembled restraints. Returns the protocol ('full', 'minimize' or 'skip') and the fraction
+        of violated restraints (None if the adaptive protocol is not enabled).
+        Structures with overlapping beads are always optimized.
+        """
+
+        adaptive = cfg.get('optimization/adaptive_protocol', None)
+        if adaptive is None:
+            return 'full', None
+
+        tol = cfg.get('optimization/violation_tolerance', 0.01)
+
+        n_imposed, n_violations = 0, 0
+        for r in monitored_restraints:
+            vs = model.evalForceViolationRatios(r.forceID, expand=True)
+            n_imposed += model.getImposedCount(r.forceID)
+            n_violations += int(np.count_nonzero(vs > tol))
+        fraction = n_violations / n_imposed if n_imposed else 0.0
+
+        if fraction > adaptive.get('minimize_threshold', 0.01):
+            return 'full', fraction
+
+        for f in model.getCollectiveForces():
+            if f.ftype == f.EXCLUDED_VOLUME and f.getOverlapCount(model.particles, tol) > 0:
+                return 'minimize', fraction
+
+        if fraction <= adaptive.get('skip_threshold', 0.0):
+            return 'skip', fraction
+        return 'minimize', fraction
+    #-
+
+
+    @staticmethod
+    def minimization_cfg(cfg):
+
+        """
+        Copy of the configuration for the 'minimize' path of the adaptive protocol: the annealing is replaced
+        by a (possibly empty) MD run at the final temperature, before the minimization
+        """
+
+        cfg = deepcopy(cfg)
+        opts = cfg['optimization']['optimizer_options']
+        tstop = opts['tstop']
+        opts['custom_annealing_protocol'] = {
+            'num_steps': 1,
+            'mdsteps': [cfg.get('optimization/adaptive_protocol/mdsteps', 0)],
+            'tstarts': [tstop],
+            'tstops': [tstop],
+            'evfactors': [1],
+            'envelope_factors': [1]
+        }
+        return cfg
+    #-
+
+
+    @staticmethod
+    def build_model(struct_id, crd, index, radii, chrom, cfg):
+
+        """
+        Create the model of a structure with all the restraints, returns the model and the list of monitored restraints
+        """
 
         # init Model class (igm.model)
         model = Model(uid=struct_id)
@@ -187,9 +445,7 @@ class ModelingStep(StructGenStep):
         chain_ids = np.concatenate( [ [i]*s for i, s in enumerate(index.chrom_sizes) ] )
 
         # add particles into model
-        n_particles = len(crd)
-        for i in range(n_particles):
-            model.addParticle(crd[i], radii[i], Particle.NORMAL, chainID=chain_ids[i])
+        model.addParticles(crd, radii, Particle.NORMAL, chain_ids=chain_ids)
 
         # Add restraints
         monitored_restraints = []
@@ -254,12 +510,18 @@ class ModelingStep(StructGenStep):
             contact_range = cfg.get('restraints/Hi-C/contact_range', 2.0)
             k             = cfg.get('restraints/Hi-C/contact_kspring', 0.05)
 
+            # restraints pre-assigned to this structure can only be used when starting from the population coordinates
+            hic_struct_id = None if cfg.get('optimization/random_shuffling', False) else struct_id
+
+            # the activation distances are read once, and shared by the inter and intra restraints
+            actdist            = ActivationDistanceDB(actdist_file)
+
             # effectively add inter  HiC restraints (bonds)
-            interhic           = interHiC(actdist_file, chrom, contact_range, k)   # LB, add chrom option
+            interhic           = interHiC(actdist, chrom, contact_range, k, struct_id=hic_struct_id)   # LB, add chrom option
             model.addRestraint(interhic)
             monitored_restraints.append(interhic)
 
-            intrahic           = intraHiC(actdist_file, chrom, contact_range, k)   # LB, add chrom option
+            intrahic           = intraHiC(actdist, chrom, contact_range, k, struct_id=hic_struct_id)   # LB, add chrom option
             model.addRestraint(intrahic)
             monitored_restraints.append(intrahic)
 
@@ -329,47 +591,56 @@ class ModelingStep(StructGenStep):
             model.addRestraint(fish)
             monitored_restraints.append(fish) 
         
-        # ====== actual optimization: restraints have been assigned, now relax structures
-	
-        cfg['runtime']['run_name'] = cfg.get('runtime/step_hash') + '_' + str(struct_id)
-        optinfo = model.optimize(cfg)
+        return model, monitored_restraints
+    #-
+
+
+    @staticmethod
+    def violation_stats(model, monitored_restraints, cfg):
+
+        """ Violation statistics of an optimized structure, by restraint """
 
         # tolerance parameter: if violation score is smaller than tolerance, then restraint is satisfied
         tol = cfg.get('optimization/violation_tolerance', 0.01)
 
+        # create violations statistics and save all of that into the "vstat" dictionary
+        vstat = {}
+        for r in monitored_restraints:
+            # collective forces (e.g. envelopes) contribute one value per restrained particle
+            vs = model.evalForceViolationRatios(r.forceID, expand=True)
+            n_imposed = model.getImposedCount(r.forceID)
+
+            H, edges = get_violation_histogram(vs)
+            violated_restr = int(np.count_nonzero(vs))          # how many violations
+            num_violations = int(np.count_nonzero(vs > tol))    # the same 'tol' value is used to compute the number of violations across different restraint kinds...is that too easy?
+            vstat[repr(r)] = {
+                'histogram': {
+                    'edges': edges.tolist(),
+                    'counts': H.tolist()
+                },
+                'violated_restr': violated_restr,
+                'n_violations': num_violations,
+                'n_imposed': n_imposed
+            }
+        return vstat
+    #-
+
+
+    @staticmethod
+    def save_model(struct_id, model, monitored_restraints, optinfo, cfg, tmp_dir):
+
+        """
+        Save the optimized structure and its violation statistics to a .hms file, and generate the .ready file
+        """
+
+        step_id = cfg.get('runtime/step_hash', 'xxxx')
+
         # save optimized configuration and violation results to .hms file
         ofname = os.path.join(tmp_dir, 'mstep_%d.hms' % struct_id)
         with HmsFile(ofname, 'w') as hms:
             hms.saveModel(struct_id, model)
 
-            # create violations statistics and save all of that into the "vstat" dictionary
-            vstat = {}
-            for r in monitored_restraints:
-                vs = []
-                n_imposed = 0
-                for fid in r.forceID:
-                    f = model.forces[fid]
-                    n_imposed += f.rnum
-                    if f.rnum > 1:
-			# a list of values is appended to vs = [] at once
-                        vs += f.getViolationRatios(model.particles).tolist()
-                    else:
-			# one value is appended at the time to vs = []
-                        vs.append(f.getViolationRatio(model.particles))
-
-                vs = np.array(vs)
-                H, edges = get_violation_histogram(vs)
-                violated_restr = np.count_nonzero(vs)          # how many violations
-                num_violations = np.count_nonzero(vs > tol)    # the same 'tol' value is used to compute the number of violations across different restraint kinds...is that too easy?
-                vstat[repr(r)] = {
-                    'histogram': {
-                        'edges': edges.tolist(),
-                        'counts': H.tolist()
-                    },
-                    'violated_restr': violated_restr,
-                    'n_violations': num_violations,
-                    'n_imposed': n_imposed
-                }
+            vstat = ModelingStep.violation_stats(model, monitored_restraints, cfg)
 
             # add violation dictionary to hms file
             h5_create_or_replace_dataset(hms, 'violation_stats', json.dumps(vstat))
@@ -392,16 +663,71 @@ class ModelingStep(StructGenStep):
     #-
 
 
+    @staticmethod
+    def save_chunk(store, chunk, struct_ids, models, monitored, optinfos, cfg):
+
+        """
+        Save the optimized structures of a task and their statistics to their chunk of the result store:
+        violation counts (n_imposed, n_violations, violated_restr) and histograms by restraint, energies,
+        protocols and violations before the optimization are stored as per-structure arrays
+        """
+
+        vstats = [
+            ModelingStep.violation_stats(model, monitored_restraints, cfg)
+            for model, monitored_restraints in zip(models, monitored)
+        ]
+        keys = sorted(set(k for vstat in vstats for k in vstat))
+        n = len(struct_ids)
+
+        counts = np.zeros((n, len(keys), 3), dtype=np.int64)
+        histograms = np.zeros((n, len(keys), DEFAULT_HIST_BINS + 1), dtype=np.int32)
+        energies = np.full((n, 3), np.nan)
+        initial_violations = np.full(n, np.nan, dtype=np.float32)
+        protocols, thermo = [], []
+        for i, (vstat, optinfo) in enumerate(zip(vstats, optinfos)):
+            for j, k in enumerate(keys):
+                if k in vstat:
+                    counts[i, j] = [vstat[k]['n_imposed'], vstat[k]['n_violations'], vstat[k]['violated_restr']]
+                    histograms[i, j] = vstat[k]['histogram']['counts']
+            if not isinstance(optinfo, dict):
+                optinfo = {}
+            energies[i] = [optinfo.get(k, np.nan) for k in ['final-energy', 'pair-energy', 'bond-energy']]
+            if optinfo.get('initial-violations') is not None:
+                initial_violations[i] = optinfo['initial-violations']
+            protocols.append(optinfo.get('protocol', 'full'))
+            thermo.append(optinfo.get('thermo', {}))
+
+        population_store.write_chunk(
+            store, chunk, struct_ids,
+            np.array([model.getCoordinates() for model in models], dtype=np.float32),
+            columns={
+                'violation_counts': counts,
+                'violation_histograms': histograms,
+                'energies': energies,
+                'initial_violations': initial_violations,
+            },
+            info={
+                'restraints': keys,
+                'protocol': protocols,
+                'thermo': thermo
+            }
+        )
+    #-
+
+
 
     def setup_poller(self):
 
         """ Set up polling function: define coordinate master matrix and a dictionary summarizing statistics from run"""
-        
-        _hss = HssFile(self.hssfilename, 'r')
-        #self._hss = HssFile(self.hssfilename, 'r+')
 
-        self._hss_crd = _hss.coordinates
-        _hss.close()
+        # with a result store, coordinates are copied from the store by teardown_poller
+        self._hss_crd = None
+        if self.result_store is None:
+            _hss = HssFile(self.hssfilename, 'r')
+            #self._hss = HssFile(self.hssfilename, 'r+')
+
+            self._hss_crd = _hss.coordinates
+            _hss.close()
 
         self._summary_data = {
             'n_imposed': 0.0,
@@ -418,10 +744,54 @@ class ModelingStep(StructGenStep):
                 'total_energies': np.zeros(self.cfg["model"]["population_size"], dtype=np.float32),
                 'pair_energies':  np.zeros(self.cfg["model"]["population_size"], dtype=np.float32),
                 'bond_energies':  np.zeros(self.cfg["model"]["population_size"], dtype=np.float32),
+                'protocol':       ['full'] * self.cfg["model"]["population_size"],
+                'initial_violations': np.full(self.cfg["model"]["population_size"], np.nan, dtype=np.float32),
                 'thermo': {}
             },
             'byrestraint': {}
         }
+
+        # per-structure statistics of each restraint, stored in the HSS file for the following
+        # modeling steps when a remodel policy is used
+        self._restraint_stats = {}
+        if self._fingerprints is not None:
+            self.reuse_structures(self._reused_ids)
+    #-
+
+
+    def reuse_structures(self, struct_ids):
+
+        """ Statistics of the structures which are not optimized, from the previous modeling step """
+
+        if len(struct_ids) == 0:
+            return
+
+        with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
+            grp = hss[MODELING_STATS]
+            keys = [k.decode() if isinstance(k, bytes) else k for k in grp['restraints'][()]]
+            counts = grp['violation_counts'][()]
+            histograms = grp['violation_histograms'][()]
+            bystructure = json.loads(hss['summary'][()])['bystructure']
+
+        for i in struct_ids:
+            vstat = {
+                k: {
+                    'histogram': {'counts': histograms[i, j]},
+                    'n_imposed': int(counts[i, j, 0]),
+                    'n_violations': int(counts[i, j, 1]),
+                    'violated_restr': int(counts[i, j, 2])
+                }
+                for j, k in enumerate(keys)
+            }
+            self.add_violation_stats(i, vstat)
+
+            for k in ['total_energies', 'pair_energies', 'bond_energies']:
+                self._summary_data['bystructure'][k][i] = bystructure[k][i]
+            for k, v in bystructure['thermo'].items():
+                if k not in self._summary_data['bystructure']['thermo']:
+                    self._summary_data['bystructure']['thermo'][k] = np.zeros(self.cfg["model"]["population_size"])
+                self._summary_data['bystructure']['thermo'][k][i] = v[i]
+            self._summary_data['bystructure']['protocol'][i] = 'reused'
     #-
 
 
@@ -446,39 +816,7 @@ class ModelingStep(StructGenStep):
             except:
                 vstat = {}
 
-            n_tot = 0        # number of violations (violation_score > tol)
-            n_vio = 0        # total number of restraints
-            ex_vio = 0       # number of violated restraints (violation_score > 0)
-
-            hist_tot = np.zeros(DEFAULT_HIST_BINS + 1)
-            for k, cstat in vstat.items():
-                if k not in self._summary_data['byrestraint']:
-                    self._summary_data['byrestraint'][k] = {
-                        'histogram': {
-                            'counts': np.zeros(DEFAULT_HIST_BINS + 1)
-                        },
-                        'n_violations': 0,
-                        'violated_restr': 0,
-                        'n_imposed': 0
-                    }
-
-                n_tot += cstat.get('n_imposed', 0)
-                n_vio += cstat.get('n_violations', 0)
-                ex_vio += cstat.get('violated_restr', 0)
-
-                hist_tot += cstat['histogram']['counts']
-                self._summary_data['byrestraint'][k]['n_violations'] += cstat.get('n_violations', 0)
-                self._summary_data['byrestraint'][k]['n_imposed'] += cstat.get('n_imposed', 0)
-                self._summary_data['byrestraint'][k]['violated_restr'] += cstat.get('violated_restr', 0)
-                self._summary_data['byrestraint'][k]['histogram']['counts'] += cstat['histogram']['counts']
-
-            self._summary_data['n_imposed'] += n_tot
-            self._summary_data['n_violations'] += n_vio
-            self._summary_data['violated_restr'] += ex_vio
-            self._summary_data['histogram']['counts'] += hist_tot
-            self._summary_data['bystructure']['n_imposed'][i] = n_tot
-            self._summary_data['bystructure']['n_violations'][i] = n_vio
-            self._summary_data['bystructure']['violated_restr'][i] = ex_vio
+            self.add_violation_stats(i, vstat)
 
             # collect optimization statistics
             try:
@@ -491,10 +829,107 @@ class ModelingStep(StructGenStep):
             # detailed optimization stats
             if 'opt_info_dict' in hms:
                 infodict = json.loads(hms['opt_info_dict'][()])
-                for k, v in infodict['thermo'].items():
-                    if k not in self._summary_data['bystructure']['thermo']:
-                        self._summary_data['bystructure']['thermo'][k] = np.zeros(self._hss_crd.shape[1])   # LB replaced hss.n_struct
-                    self._summary_data['bystructure']['thermo'][k][i] = v
+                self.add_opt_info(i, infodict.get('protocol', 'full'), infodict.get('initial-violations'),
+                                  infodict.get('thermo', {}))
+    #-
+
+
+    def collect_chunk(self, struct_ids):
+
+        """ Add the statistics of the structures of a chunk of the result store (coordinates are copied by teardown_poller) """
+
+        chunk = population_store.chunk_index(struct_ids[0], self.cfg.get("optimization/structures_per_task", 1))
+        ids, columns, info = population_store.read_chunk(self.result_store, chunk)
+        missing = set(struct_ids) - set(ids.tolist())
+        if missing:
+            raise RuntimeError('results of structures %s are missing in %s' % (sorted(missing), self.result_store))
+
+        counts, histograms = columns['violation_counts'], columns['violation_histograms']
+        bystructure = self._summary_data['bystructure']
+        for n, i in enumerate(ids):
+            vstat = {
+                k: {
+                    'histogram': {'counts': histograms[n, j]},
+                    'n_imposed': int(counts[n, j, 0]),
+                    'n_violations': int(counts[n, j, 1]),
+                    'violated_restr': int(counts[n, j, 2])
+                }
+                for j, k in enumerate(info['restraints'])
+            }
+            self.add_violation_stats(i, vstat)
+
+            for j, k in enumerate(['total_energies', 'pair_energies', 'bond_energies']):
+                if not np.isnan(columns['energies'][n, j]):
+                    bystructure[k][i] = columns['energies'][n, j]
+
+            initial = columns['initial_violations'][n]
+            self.add_opt_info(i, info['protocol'][n], None if np.isnan(initial) else initial, info['thermo'][n])
+    #-
+
+
+    def add_opt_info(self, i, protocol, initial_violations, thermo):
+
+        """ Path taken by the adaptive protocol, violations before the optimization, and thermodynamic quantities of the i-th structure """
+
+        self._summary_data['bystructure']['protocol'][i] = protocol
+        if initial_violations is not None:
+            self._summary_data['bystructure']['initial_violations'][i] = initial_violations
+
+        for k, v in thermo.items():
+            if k not in self._summary_data['bystructure']['thermo']:
+                self._summary_data['bystructure']['thermo'][k] = np.zeros(self.cfg["model"]["population_size"])   # LB replaced hss.n_struct
+            self._summary_data['bystructure']['thermo'][k][i] = v
+    #-
+
+
+    def add_violation_stats(self, i, vstat):
+
+        """ Add the violation statistics of the i-th structure (by restraint) to the summary """
+
+        n_tot = 0        # number of violations (violation_score > tol)
+        n_vio = 0        # total number of restraints
+        ex_vio = 0       # number of violated restraints (violation_score > 0)
+
+        hist_tot = np.zeros(DEFAULT_HIST_BINS + 1)
+        for k, cstat in vstat.items():
+            if k not in self._summary_data['byrestraint']:
+                self._summary_data['byrestraint'][k] = {
+                    'histogram': {
+                        'counts': np.zeros(DEFAULT_HIST_BINS + 1)
+                    },
+                    'n_violations': 0,
+                    'violated_restr': 0,
+                    'n_imposed': 0
+                }
+
+            n_tot += cstat.get('n_imposed', 0)
+            n_vio += cstat.get('n_violations', 0)
+            ex_vio += cstat.get('violated_restr', 0)
+
+            hist_tot += cstat['histogram']['counts']
+            self._summary_data['byrestraint'][k]['n_violations'] += cstat.get('n_violations', 0)
+            self._summary_data['byrestraint'][k]['n_imposed'] += cstat.get('n_imposed', 0)
+            self._summary_data['byrestraint'][k]['violated_restr'] += cstat.get('violated_restr', 0)
+            self._summary_data['byrestraint'][k]['histogram']['counts'] += cstat['histogram']['counts']
+
+            # per-structure copy, for the remodel policies
+            if self._fingerprints is not None:
+                if k not in self._restraint_stats:
+                    self._restraint_stats[k] = (
+                        np.zeros((self.cfg["model"]["population_size"], 3), dtype=np.int64),
+                        np.zeros((self.cfg["model"]["population_size"], DEFAULT_HIST_BINS + 1), dtype=np.int32)
+                    )
+                counts, histograms = self._restraint_stats[k]
+                counts[i] = [cstat.get('n_imposed', 0), cstat.get('n_violations', 0), cstat.get('violated_restr', 0)]
+                histograms[i] = cstat['histogram']['counts']
+
+        self._summary_data['n_imposed'] += n_tot
+        self._summary_data['n_violations'] += n_vio
+        self._summary_data['violated_restr'] += ex_vio
+        self._summary_data['histogram']['counts'] += hist_tot
+        self._summary_data['bystructure']['n_imposed'][i] = n_tot
+        self._summary_data['bystructure']['n_violations'][i] = n_vio
+        self._summary_data['bystructure']['violated_restr'][i] = ex_vio
     #-
 
 
@@ -518,9 +953,34 @@ class ModelingStep(StructGenStep):
 
         # store violation score, all the coordinates and the restraint violation summary into the HSS file
         self._hss.set_violation(violation_score)
-        self._hss.set_coordinates(self._hss_crd)   # LB
+        if self.result_store is None:
+            self._hss.set_coordinates(self._hss_crd)   # LB
+        else:
+            # chunks written by the tasks of this step
+            chunks = sorted(set(
+                population_store.chunk_index(ids[0], self.cfg.get("optimization/structures_per_task", 1))
+                for ids in self.argument_list
+            ))
+            population_store.write_coordinates(self.result_store, self._hss['coordinates'], chunks)
         h5_create_or_replace_dataset(self._hss, 'summary', data=json.dumps(self._summary_data, default=lambda a: a.tolist()))
-        
+
+        # restraint fingerprints and per-structure statistics, used by the remodel policies of the next step
+        if MODELING_STATS in self._hss:
+            del self._hss[MODELING_STATS]
+        if self._fingerprints is not None:
+            keys = sorted(self._restraint_stats.keys())
+            n_struct = self.cfg["model"]["population_size"]
+            counts = np.zeros((n_struct, len(keys), 3), dtype=np.int64)
+            histograms = np.zeros((n_struct, len(keys), DEFAULT_HIST_BINS + 1), dtype=np.int32)
+            for j, k in enumerate(keys):
+                counts[:, j], histograms[:, j] = self._restraint_stats[k]
+
+            grp = self._hss.create_group(MODELING_STATS)
+            grp.create_dataset('fingerprints', data=self._fingerprints)
+            grp.create_dataset('restraints', data=np.array(keys, dtype=object), dtype=h5py.string_dtype())
+            grp.create_dataset('violation_counts', data=counts)
+            grp.create_dataset('violation_histograms', data=histograms, compression='gzip')
+
         # close HSS file
         self._hss.close()
     #-
@@ -531,39 +991,26 @@ class ModelingStep(StructGenStep):
         Collect all structure coordinates together to assemble a hssFile
         """
 
-        # wait for poller to finish (see also RelaxInit.py script)
-        for _ in tqdm(self.file_poller.enumerate(), desc='(REDUCE)'):
-            pass
+        # wait for poller to finish (see also RelaxInit.py script); the chunks of the result store
+        # have already been collected, only coordinates and summary are written
+        if self.result_store is None:
+            for _ in tqdm(self.file_poller.enumerate(), desc='(REDUCE)'):
+                pass
+        else:
+            self.teardown_poller()
 
         # read and log details, and save the runtime variables
         with HssFile(self.hssfilename, 'r+') as hss:
-            n_struct = hss.nstruct
-            n_beads = hss.nbead
             violation_score = log_stats(hss, self.cfg)
             self.cfg['runtime']['violation_score'] = violation_score
             h5_create_or_replace_dataset(hss, 'config_data',
                                          data=json.dumps(self.cfg, default=lambda a: a.tolist()))
 
         # repack hss file
-        PACK_SIZE = 1e6
-        pack_beads = max(1, int(PACK_SIZE / n_struct / 3))
-        pack_beads = min(pack_beads, n_beads)
-        cmd = [
-            'h5repack',
-            '-i', self.hssfilename,
-            '-o', self.hssfilename + '.swap',
-            '-l', 'coordinates:CHUNK={:d}x{:d}x3'.format(pack_beads, n_struct),
-            '-v'
-        ]
-
         logger.info('Repacking...')
-        sp = Popen(cmd, stderr=PIPE, stdout=PIPE)
-        stdout, stderr = sp.communicate()
-        if sp.returncode != 0:
-            print(' '.join(cmd))
-            print('O:', stdout.decode('utf-8'))
-            print('E:', stderr.decode('utf-8'))
-            raise RuntimeError('repacking failed. error code: %d' % sp.returncode)
+        if not repack_hss(self.hssfilename, self.hssfilename + '.swap'):
+            # already in the output layout; the working file is kept for the next step
+            copyfile(self.hssfilename, self.hssfilename + '.swap')
         logger.info('...done!')
 
         # save the output file with a unique file name if requested (see 'intermediate_name' function below)
@@ -580,6 +1027,13 @@ class ModelingStep(StructGenStep):
 
 
 
+    def cleanup(self):
+        super(ModelingStep, self).cleanup()
+        if self.result_store is not None and not self.keep_temporary_files:
+            population_store.remove_store(self.result_store)
+    #-
+
+
     def skip(self):
         fn = self.intermediate_name() + '.hss'
         if os.path.isfile(fn):
@@ -659,6 +1113,80 @@ def get_violation_histogram(v, nbins=DEFAULT_HIST_BINS, vmax=1):
     return H, edges
 
 
+def restraint_fingerprints(cfg, n_struct):
+
+    """
+    Fingerprints (64 bit hashes) of the restraints assigned to each structure from the data (Hi-C, DamID, SPRITE,
+    FISH): restraints read from the same inputs, with the same parameters, have the same fingerprint. Hi-C,
+    DamID and FISH restraints are identified by their beads only (the pairs assigned to each structure, the
+    restrained loci, the probes and pairs with a target): activation and target distances are updated by every
+    A step, and a change of distance alone does not change the fingerprint. Inputs which are not assigned to single structures (e.g. the DamID loci) change the fingerprints
+    of all the structures.
+    """
+
+    hashes = [hashlib.md5() for _ in range(n_struct)]
+
+    def update_all(*arrays):
+        h = hashlib.md5()
+        for a in arrays:
+            h.update(np.ascontiguousarray(a).tobytes())
+        digest = h.digest()
+        for h in hashes:
+            h.update(digest)
+
+    def update(i, *arrays):
+        for a in arrays:
+            hashes[i].update(np.ascontiguousarray(a).tobytes())
+
+    def params(*values):
+        return np.frombuffer(json.dumps(values).encode(), dtype=np.uint8)
+
+    if "Hi-C" in cfg['restraints']:
+        data = input_cache.load_h5_arrays(cfg.get('runtime/Hi-C/actdist_file'), ActivationDistanceDB.FIELDS)
+        update_all(params('Hi-C', cfg.get('restraints/Hi-C/contact_range', 2.0),
+                          cfg.get('restraints/Hi-C/contact_kspring', 0.05)))
+        if 'by_struct/indptr' in data:
+            indptr = data['by_struct/indptr']
+            for i in range(n_struct):
+                update(i, *[data['by_struct/' + k][indptr[i]:indptr[i + 1]] for k in ('row', 'col')])
+        else:
+            update_all(data['row'], data['col'])
+
+    if "DamID" in cfg['restraints']:
+        data = input_cache.load_h5_arrays(cfg.get('runtime/DamID/damid_actdist_file'), ('loc',))
+        update_all(params('DamID', cfg.get('restraints/DamID/contact_range', 2.0),
+                          cfg.get('restraints/DamID/contact_kspring', 0.05)),
+                   data['loc'])
+
+    if "sprite" in cfg['restraints']:
+        sprite_tmp = make_absolute_path(cfg.get('restraints/sprite/tmp_dir', 'sprite'), cfg.get('parameters/tmp_dir'))
+        data = load_sprite_assignment(make_absolute_path(
+            cfg.get('restraints/sprite/assignment_file', 'sprite_assignment.h5'), sprite_tmp))
+        update_all(params('sprite', cfg['restraints']['sprite']['kspring'], cfg['runtime']['sprite']['volume_fraction']))
+        indptr, selected = data['indptr'], data['selected']
+        bounds = np.searchsorted(data['sorted_assignment'], np.arange(n_struct + 1))
+        for i in range(n_struct):
+            clusters = data['clusters'][bounds[i]:bounds[i + 1]]
+            update(i, indptr[clusters + 1] - indptr[clusters], *[selected[indptr[c]:indptr[c + 1]] for c in clusters])
+
+    if "FISH" in cfg['restraints']:
+        fish_tmp = make_absolute_path(cfg.get('restraints/FISH/tmp_dir', 'FISH'), cfg.get('parameters/tmp_dir'))
+        data = input_cache.load_h5_arrays(make_absolute_path(
+            cfg.get('restraints/FISH/fish_file', 'fish_assignment.h5'), fish_tmp), FISH_FIELDS)
+        update_all(params('FISH', cfg['restraints']['FISH']['kspring'], cfg['runtime']['FISH']['tol'],
+                          cfg['restraints']['FISH']['rtype']),
+                   *[data[k] for k in ('probes', 'pairs') if k in data])
+        # targets are (n_probes, n_struct), one column per structure. The target distances are drawn again by
+        # every assignment step: only the probes and pairs which have a target in each structure are hashed
+        # (the bead copies are chosen from the coordinates when the model is built)
+        assigned = [np.isfinite(np.asarray(data[k], dtype=np.float64)).T.copy()
+                    for k in ('radial_min', 'radial_max', 'pair_min', 'pair_max') if k in data]
+        for i in range(n_struct):
+            update(i, *[t[i] for t in assigned])
+
+    return np.array([np.frombuffer(h.digest()[:8], dtype=np.uint64)[0] for h in hashes], dtype=np.uint64)
+
+
 def log_stats(hss, cfg):
 
     """ Recapitulate average (per-bead) thermodynamic quantities, and print information to logger to finally conclude this M step; detail violations and break 'em down for each restraint class. Colors are only used when printing to terminal, otherwise color code strings show at the beginning and end of the line to be colored]
@@ -697,18 +1225,30 @@ def log_stats(hss, cfg):
     else:
         violation_score = total_violations / total_restraints
 
+    # structures skipped by the adaptive protocol have no optimization statistics
+    protocols = np.array(summary['bystructure'].get('protocol', ['full'] * n_struct))
+    optimized = protocols != 'skip'
+    if np.any(protocols != 'full'):
+        logger.info(
+            bcolors.OKBLUE + '  Optimization protocol: %d full, %d minimization only, %d skipped, %d not remodeled  ' + bcolors.ENDC,
+            np.count_nonzero(protocols == 'full'),
+            np.count_nonzero(protocols == 'minimize'),
+            np.count_nonzero(protocols == 'skip'),
+            np.count_nonzero(protocols == 'reused')
+        )
+
     if 'thermo' in summary['bystructure'] and len(summary['bystructure']['thermo']):
         logger.info(bcolors.HEADER + '          ========== Average thermodynamic info per bead =========  ' + bcolors.ENDC)
         for k, arr in summary['bystructure']['thermo'].items():
-            vv = np.array(arr) / n_beads
+            vv = np.array(arr)[optimized] / n_beads
             logger.info(
                 bcolors.HEADER + '  %s:  %f +/- %f  ' + bcolors.ENDC,
                 k, np.mean(vv), np.std(vv)
             )
 
-    e_tot = np.array(summary['bystructure']['total_energies']) / n_beads
-    e_pair = np.array(summary['bystructure']['pair_energies']) / n_beads
-    e_bond = np.array(summary['bystructure']['bond_energies']) / n_beads
+    e_tot = np.array(summary['bystructure']['total_energies'])[optimized] / n_beads
+    e_pair = np.array(summary['bystructure']['pair_energies'])[optimized] / n_beads
+    e_bond = np.array(summary['bystructure']['bond_energies'])[optimized] / n_beads
 
     logger.info(
         bcolors.HEADER + '  Average energies per bead:  total: %f +/- %f | pair: %f +/- %f | bond: %f +/- %f  ' + bcolors.ENDC,
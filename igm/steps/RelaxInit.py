@@ -6,14 +6,16 @@ from alabtools.analysis import HssFile
 from tqdm import tqdm
 from copy import deepcopy
 from shutil import copyfile
-from subprocess import Popen, PIPE
 
 from ..core import StructGenStep
 from ..model import Model, Particle
 from ..restraints import Polymer, Envelope, Steric, Nucleolus, GenEnvelope
-from ..utils import HmsFile
+from ..utils import HmsFile, input_cache
 from ..parallel.async_file_operations import FilePoller
 from ..utils.log import logger
+from ..utils.population_cache import create_struct_major_copy, get_struct_coordinates
+from ..utils.repack import repack_hss
+from .ModelingStep import MODELING_STATS
 
 
 class RelaxInit(StructGenStep):
@@ -24,6 +26,8 @@ class RelaxInit(StructGenStep):
         self.file_poller = None
         self.argument_list = range(self.cfg["model"]["population_size"])
         self.hssfilename = self.cfg["optimization"]["structure_output"] + '.T'
+        # completed tasks are signaled to the poller as soon as the controller reports them
+        self.stream_reduce = True
 
     def before_map(self):
         '''
@@ -38,6 +42,11 @@ class RelaxInit(StructGenStep):
             for f in readyfiles:
                 if os.path.isfile(f):
                     os.remove(f)
+
+        # struct-major copy of the coordinates, so that each task reads its structure in a single block
+        if self.cfg.get('optimization/struct_major_copy', False):
+            create_struct_major_copy(self.cfg["optimization"]["structure_output"])
+
         self._run_poller()
 
     def setup_poller(self):
@@ -54,6 +63,9 @@ class RelaxInit(StructGenStep):
 
         _hss = HssFile(self.hssfilename, 'r+')
         _hss.set_coordinates(self._hss_crd)
+        # statistics of a previous modeling step refer to other coordinates (see ModelingStep.select_structures)
+        if MODELING_STATS in _hss:
+            del _hss[MODELING_STATS]
         _hss.close()
         
     def _run_poller(self):
@@ -74,6 +86,13 @@ class RelaxInit(StructGenStep):
         )
         self.file_poller.watch_async()
 
+    def gather(self, struct_id, result):
+
+        """ A task has been completed: its ready file can be checked right away by the poller """
+
+        if self.file_poller is not None:
+            self.file_poller.notify([struct_id])
+
     def before_reduce(self):
         '''
         This runs only if reduce step is not skipped
@@ -96,6 +115,9 @@ class RelaxInit(StructGenStep):
             if os.path.isfile(readyfile):
                 return
 
+        # restraint inputs are kept in memory by the worker, for the following tasks
+        input_cache.configure(cfg)
+
         # extract structure information
         hssfilename = cfg["optimization"]["structure_output"]
 
@@ -103,15 +125,13 @@ class RelaxInit(StructGenStep):
         with HssFile(hssfilename, 'r') as hss:
             index = hss.index
             radii = hss.radii
-            crd = hss.get_struct_crd(struct_id)
+            crd = get_struct_coordinates(hss, [struct_id], cfg)[0]
 
         # init Model
         model = Model(uid=struct_id)
 
         # add particles into model
-        n_particles = len(crd)
-        for i in range(n_particles):
-            model.addParticle(crd[i], radii[i], Particle.NORMAL)
+        model.addParticles(crd, radii, Particle.NORMAL)
 
         # ========Add polymer/nucleoli restraints =========
 
@@ -204,32 +224,12 @@ class RelaxInit(StructGenStep):
         for i in tqdm(self.file_poller.enumerate(), desc='(REDUCE)'):
             pass
 
-        with HssFile(self.hssfilename, 'r+') as hss:
-            n_struct = hss.nstruct
-            n_beads = hss.nbead
-
         logger.info('Coordinates in master file updated for ALL structures; repacking starts...')
-        
-        # repack hss file (this is a syntax proper to h5df files)
-        PACK_SIZE = 1e6
-        pack_beads = max(1, int(PACK_SIZE / n_struct / 3))
-        pack_beads = min(pack_beads, n_beads)
-        cmd = [
-            'h5repack',
-            '-i', self.hssfilename,
-            '-o', self.hssfilename + '.swap',
-            '-l', 'coordinates:CHUNK={:d}x{:d}x3'.format(pack_beads, n_struct),
-            '-v'
-        ]
 
-        sp = Popen(cmd, stderr=PIPE, stdout=PIPE)
-        logger.info('repacking...')
-        stdout, stderr = sp.communicate()
-        if sp.returncode != 0:
-            print(' '.join(cmd))
-            print('O:', stdout.decode('utf-8'))
-            print('E:', stderr.decode('utf-8'))
-            raise RuntimeError('repacking failed. error code: %d' % sp.returncode)
+        # repack hss file, chunking the coordinates by beads
+        if not repack_hss(self.hssfilename, self.hssfilename + '.swap'):
+            # already in the output layout; the working file is kept for the next step
+            copyfile(self.hssfilename, self.hssfilename + '.swap')
         logger.info('repacking done.')
 
         # save the output file with a unique file name if requested
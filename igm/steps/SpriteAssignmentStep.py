@@ -12,10 +12,13 @@ import numpy as np
 import h5py
 import os
 import os.path
+import time
 
 from alabtools.analysis import HssFile
 from ..cython_compiled.sprite import compute_gyration_radius
 from ..utils.files import make_absolute_path
+from ..utils.population_cache import get_population_coordinates
+from ..parallel.partition import BatchCostModel, batch_costs, copy_numbers, record_task_time
 from ..core import Step
 
 from tqdm import tqdm
@@ -73,32 +76,39 @@ class SpriteAssignmentStep(Step):
 
         clusters_file = self.cfg.get('restraints/sprite/clusters')
         with h5py.File(clusters_file, 'r') as h5:
-            n_clusters = len(h5['indptr']) - 1
+            indptr = h5['indptr'][()]
+            data = h5['data'][()]
+        n_clusters = len(indptr) - 1
 
         with HssFile(self.cfg.get("optimization/structure_output"), 'r') as hss:
             self.n_struct = hss.nstruct
+            index = hss.index
 
+        # split the clusters into batches of similar cost, and pass (batch_id, first cluster, last cluster + 1)
+        # to the tasks
         batch_size = self.cfg.get('restraints/sprite/batch_size', 10)
-        n_batches = n_clusters // batch_size
-        if n_clusters % batch_size != 0:
-            n_batches += 1
+        costs = get_cluster_costs(indptr, data, index,
+                                  self.cfg.get('restraints/sprite/max_chrom_in_cluster', 6)) * self.n_struct
+        self.cost_model = BatchCostModel(self.cfg, 'sprite')
+        bounds = self.cost_model.partition(costs, batch_size)
+        self.batch_costs = batch_costs(costs, bounds)
+        n_batches = len(bounds) - 1
 
         self.n_batches = n_batches
         self.n_clusters = n_clusters
-        self.argument_list = range(n_batches)
+        self.argument_list = [(b, int(bounds[b]), int(bounds[b + 1])) for b in range(n_batches)]
             
     @staticmethod
-    def task(batch_id, cfg, tmp_dir):
+    def task(batch, cfg, tmp_dir):
 
+        start_time = time.time()
+        batch_id, start, stop = batch
         clusters_file = cfg.get('restraints/sprite/clusters')
-        batch_size = cfg.get('restraints/sprite/batch_size', 10)
         keep_best = cfg.get('restraints/sprite/keep_best', 50)
 
         # read the clusters
         with h5py.File(clusters_file, 'r') as h5:
-            start = batch_id*batch_size
-            stop = (batch_id+1)*batch_size + 1
-            ii = h5['indptr'][start:stop][()]
+            ii = h5['indptr'][start:stop + 1][()]
             data = h5['data'][ii[0]:ii[-1]] #load everything for performance
             ii -= ii[0]   # subtract offset (ii[0]) from the full ii array
 
@@ -112,6 +122,7 @@ class SpriteAssignmentStep(Step):
         # open the structure file and read index
         hss     = HssFile(cfg.get("optimization/structure_output"), 'r')
         index = hss.index
+        crd   = get_population_coordinates(hss, cfg)
             
         indexes, values, selected_beads = [], [], []
         
@@ -132,7 +143,7 @@ class SpriteAssignmentStep(Step):
             # compute radius**2 of giration for a set of genomic segments, across population (three outputs)
             # NB: current_selected_beads = the bead indexes making up the cluster after considering the possible combinations of chromosome copies.
             rg2s, _, current_selected_beads = compute_gyration_radius(
-                hss['coordinates'], 
+                crd, 
                 cluster, 
                 index, 
                 index.copy_index
@@ -172,13 +183,14 @@ class SpriteAssignmentStep(Step):
         selected_beads = np.load(sel_file)
         indexes = np.load(idx_file)        
         values = np.load(val_file)
+
+        record_task_time(tmp_dir, batch_id, start_time)
         
     def reduce(self):
 
         # using random order, to minimize biases
-        random_order = np.random.permutation(self.argument_list)
+        random_order = np.random.permutation(len(self.argument_list))
         clusters_file = self.cfg.get('restraints/sprite/clusters')
-        batch_size = self.cfg.get('restraints/sprite/batch_size', 10)
         kT = self.cfg.get('restraints/sprite/radius_kt', 100.0)
 
         # initialize stuff
@@ -210,6 +222,8 @@ class SpriteAssignmentStep(Step):
             # loop over different batches, with progress status bar
             for batch_id in tqdm(random_order, desc='(REDUCE)'):
 
+                _, first_cluster, _ = self.argument_list[batch_id]
+
                 # load all files for current batch
                 idx_file = os.path.join(self.tmp_dir, 'tmp.%d.idx.npy' % batch_id )
                 structure_indexes = np.load(idx_file)    # indices of configurations in batch
@@ -229,7 +243,7 @@ class SpriteAssignmentStep(Step):
                 for i, (best_rg2s, curr_idx) in enumerate(results):   # i is a counter
                     
                     # 'best_rg2s' and 'curr_idx' are arrays, each pertaining a given cluster in current batch
-                    ci = i + batch_id*batch_size # cluster id
+                    ci = i + first_cluster # cluster id
 
                     if best_rg2s[0] < 0:    # negative radius of gyration squared (should not happen)
                         pos = 0
@@ -263,12 +277,47 @@ class SpriteAssignmentStep(Step):
                     assigned_beads.append(selected_beads_zip[ 'arr_%i' % i][pos])
 
                 # look above: clustering partitioning
-                start = indptr[ batch_id * batch_size ]
-                stop  = indptr[ batch_id * batch_size + len(assigned_beads) ]
+                start = indptr[ first_cluster ]
+                stop  = indptr[ first_cluster + len(assigned_beads) ]
   
                 # (diploid) bead indexes associated with each cluster, cluster range 'start' to 'stop'
                 assignment_file['selected'][start:stop] = np.concatenate(assigned_beads)
 
             assignment_file['assignment'][...] = assignment
+
+        # use the measured task durations for the next partitions
+        self.cost_model.update(self.batch_costs, self.tmp_dir)
 #=  
     
+
+
+def get_cluster_costs(indptr, data, index, max_chrom_in_cluster):
+
+    """
+    Estimated cost of the assignment of each cluster (per structure).
+
+    compute_gyration_radius enumerates all the copy combinations of one
+    representative segment per chromosome, then computes the Rg of the whole
+    cluster: the cost is n_chrom x prod(copies of the representatives) +
+    cluster size. Clusters with more than `max_chrom_in_cluster` chromosomes
+    are skipped by the task, and only count their size.
+    """
+
+    n_clusters = len(indptr) - 1
+    sizes = np.diff(indptr)
+    cluster_id = np.repeat(np.arange(n_clusters), sizes)
+    chrom = np.asarray(index.chrom)[data]
+
+    # one representative per (cluster, chromosome)
+    n_chrom_total = int(chrom.max()) + 1 if len(chrom) else 1
+    _, first = np.unique(cluster_id * n_chrom_total + chrom, return_index=True)
+    rep_cluster = cluster_id[first]
+    rep_copies = copy_numbers(index.copy_index)[data[first]].astype(np.float64)
+
+    n_chrom = np.bincount(rep_cluster, minlength=n_clusters)
+    combinations = np.exp(np.bincount(rep_cluster, weights=np.log(rep_copies), minlength=n_clusters))
+
+    costs = n_chrom * combinations + sizes
+    skipped = n_chrom > max_chrom_in_cluster
+    costs[skipped] = sizes[skipped]
+    return costs
@@ -56,9 +56,7 @@ def modeling_task(struct_id, cfg_file):
         index = f.index
         crd = f['coordinates'][:, struct_id, :][()]
 
-    n_particles = len(crd)
-    for i in range(n_particles):
-        model.addParticle(crd[i], radii[i], Particle.NORMAL)
+    model.addParticles(crd, radii, Particle.NORMAL)
         
     ee = Envelope(cfg['model']['nucleus_geometry'])
     model.addRestraint(ee)
@@ -74,7 +72,7 @@ def modeling_task(struct_id, cfg_file):
     kernel = kernel_class[cfg['mstep']['kernel']]
     info = kernel.optimize(model, cfg['optimization'])
     
-    new_crd = np.array([p.pos for p in model.particles], dtype=COORD_DTYPE) 
+    new_crd = model.positions.astype(COORD_DTYPE)
     np.save(local_vars['crd_out'], new_crd)
 
     # make sure that is readable
@@ -94,3 +94,94 @@ def get_actdist(i, j, pwish, plast, hss, contactRange=2, option=0):
         else:
             res = [(i0, i1, activation_distance, p) for i0 in ii for i1 in jj]
     return res
+
+def population_fingerprint(hss):
+    '''
+    Cheap identifier of the coordinates in a population file: md5 of the
+    coordinates shape and of the coordinates of the first and last bead
+    across all structures. Any optimization changes it.
+    '''
+    import hashlib
+    import numpy as np
+
+    crd = hss['coordinates']
+    h = hashlib.md5(np.array(crd.shape, dtype='i8').tobytes())
+    h.update(np.ascontiguousarray(crd[0], dtype='f4').tobytes())
+    h.update(np.ascontiguousarray(crd[-1], dtype='f4').tobytes())
+    return h.hexdigest()
+
+def read_pnow_matrix(actdist_file, hss, contact_range):
+    '''
+    Read the population contact frequencies stored by the
+    ActivationDistanceStep in an actdist file.
+
+    Returns
+    -------
+        scipy.sparse.csr_matrix with the frequencies of the candidate pairs
+        (upper triangle), or None if they are not available, or they were
+        computed on a different population or contact range.
+    '''
+    import h5py
+    import numpy as np
+    import scipy.sparse
+
+    if actdist_file is None:
+        return None
+    with h5py.File(actdist_file, 'r') as h5f:
+        if 'pnow' not in h5f:
+            return None
+        grp = h5f['pnow']
+        if grp.attrs.get('population') != population_fingerprint(hss):
+            return None
+        if not np.isclose(grp.attrs.get('contact_range', -1), contact_range):
+            return None
+        return scipy.sparse.csr_matrix(
+            (grp['pnow'][()], (grp['row'][()], grp['col'][()])),
+            shape=tuple(grp.attrs['shape'])
+        )
+
+def get_contact_frequencies(hss, row, col, contact_range, actdist_file=None, tile_size=64):
+    '''
+    Population contact frequencies (as defined in the activation distance
+    computation) for a set of (row, col) locus pairs, row < col.
+
+    Frequencies stored in `actdist_file` are reused if they refer to the
+    same population and contact range, only the missing pairs are computed.
+    '''
+    import numpy as np
+    from ..steps.ActivationDistanceStep import get_actdist_tile
+
+    row = np.asarray(row, dtype=np.int64)
+    col = np.asarray(col, dtype=np.int64)
+    freq = np.zeros(len(row))
+    missing = np.ones(len(row), dtype=bool)
+
+    pnow = read_pnow_matrix(actdist_file, hss, contact_range)
+    if pnow is not None and pnow.nnz:
+        # pairs with zero frequency are stored explicitly, so look for the
+        # pairs in the sparsity structure, joining on the row * n + col key
+        n = pnow.shape[1]
+        pnow = pnow.tocoo()
+        stored_keys = pnow.row.astype(np.int64) * n + pnow.col
+        order = np.argsort(stored_keys)
+        stored_keys = stored_keys[order]
+        keys = row * n + col
+        pos = np.minimum(np.searchsorted(stored_keys, keys), len(stored_keys) - 1)
+        found = stored_keys[pos] == keys
+        freq[found] = pnow.data[order[pos[found]]]
+        missing[found] = False
+
+    todo = np.flatnonzero(missing)
+    if len(todo):
+        index = hss.index
+        radii = hss.radii
+        crd = hss['coordinates']
+        zeros = np.zeros(tile_size)
+        for start in range(0, len(todo), tile_size):
+            tile = todo[start:start + tile_size]
+            _, freq[tile] = get_actdist_tile(
+                row[tile], col[tile], zeros[:len(tile)], zeros[:len(tile)],
+                crd, radii, index.copy_index, index.chrom,
+                contactRange=contact_range, return_pnow=True
+            )
+    return freq
@@ -114,6 +114,51 @@ class HmsFile(h5py.File):
         #-
         return len(ratios)
 
+def read_bead_block(crd, beads, dtype='f4'):
+    '''
+    Read a set of bead rows from a bead-major coordinates array (either a
+    h5py dataset or a numpy array of shape n_bead x n_struct x 3).
+
+    Every requested bead is read exactly once, in increasing order (hdf5
+    requires sorted indexes for fancy selections).
+
+    Returns
+    -------
+    beads : np.ndarray
+        the sorted, unique bead indexes which have been read
+    block : np.ndarray
+        contiguous (len(beads), n_struct, 3) array of coordinates
+    '''
+    beads = np.unique(np.asarray(beads, dtype=np.int64))
+    if len(beads) == 0:
+        return beads, np.empty((0, crd.shape[1], 3), dtype=dtype)
+    block = np.ascontiguousarray(crd[beads.tolist()], dtype=dtype)
+    return beads, block
+
+def save_npy_batch(fname, data):
+    '''
+    Save a batch result (usually a structured array) to a binary .npy file.
+    The file name is used as is (np.save would append a .npy extension).
+    '''
+    with open(fname, 'wb') as f:
+        np.save(f, data)
+
+def h5_append_columns(root, data, chunk_size=65536):
+    '''
+    Append the rows of a structured array to one resizable 1D dataset per
+    field, named as the field. Datasets are created if they do not exist.
+    '''
+    for name in data.dtype.names:
+        if name not in root:
+            root.create_dataset(name, shape=(0,), maxshape=(None,),
+                                dtype=data.dtype[name], chunks=(chunk_size,))
+        dset = root[name]
+        n = dset.shape[0]
+        if len(data):
+            dset.resize((n + len(data),))
+            dset[n:] = data[name]
+    return root
+
 def make_absolute_path(path, basedir='.'):
     import os.path
     if os.path.isabs(path):
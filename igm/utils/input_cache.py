@@ -0,0 +1,105 @@
+'''
+Process-local cache of the read-only inputs of the restraints (activation
+distances, assignment files, contact probabilities, volumetric maps).
+
+Entries are keyed by the real path of the file, and by its modification time
+and size, so a new version of a file is always read again (and replaces the
+old entry). The cache lives in the worker process, so on persistent engines
+only the first task reads the files, and the following ones only slice the
+cached arrays. With the ipyparallel controller this holds when no task
+timeout is set: with a timeout each task runs in a forked child process,
+and its cache entries are lost when the task ends.
+
+HDF5 datasets which are stored contiguously and without filters are mapped
+directly from the file (zero-copy), the others are read into memory.
+'''
+
+from __future__ import division, print_function
+
+import os
+import os.path
+import numpy as np
+import h5py
+
+_cache = {}
+_enabled = True
+
+
+def configure(cfg):
+
+    """ Enable or disable the cache, from `optimization/input_cache` """
+
+    global _enabled
+    _enabled = cfg.get('optimization/input_cache', True)
+    if not _enabled:
+        clear()
+
+
+def clear():
+    _cache.clear()
+
+
+def file_key(fname):
+    st = os.stat(fname)
+    return os.path.realpath(fname), st.st_mtime_ns, st.st_size
+
+
+def cached(fname, loader, name):
+    '''
+    Returns loader(fname), cached in the current process.
+
+    Parameters
+    ----------
+    fname : str
+        input file
+    loader : callable
+        function reading the file
+    name : str
+        identifies the loader, the same file can be cached by different
+        loaders
+    '''
+    if not _enabled:
+        return loader(fname)
+
+    path, mtime, size = file_key(fname)
+    key = (name, path)
+    entry = _cache.get(key)
+    if entry is None or entry[0] != (mtime, size):
+        _cache.pop(key, None)
+        entry = _cache[key] = ((mtime, size), loader(fname))
+    return entry[1]
+
+
+def read_h5_dataset(h5f, name):
+
+    """ Maps a dataset from the file if possible, otherwise reads it """
+
+    dset = h5f[name]
+    offset = dset.id.get_offset()
+    if (offset is not None and dset.chunks is None and dset.compression is None and
+            dset.size > 0 and dset.dtype.kind in 'biuf'):
+        return np.memmap(h5f.filename, mode='r', dtype=dset.dtype, offset=offset, shape=dset.shape)
+    return dset[()]
+
+
+def load_h5_arrays(fname, names):
+
+    """ Returns a dictionary of the datasets `names` of a HDF5 file (missing datasets are skipped) """
+
+    with h5py.File(fname, 'r') as h5f:
+        return {k: read_h5_dataset(h5f, k) for k in names if k in h5f}
+
+
+def h5_arrays(fname, names):
+    '''
+    Cached `load_h5_arrays`
+    '''
+    names = tuple(names)
+    return cached(fname, lambda f: load_h5_arrays(f, names), 'h5:' + ','.join(names))
+
+
+def npy(fname):
+    '''
+    Cached, memory mapped .npy file
+    '''
+    return cached(fname, lambda f: np.load(f, mmap_mode='r'), 'npy')
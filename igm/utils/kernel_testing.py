@@ -41,9 +41,7 @@ def debug_minimization(cfg, struct_id, rname, **kwargs):
     chain_ids = np.concatenate( [ [i]*s for i, s in enumerate(index.chrom_sizes) ] )
 
     #add particles into model
-    n_particles = len(crd)
-    for i in range(n_particles):
-        model.addParticle(crd[i], radii[i], Particle.NORMAL, chainID=chain_ids[i])
+    model.addParticles(crd, radii, Particle.NORMAL, chain_ids=chain_ids)
 
     #========Add restraint
     monitored_restraints = []
@@ -0,0 +1,151 @@
+from __future__ import division, print_function
+
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import numpy as np
+import scipy.sparse
+
+from .log import logger
+
+CACHE_VERSION = 1
+
+# read size when hashing the source file
+HASH_BLOCK_SIZE = 1 << 24
+
+
+def file_hash(fname):
+
+    """ sha1 of the content of a file """
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def input_matrix_cache_dir(cfg):
+
+    """ Run-scoped directory for the input matrix cache """
+
+    return os.path.join(cfg.get('parameters/tmp_dir'), 'matrix_cache')
+
+
+class CachedContactMatrix(object):
+    '''
+    Memory-mapped representation of a parsed contact matrix (see
+    `load_contact_matrix`). Only the upper triangle (row < col) is stored,
+    in CSR order:
+
+    row, col, data : np.ndarray
+        upper triangle COO arrays, sorted by row and column
+    indptr : np.ndarray
+        CSR row pointers for col/data
+    chrom : np.ndarray
+        chromosome id of each row
+    shape : tuple
+        shape of the matrix
+    '''
+
+    FIELDS = ['row', 'col', 'data', 'indptr', 'chrom', 'shape']
+
+    def __init__(self, path):
+        for k in self.FIELDS:
+            setattr(self, k, np.load(os.path.join(path, k + '.npy'), mmap_mode='r'))
+        self.shape = tuple(int(x) for x in self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def csr(self):
+        return scipy.sparse.csr_matrix((self.data, self.col, self.indptr), shape=self.shape)
+
+    def superdiagonal(self):
+
+        """ Values at (i, i+1) for i in 0 ... n-2 """
+
+        out = np.zeros(max(self.shape[0] - 1, 0), dtype=self.data.dtype)
+        ii = np.flatnonzero(self.col == self.row + 1)
+        out[self.row[ii]] = self.data[ii]
+        return out
+
+
+def _write_cache(fname, path):
+
+    """ Parse the matrix with alabtools and write the arrays to a new cache directory """
+
+    from alabtools import Contactmatrix
+
+    cm = Contactmatrix(fname)
+    coo = cm.matrix.csr.tocoo()
+    keep = coo.row < coo.col
+    row, col, data = coo.row[keep], coo.col[keep], coo.data[keep]
+    order = np.lexsort((col, row))
+    row, col, data = row[order], col[order], data[order]
+
+    n = cm.matrix.shape[0]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(row, minlength=n))
+
+    arrays = {
+        'row': row.astype(np.int32),
+        'col': col.astype(np.int32),
+        'data': data,
+        'indptr': indptr,
+        'chrom': np.asarray(cm.index.chrom),
+        'shape': np.array(cm.matrix.shape, dtype=np.int64),
+    }
+
+    tmppath = '{}.{:d}.tmp'.format(path, os.getpid())
+    if os.path.isdir(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmppath, k + '.npy'), v)
+    try:
+        os.rename(tmppath, path)
+    except OSError:
+        # someone else created it in the meantime
+        shutil.rmtree(tmppath)
+
+
+def load_contact_matrix(fname, cache_dir):
+    '''
+    Returns a `CachedContactMatrix` for the contact matrix file `fname`.
+
+    The matrix is parsed only the first time: its arrays are saved in a
+    `cache_dir` subdirectory named by the sha1 of the file content, and
+    memory-mapped by all the following calls. To avoid hashing the file on
+    every call, the hash is stored with the file modification time and size,
+    and recomputed only if they change.
+    '''
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    st = os.stat(fname)
+    stamp_file = os.path.join(
+        cache_dir, hashlib.md5(os.path.realpath(fname).encode()).hexdigest() + '.json'
+    )
+    stamp = {}
+    if os.path.isfile(stamp_file):
+        with open(stamp_file) as f:
+            stamp = json.load(f)
+
+    if stamp.get('mtime') == st.st_mtime_ns and stamp.get('size') == st.st_size:
+        content_hash = stamp['hash']
+    else:
+        content_hash = file_hash(fname)
+        with open(stamp_file, 'w') as f:
+            json.dump({'path': os.path.realpath(fname), 'mtime': st.st_mtime_ns,
+                       'size': st.st_size, 'hash': content_hash}, f)
+
+    path = os.path.join(cache_dir, 'matrix-{:d}-{}'.format(CACHE_VERSION, content_hash))
+    if not os.path.isdir(path):
+        logger.info('caching input matrix %s', fname)
+        _write_cache(fname, path)
+
+    return CachedContactMatrix(path)
@@ -0,0 +1,228 @@
+from __future__ import division, print_function
+
+import os
+import os.path
+import glob
+import fcntl
+import hashlib
+import numpy as np
+
+from alabtools.analysis import HssFile
+
+from .log import logger
+
+CACHE_PREFIX = 'igm-population-'
+DEFAULT_CACHE_DIR = '/dev/shm'
+
+# number of coordinates copied at once when the cache is created
+COPY_BLOCK_SIZE = 1e7
+
+
+def _path_hash(hssfname):
+    return hashlib.md5(os.path.realpath(hssfname).encode()).hexdigest()
+
+
+def cache_filename(hssfname, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Node-local cache file for the population coordinates. The name is keyed
+    by the (real) path of the hss file, and by its modification time and
+    size, so that a new population never maps stale coordinates.
+    '''
+    st = os.stat(hssfname)
+    return os.path.join(
+        cache_dir,
+        '{}{}.{:d}-{:d}.npy'.format(CACHE_PREFIX, _path_hash(hssfname), st.st_mtime_ns, st.st_size)
+    )
+
+
+def _write_cache(hssfname, fname):
+
+    """ Copy the bead-major coordinates from the hss file into a .npy file, then atomically rename it """
+
+    tmpname = '{}.{:d}.tmp'.format(fname, os.getpid())
+    with HssFile(hssfname, 'r') as hss:
+        crd = hss['coordinates']
+        out = np.lib.format.open_memmap(tmpname, mode='w+', dtype=crd.dtype, shape=crd.shape)
+        step = max(1, int(COPY_BLOCK_SIZE / crd.shape[1] / 3))
+        for start in range(0, crd.shape[0], step):
+            out[start:start + step] = crd[start:start + step]
+        out.flush()
+        del out
+    os.rename(tmpname, fname)
+
+
+def _remove_cache_files(hssfname, cache_dir, keep=None):
+    pattern = os.path.join(cache_dir, CACHE_PREFIX + _path_hash(hssfname) + '.*')
+    for f in glob.glob(pattern):
+        if keep is not None and f.startswith(keep):
+            continue
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+
+# caches mapped by this process: a shared lock is held on their '.users'
+# file, so that other processes know that they are in use
+_cache_locks = {}
+
+
+def load_population_cache(hssfname, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Returns the bead-major coordinates (n_bead x n_struct x 3) of a population
+    as a read-only numpy memmap of a node-local file (by default in /dev/shm).
+
+    The first task on a node reads the coordinates from the hss file and writes
+    the cache, while the other tasks on the same node wait on a file lock. All
+    the following tasks just map the file, sharing the same pages in memory
+    (zero-copy). Each process keeps a shared lock on the cache while it
+    is alive (see release_idle_population_caches).
+
+    Caches for older versions of the same hss file are removed when a new one
+    is created, so each node keeps at most one copy of each population.
+    '''
+    fname = cache_filename(hssfname, cache_dir)
+    if fname not in _cache_locks or not os.path.isfile(fname):
+        # register as a user of the cache (see release_idle_population_caches)
+        uf = open(fname + '.users', 'a')
+        fcntl.flock(uf, fcntl.LOCK_SH)
+        old = _cache_locks.pop(fname, None)
+        if old is not None:
+            old.close()
+        _cache_locks[fname] = uf
+
+        if not os.path.isfile(fname):
+            with open(fname + '.lock', 'w') as lf:
+                fcntl.flock(lf, fcntl.LOCK_EX)
+                try:
+                    if not os.path.isfile(fname):
+                        _remove_cache_files(hssfname, cache_dir, keep=fname)
+                        _write_cache(hssfname, fname)
+                finally:
+                    fcntl.flock(lf, fcntl.LOCK_UN)
+    return np.load(fname, mmap_mode='r')
+
+
+def release_population_cache(hssfname, cache_dir=DEFAULT_CACHE_DIR):
+    '''
+    Removes the cache files for a population on the current node. At the end
+    of a step, this is run on every worker through Controller.broadcast.
+    '''
+    if os.path.isdir(cache_dir):
+        _remove_cache_files(hssfname, cache_dir)
+
+
+def release_idle_population_caches():
+    '''
+    Removes the caches mapped by this process which are not in use by other
+    processes on the node. Used by controllers without persistent workers,
+    whose jobs cannot be reached at the end of the step.
+    '''
+    for fname, uf in list(_cache_locks.items()):
+        del _cache_locks[fname]
+        try:
+            fcntl.flock(uf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            # still mapped by another task
+            uf.close()
+            continue
+        try:
+            for f in [fname, fname + '.lock', fname + '.users']:
+                if os.path.isfile(f):
+                    os.remove(f)
+        except OSError:
+            pass
+        finally:
+            uf.close()
+
+
+def get_population_coordinates(hss, cfg):
+    '''
+    Returns the bead-major coordinates to be read by an assignment task.
+    If `optimization/population_cache` is set, the coordinates are mapped
+    from the node-local shared cache, otherwise the hss dataset is returned.
+    '''
+    if cfg.get('optimization/population_cache', False):
+        cache_dir = cfg.get('optimization/population_cache_dir', DEFAULT_CACHE_DIR)
+        if os.path.isdir(cache_dir):
+            return load_population_cache(hss.filename, cache_dir)
+        logger.warning('population cache directory %s does not exist, reading from %s', cache_dir, hss.filename)
+    return hss['coordinates']
+
+
+# ---- struct-major copy of the population, for the per-structure (modeling) tasks
+
+STRUCT_MAJOR_SUFFIX = '.bystruct'
+
+
+def struct_major_filename(hssfname):
+    '''
+    Struct-major copy of the population coordinates, next to the hss file
+    (so that it is visible to all the nodes). As for the node-local cache,
+    the name is keyed by the modification time and size of the hss file.
+    '''
+    st = os.stat(hssfname)
+    return '{}{}.{:d}-{:d}.npy'.format(hssfname, STRUCT_MAJOR_SUFFIX, st.st_mtime_ns, st.st_size)
+
+
+def _remove_struct_major_files(hssfname, keep=None):
+    for f in glob.glob(glob.escape(hssfname + STRUCT_MAJOR_SUFFIX) + '.*'):
+        if keep is not None and f.startswith(keep):
+            continue
+        try:
+            os.remove(f)
+        except OSError:
+            pass
+
+
+def create_struct_major_copy(hssfname):
+    '''
+    Writes the coordinates of a population as a struct-major
+    (n_struct x n_bead x 3) .npy file, transposing blocks of beads from the
+    bead-major hss dataset, so that each structure is a contiguous block.
+    Nothing is done if the copy for the current version of the file exists.
+    It is intended to be called by the master node before mapping the tasks.
+    '''
+    fname = struct_major_filename(hssfname)
+    if os.path.isfile(fname):
+        return fname
+
+    _remove_struct_major_files(hssfname)
+    tmpname = '{}.{:d}.tmp'.format(fname, os.getpid())
+    with HssFile(hssfname, 'r') as hss:
+        crd = hss['coordinates']
+        n_bead, n_struct = crd.shape[0], crd.shape[1]
+        out = np.lib.format.open_memmap(tmpname, mode='w+', dtype=crd.dtype, shape=(n_struct, n_bead, 3))
+        step = max(1, int(COPY_BLOCK_SIZE / n_struct / 3))
+        for start in range(0, n_bead, step):
+            out[:, start:start + step] = crd[start:start + step].transpose(1, 0, 2)
+        out.flush()
+        del out
+    os.rename(tmpname, fname)
+    return fname
+
+
+def release_struct_major_copy(hssfname):
+
+    """ Removes the struct-major copies of a population """
+
+    _remove_struct_major_files(hssfname)
+
+
+def get_struct_coordinates(hss, struct_ids, cfg):
+    '''
+    Returns the coordinates of a list of structures, to be read by a
+    modeling task. If `optimization/struct_major_copy` is set and the copy
+    for the current version of the hss file exists, consecutive structures
+    are read with a single contiguous read from it, otherwise each
+    structure is read from the hss dataset.
+    '''
+    if cfg.get('optimization/struct_major_copy', False):
+        fname = struct_major_filename(hss.filename)
+        if os.path.isfile(fname):
+            crd = np.load(fname, mmap_mode='r')
+            ids = np.asarray(struct_ids, dtype=np.int64)
+            if len(ids) and np.all(np.diff(ids) == 1):
+                return list(np.array(crd[ids[0]:ids[-1] + 1]))
+            return [np.array(crd[i]) for i in ids]
+    return [hss.get_struct_crd(i) for i in struct_ids]
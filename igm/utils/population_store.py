@@ -0,0 +1,150 @@
+'''
+Directory store for the results of the modeling tasks, written directly
+by the workers (see `optimization/result_storage`).
+
+Structures are grouped in chunks of `chunk_size` consecutive structures,
+and each chunk is written by a single task, so that workers never write to
+the same files. The results of a chunk are stored by column:
+
+    <path>/<chunk>/struct_ids.npy     (k,) structures in the chunk
+    <path>/<chunk>/coordinates.npy    (k, n_bead, 3)
+    <path>/<chunk>/<column>.npy       (k, ...) other per-structure arrays
+    <path>/<chunk>/info.json          values which are not arrays
+
+A chunk is written to a temporary directory, which is then renamed: it is
+either complete or missing.
+'''
+
+from __future__ import division, print_function
+
+import os
+import os.path
+import json
+import shutil
+import numpy as np
+
+COORDINATES = 'coordinates'
+STRUCT_IDS = 'struct_ids'
+INFO = 'info.json'
+
+
+def chunk_index(struct_id, chunk_size):
+    return int(struct_id) // int(chunk_size)
+
+
+def chunk_path(path, chunk):
+    return os.path.join(path, '%d' % chunk)
+
+
+def has_chunk(path, chunk):
+    return os.path.isdir(chunk_path(path, chunk))
+
+
+def list_chunks(path):
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(d) for d in os.listdir(path) if d.isdigit())
+
+
+def write_chunk(path, chunk, struct_ids, coordinates, columns=None, info=None):
+    '''
+    Write the results of the structures `struct_ids`, which must belong to
+    the same chunk. An existing chunk is replaced.
+
+    Parameters
+    ----------
+    path : str
+        store directory, created if needed
+    chunk : int
+        chunk index
+    struct_ids : list of int
+        structures in the chunk
+    coordinates : np.ndarray
+        (len(struct_ids), n_bead, 3) coordinates
+    columns : dict
+        other arrays, with one row per structure
+    info : dict
+        json serializable data
+    '''
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # created by another worker
+            if not os.path.isdir(path):
+                raise
+
+    fname = chunk_path(path, chunk)
+    tmpname = '{}.{:d}.tmp'.format(fname, os.getpid())
+    if os.path.isdir(tmpname):
+        shutil.rmtree(tmpname)
+    os.mkdir(tmpname)
+
+    np.save(os.path.join(tmpname, STRUCT_IDS), np.asarray(struct_ids, dtype=np.int64))
+    np.save(os.path.join(tmpname, COORDINATES), np.asarray(coordinates, dtype=np.float32))
+    for k, v in (columns or {}).items():
+        v = np.asarray(v)
+        if len(v) != len(struct_ids):
+            raise ValueError('column %s has %d rows, %d structures' % (k, len(v), len(struct_ids)))
+        np.save(os.path.join(tmpname, k), v)
+    with open(os.path.join(tmpname, INFO), 'w') as f:
+        json.dump(info or {}, f)
+
+    if os.path.isdir(fname):
+        shutil.rmtree(fname)
+    os.rename(tmpname, fname)
+
+
+def read_chunk(path, chunk, coordinates=False):
+    '''
+    Read the arrays of a chunk.
+
+    Returns
+    -------
+    struct_ids : np.ndarray
+    columns : dict
+        per-structure arrays (coordinates only if `coordinates` is True,
+        memory mapped)
+    info : dict
+    '''
+    fname = chunk_path(path, chunk)
+    if not os.path.isdir(fname):
+        raise RuntimeError('chunk %d is missing in %s' % (chunk, path))
+
+    columns = {}
+    for f in os.listdir(fname):
+        k, ext = os.path.splitext(f)
+        if ext != '.npy' or k == STRUCT_IDS:
+            continue
+        if k == COORDINATES:
+            if coordinates:
+                columns[k] = np.load(os.path.join(fname, f), mmap_mode='r')
+        else:
+            columns[k] = np.load(os.path.join(fname, f))
+    with open(os.path.join(fname, INFO), 'r') as fp:
+        info = json.load(fp)
+    return np.load(os.path.join(fname, STRUCT_IDS + '.npy')), columns, info
+
+
+def write_coordinates(path, dset, chunks=None):
+    '''
+    Copy the coordinates of the store into the bead-major (n_bead, n_struct, 3)
+    dataset `dset`, one chunk at a time. Structures missing in the store
+    are not modified.
+    '''
+    for chunk in (list_chunks(path) if chunks is None else chunks):
+        struct_ids, columns, _ = read_chunk(path, chunk, coordinates=True)
+        if len(struct_ids) == 0:
+            continue
+        crd = np.swapaxes(columns[COORDINATES], 0, 1)
+        start, stop = struct_ids[0], struct_ids[-1] + 1
+        if stop - start == len(struct_ids) and np.all(np.diff(struct_ids) == 1):
+            dset[:, start:stop, :] = crd
+        else:
+            order = np.argsort(struct_ids)
+            dset[:, struct_ids[order].tolist(), :] = crd[:, order, :]
+
+
+def remove_store(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
@@ -0,0 +1,128 @@
+'''
+In-process repacking of population (hss) files, replacing the
+`h5repack -l coordinates:CHUNK=...` runs at the end of the structure
+generation steps.
+
+The file is copied object by object, and the coordinates are streamed into
+a dataset chunked by beads (each chunk holds all the structures of a group
+of beads), in blocks of whole chunks. A checksum of each block is computed
+while writing, and the output is read back and checked against it.
+'''
+
+from __future__ import division, print_function
+
+import os
+import zlib
+import h5py
+
+from .log import logger
+
+# target number of coordinates per chunk of the repacked dataset
+PACK_SIZE = 1e6
+
+# number of coordinates copied at once
+BLOCK_SIZE = 5e7
+
+
+def bead_major_chunks(n_bead, n_struct):
+
+    """ Chunks of the repacked coordinates: all the structures of ~PACK_SIZE / n_struct / 3 beads """
+
+    pack_beads = max(1, int(PACK_SIZE / n_struct / 3))
+    pack_beads = min(pack_beads, n_bead)
+    return (pack_beads, n_struct, 3)
+
+
+def _blocks(n, chunk, block_size, row_size):
+    step = max(1, int(block_size / row_size) // chunk) * chunk
+    for start in range(0, n, step):
+        yield start, min(start + step, n)
+
+
+def _copy_attrs(src, dst):
+    for k, v in src.attrs.items():
+        dst.attrs[k] = v
+
+
+def _verify(fname, names, checksums, chunks, block_size):
+    with h5py.File(fname, 'r') as h5f:
+        missing = [k for k in names if k not in h5f]
+        if missing:
+            raise RuntimeError('repacking failed, missing objects in %s: %s' % (fname, ', '.join(missing)))
+        crd = h5f['coordinates']
+        if crd.chunks != chunks:
+            raise RuntimeError('repacking failed, wrong chunks in %s: %s' % (fname, crd.chunks))
+        row_size = crd.shape[1] * crd.shape[2]
+        for (start, end), crc in zip(_blocks(crd.shape[0], chunks[0], block_size, row_size), checksums):
+            if zlib.crc32(crd[start:end].tobytes()) != crc:
+                raise RuntimeError('repacking failed, coordinates of beads %d-%d differ in %s' % (start, end, fname))
+
+
+def repack_hss(src, dst, chunks=None, block_size=BLOCK_SIZE, verify=True):
+    '''
+    Writes a copy of the population file `src` to `dst`, with the
+    coordinates chunked by beads.
+
+    If the coordinates of `src` already have the requested chunks, nothing
+    is written and the caller can use `src` as it is.
+
+    Parameters
+    ----------
+    src, dst : str
+        input and output files
+    chunks : tuple, optional
+        chunks of the output coordinates (by default, see bead_major_chunks)
+    block_size : int
+        approximate number of coordinates read and written at once, rounded
+        to whole chunks
+    verify : bool
+        read back the output and compare the coordinates with the checksums
+        of the written blocks
+
+    Returns
+    -------
+    repacked : bool
+        False if `src` already has the requested layout and `dst` has not
+        been written
+    '''
+
+    with h5py.File(src, 'r') as inp:
+        crd = inp['coordinates']
+        n_bead, n_struct = crd.shape[0], crd.shape[1]
+        if chunks is None:
+            chunks = bead_major_chunks(n_bead, n_struct)
+        chunks = tuple(chunks)
+
+        if crd.chunks == chunks:
+            logger.debug('%s already has the requested layout', src)
+            return False
+
+        names = list(inp.keys())
+        checksums = []
+        with h5py.File(dst, 'w') as out:
+            _copy_attrs(inp, out)
+            for name in names:
+                if name != 'coordinates':
+                    inp.copy(inp[name], out, name=name)
+
+            dset = out.create_dataset(
+                'coordinates', shape=crd.shape, dtype=crd.dtype, chunks=chunks,
+                compression=crd.compression, compression_opts=crd.compression_opts,
+                shuffle=crd.shuffle, fletcher32=crd.fletcher32, fillvalue=crd.fillvalue
+            )
+            _copy_attrs(crd, dset)
+
+            # whole chunks of the output are written at once
+            row_size = n_struct * crd.shape[2]
+            for start, end in _blocks(n_bead, chunks[0], block_size, row_size):
+                block = crd[start:end]
+                dset[start:end] = block
+                checksums.append(zlib.crc32(block.tobytes()))
+
+    if verify:
+        try:
+            _verify(dst, names, checksums, chunks, block_size)
+        except:
+            os.remove(dst)
+            raise
+    return True
@@ -35,6 +35,8 @@ extras_require = {
 extensions = [
     Extension("igm.cython_compiled.sprite",
               ["igm/cython_compiled/sprite.pyx", "igm/cython_compiled/cpp_sprite_assignment.cpp"]),
+    Extension("igm.cython_compiled.actdist",
+              ["igm/cython_compiled/actdist.pyx", "igm/cython_compiled/cpp_actdist.cpp"]),
 ]
 
 extensions = cythonize(extensions)
@@ -0,0 +1,96 @@
+from __future__ import division, print_function
+
+import unittest
+import numpy as np
+from scipy.spatial import cKDTree
+
+from igm.model import Model, Particle
+from igm.model.forces import Force, ExcludedVolume, EllipticEnvelope, NuclExcludedVolume
+from igm.model.kernel.numpy_kernel import ArrayModel, cell_list_pairs
+
+
+def random_model(n=60, seed=0):
+    rng = np.random.RandomState(seed)
+    crd = rng.uniform(-1000, 1000, (n, 3))
+    radii = rng.uniform(100, 200, n)
+
+    m = Model()
+    m.addParticles(crd, radii, Particle.NORMAL)
+    ids = list(range(n))
+    m.addForce(ExcludedVolume(ids, k=1.0))
+    m.addBonds(Force.HARMONIC_UPPER_BOUND, ids[:-1], ids[1:], rng.uniform(200, 600, n - 1), 0.5)
+    m.addBonds(Force.HARMONIC_LOWER_BOUND, ids[:-2], ids[2:], rng.uniform(600, 1500, n - 2), 0.5)
+    m.addForce(EllipticEnvelope(ids, semiaxes=(1000, 900, 800), k=1.0))
+    m.addForce(NuclExcludedVolume(ids, (300., -200., 100.), 500., k=2.0))
+    return m
+
+
+class TestCellListPairs(unittest.TestCase):
+
+    def check(self, crd, cutoff):
+        pi, pj = cell_list_pairs(crd, cutoff)
+        self.assertTrue(np.all(pi < pj))
+        found = set(zip(pi.tolist(), pj.tolist()))
+        self.assertEqual(len(found), len(pi))
+        expected = {(i, j) for i, j in cKDTree(crd).query_pairs(cutoff) if np.linalg.norm(crd[i] - crd[j]) < cutoff}
+        self.assertEqual(found, expected)
+
+    def test_random(self):
+        rng = np.random.RandomState(1)
+        for n, cutoff in [(2, 10.0), (50, 0.3), (500, 0.1), (500, 2.0)]:
+            self.check(rng.uniform(-1, 1, (n, 3)), cutoff)
+
+    def test_flat_and_clustered(self):
+        rng = np.random.RandomState(2)
+        flat = rng.uniform(0, 5, (300, 3))
+        flat[:, 2] = 0
+        self.check(flat, 0.4)
+        clustered = np.concatenate([rng.normal(0, 0.05, (100, 3)), rng.normal(3, 0.05, (100, 3))])
+        self.check(clustered, 0.1)
+
+    def test_empty(self):
+        pi, pj = cell_list_pairs(np.zeros((1, 3)), 1.0)
+        self.assertEqual(len(pi), 0)
+        pi, pj = cell_list_pairs(np.random.rand(10, 3), 0.0)
+        self.assertEqual(len(pi), 0)
+
+
+class TestArrayModelEnergy(unittest.TestCase):
+
+    def test_gradient(self):
+        m = ArrayModel(random_model())
+        crd = m.crd.copy()
+        m.update_neighbors(crd, 0.0)
+
+        terms = {}
+        e, grad = m.energy(crd, terms=terms)
+        # all the terms are active
+        self.assertTrue(all(v > 0 for v in terms.values()), terms)
+        self.assertEqual(len(terms), 4)
+
+        h = 1e-4
+        num = np.zeros_like(crd)
+        for i in range(len(crd)):
+            for d in range(3):
+                x = crd.copy()
+                x[i, d] += h
+                ep, _ = m.energy(x)
+                x[i, d] -= 2 * h
+                em, _ = m.energy(x)
+                num[i, d] = (ep - em) / (2 * h)
+        np.testing.assert_allclose(grad, num, rtol=1e-5, atol=1e-6 * np.abs(num).max())
+
+    def test_body_energy(self):
+        m = Model()
+        m.addParticles(np.array([[300., 0., 0.], [1000., 0., 0.]]), np.array([100., 100.]))
+        m.addForce(NuclExcludedVolume([0, 1], (0., 0., 0.), 500., k=2.0))
+        am = ArrayModel(m)
+        e, grad = am.energy(am.crd.copy())
+        # the first particle overlaps the body by 300, the second one is outside
+        self.assertAlmostEqual(e, 2.0 * 300 ** 2)
+        np.testing.assert_allclose(grad[0], [-2.0 * 2.0 * 300, 0, 0])
+        np.testing.assert_allclose(grad[1], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()